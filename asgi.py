@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+ASGI Entry Point for Alana Legal Sense
+Sirve /chat y /chat/stream con clientes asíncronos de OpenAI: mientras una
+pregunta espera al LLM o a los embeddings, el mismo proceso atiende cientos de
+peticiones más. El resto de rutas (upload, historial, jobs...) siguen siendo
+las de Flask, montadas como WSGI, con los mismos contratos JSON.
+
+    uvicorn asgi:app --host 0.0.0.0 --port $PORT --workers 2
+    gunicorn asgi:app -k uvicorn.workers.UvicornWorker --config gunicorn.conf.py
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+from anyio import CapacityLimiter, to_thread
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+# Asegurar que el directorio actual está en el path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+from main import (
+    LLM, QUERY_EMBEDDINGS, RAG_TIMEOUT, STREAMED_LIST_FIELDS, Deadline, LLMUnavailable, ann_search_kwargs, build_rag_messages,
+    cache_namespace, cache_payload, cluster_response, finalize_rag_answer, format_sse, get_cached_response, get_corpus_id,
+    get_respuesta_by_tipo, get_semantic_cached_response, is_clarify_request, is_trivial_message,
+    load_vector_db_if_needed, make_key, parse_partial_json, parse_search_filter,
+    parse_session_id, parse_tenant, persist_rag_answer, retrieve_rag_context,
+)
+
+# Hilos para lo que sigue siendo bloqueante (FAISS, cache en disco, Supabase)
+THREAD_LIMIT = int(os.getenv("ASGI_THREADS", "64"))
+
+# Single-flight dentro del proceso: peticiones idénticas comparten la misma tarea
+_inflight = {}
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+_thread_limiter = None
+
+
+async def run_blocking(func, *args):
+    """Ejecuta `func` en el pool de hilos (el limitador se crea dentro del event loop)."""
+    global _thread_limiter
+    if _thread_limiter is None:
+        _thread_limiter = CapacityLimiter(THREAD_LIMIT)
+    return await to_thread.run_sync(lambda: func(*args), limiter=_thread_limiter)
+
+
+def _flask_chat(form):
+    """Ejecuta la vista /chat de Flask (rutas sin RAG) y devuelve su JSON."""
+    with main.app.test_request_context("/chat", method="POST", data=form):
+        return main.chat().get_json()
+
+
+async def aembed_query(vector_db, user_text):
+    """Embedding de la pregunta sin bloquear el event loop (None si falla)."""
+    try:
+        embedder = getattr(vector_db, "embeddings", None)
+        if embedder is not None and hasattr(embedder, "aembed_query"):
+            return await QUERY_EMBEDDINGS.aembed(embedder, user_text)
+        model = "text-embedding-ada-002"
+        vector = QUERY_EMBEDDINGS.get(user_text, model)
+        if vector is None:
+            response = await LLM.aclient.embeddings.create(model=model, input=user_text)
+            vector = response.data[0].embedding
+            QUERY_EMBEDDINGS.put(user_text, vector, model)
+        return vector
+    except Exception as e:
+        print(f"⚠ Error generando embedding de la consulta: {e}")
+        return None
+
+
+def _persist_in_background(ctx, payload):
+    """BackgroundTask que encola la respuesta para Supabase después de enviarla."""
+    return BackgroundTask(run_blocking, persist_rag_answer, ctx["user_text"], payload, ctx["corpus_id"],
+                          ctx["session_id"], ctx["tenant"])
+
+
+async def _prepare(form, raw_form=None, headers=None):
+    """
+    Parte común de /chat y /chat/stream. Devuelve un dict con el contexto de
+    la petición RAG, o {"payload": ...} si ya hay respuesta sin llamar al LLM
+    ({"payload": ..., "status": 400} si el filtro o el tenant no son válidos).
+    """
+    headers = headers or {}
+    try:
+        tenant = parse_tenant(form, headers)
+    except ValueError as e:
+        return {"payload": {"response": str(e), "error": str(e)}, "status": 400}
+    if tenant:
+        # la vista de Flask no ve las cabeceras: el tenant va en el formulario
+        form = {**form, "tenant": tenant}
+    session_id = parse_session_id(form, headers)
+
+    user_text = form.get("message", "").strip()
+    if not user_text or is_trivial_message(user_text):
+        return {"payload": await run_blocking(_flask_chat, form)}
+
+    vector_db = await run_blocking(load_vector_db_if_needed, tenant)
+    if vector_db is None:
+        return {"payload": await run_blocking(_flask_chat, form)}
+
+    try:
+        # el formulario original conserva los `document` repetidos
+        search_filter = parse_search_filter(raw_form if raw_form is not None else form, vector_db)
+    except ValueError as e:
+        return {"payload": {"response": f"Filtro inválido: {e}", "error": str(e)}, "status": 400}
+    search_kwargs = ann_search_kwargs(form)
+    if search_filter:
+        search_kwargs["filter"] = search_filter
+
+    print(f"🔍 Consulta recibida (async): {user_text[:100]}...")
+    deadline = Deadline(RAG_TIMEOUT)
+    # stat() del manifest o apertura del store del tenant: fuera del event loop
+    corpus_id = await run_blocking(get_corpus_id, tenant)
+    namespace = cache_namespace(corpus_id, search_filter, tenant)
+    cache_key = make_key(user_text + "|" + namespace)
+    cached_response = await run_blocking(get_cached_response, cache_key)
+    if cached_response:
+        print(f"🚀 Respuesta desde cache para: {user_text[:50]}...")
+        return {"payload": cached_response}
+
+    is_clarify = is_clarify_request(user_text)
+    query_vector = await aembed_query(vector_db, user_text)
+    if not is_clarify:
+        semantic_response = await run_blocking(get_semantic_cached_response, namespace, query_vector)
+        if semantic_response:
+            print(f"🧠 Respuesta desde cache semántico ({semantic_response['similarity']}): {user_text[:50]}...")
+            return {"payload": semantic_response}
+
+    return {
+        "user_text": user_text,
+        "vector_db": vector_db,
+        "is_clarify": is_clarify,
+        "corpus_id": corpus_id,
+        "tenant": tenant,
+        "session_id": session_id,
+        "namespace": namespace,
+        "cache_key": cache_key,
+        "query_vector": query_vector,
+        "search_kwargs": search_kwargs,
+        "deadline": deadline,
+    }
+
+
+async def _answer(ctx, start_time):
+    """Búsqueda + LLM + cache. Devuelve (payload, guardar_en_supabase)."""
+    contexto, sources, derived_confidence = await run_blocking(
+        retrieve_rag_context, ctx["vector_db"], ctx["user_text"], ctx["is_clarify"],
+        ctx["query_vector"], ctx["search_kwargs"], ctx["deadline"])
+    try:
+        ai_response = await LLM.achat(build_rag_messages(contexto, ctx["user_text"], ctx["is_clarify"]),
+                                      deadline=ctx["deadline"])
+    except Exception as e:
+        print("⚠ Error en RAG (async):", e)
+        fallback = await run_blocking(get_cached_response, ctx["cache_key"])
+        if fallback is not None:
+            return fallback, False
+        if isinstance(e, LLMUnavailable):
+            return await run_blocking(cluster_response, ctx["user_text"]), False
+        return {"response": "Error: no se pudo conectar al servicio de IA. Intenta de nuevo más tarde.",
+                "error": str(e)}, False
+
+    payload = finalize_rag_answer(ai_response.choices[0].message.content, sources, derived_confidence,
+                                  ctx["user_text"], start_time, persist=False)
+    stored = await run_blocking(cache_payload, ctx["cache_key"], payload, ctx["namespace"],
+                                None if ctx["is_clarify"] else ctx["query_vector"])
+    return stored, True
+
+
+async def chat(request):
+    start_time = time.time()
+    raw_form = await request.form()
+    ctx = await _prepare(dict(raw_form), raw_form, request.headers)
+    if "payload" in ctx:
+        return JSONResponse(ctx["payload"], status_code=ctx.get("status", 200))
+
+    cache_key = ctx["cache_key"]
+    task = _inflight.get(cache_key)
+    leader = task is None
+    if leader:
+        task = asyncio.ensure_future(_answer(ctx, start_time))
+        _inflight[cache_key] = task
+        task.add_done_callback(lambda _: _inflight.pop(cache_key, None))
+    else:
+        print(f"🛬 Respuesta compartida de petición en vuelo: {ctx['user_text'][:50]}...")
+
+    try:
+        # shield: si este cliente se desconecta, la tarea sigue para los demás
+        payload, persist = await asyncio.shield(task)
+    except Exception as e:
+        print("⚠ Error en RAG (async):", e)
+        return JSONResponse({"response": get_respuesta_by_tipo("error_procesamiento"), "error": str(e)})
+
+    background = _persist_in_background(ctx, payload) if leader and persist else None
+    return JSONResponse(payload, background=background)
+
+
+async def chat_stream(request):
+    """Igual que /chat/stream de Flask, con el stream de OpenAI asíncrono."""
+    start_time = time.time()
+    raw_form = await request.form()
+    ctx = await _prepare(dict(raw_form), raw_form, request.headers)
+    if "status" in ctx:
+        return JSONResponse(ctx["payload"], status_code=ctx["status"])
+    if "payload" in ctx:
+        return StreamingResponse(iter([format_sse("done", ctx["payload"])]),
+                                 media_type="text/event-stream", headers=SSE_HEADERS)
+
+    async def generate():
+        try:
+            contexto, sources, derived_confidence = await run_blocking(
+                retrieve_rag_context, ctx["vector_db"], ctx["user_text"], ctx["is_clarify"],
+                ctx["query_vector"], ctx["search_kwargs"], ctx["deadline"])
+        except Exception as e:
+            print("⚠ Error en RAG (stream async):", e)
+            yield format_sse("error", {"response": get_respuesta_by_tipo("error_procesamiento"), "error": str(e)})
+            return
+
+        yield format_sse("sources", {"sources": sources, "confidence": derived_confidence})
+
+        respuesta_gpt = ""
+        sent_answer = ""
+        sent_lists = {}
+        try:
+            stream = await LLM.achat(build_rag_messages(contexto, ctx["user_text"], ctx["is_clarify"]),
+                                     deadline=ctx["deadline"], stream=True)
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content or ""
+                if not delta:
+                    continue
+                respuesta_gpt += delta
+
+                partial = parse_partial_json(respuesta_gpt)
+                answer = partial.get("answer")
+                if isinstance(answer, str) and len(answer) > len(sent_answer) and answer.startswith(sent_answer):
+                    yield format_sse("token", {"delta": answer[len(sent_answer):]})
+                    sent_answer = answer
+                for field in STREAMED_LIST_FIELDS:
+                    items = partial.get(field)
+                    if isinstance(items, list) and len(items) > len(sent_lists.get(field, [])):
+                        sent_lists[field] = items
+                        yield format_sse("partial", {field: items})
+        except Exception as e:
+            print("⚠ Error en RAG (stream async):", e)
+            fallback = await run_blocking(get_cached_response, ctx["cache_key"])
+            if fallback is not None:
+                yield format_sse("done", fallback)
+            elif isinstance(e, LLMUnavailable) and not respuesta_gpt:
+                yield format_sse("done", await run_blocking(cluster_response, ctx["user_text"]))
+            else:
+                yield format_sse("error", {"response": "Error: no se pudo conectar al servicio de IA. Intenta de nuevo más tarde.",
+                                           "error": str(e)})
+            return
+
+        payload = finalize_rag_answer(respuesta_gpt, sources, derived_confidence, ctx["user_text"],
+                                      start_time, persist=False)
+        stored = await run_blocking(cache_payload, ctx["cache_key"], payload, ctx["namespace"],
+                                    None if ctx["is_clarify"] else ctx["query_vector"])
+        yield format_sse("done", stored)
+        # la conexión ya recibió `done`; Supabase no retrasa al cliente
+        await run_blocking(persist_rag_answer, ctx["user_text"], payload, ctx["corpus_id"],
+                           ctx["session_id"], ctx["tenant"])
+
+    return StreamingResponse(generate(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+app = Starlette(routes=[
+    Route("/chat", chat, methods=["POST"]),
+    Route("/chat/stream", chat_stream, methods=["POST"]),
+    # Todo lo demás lo sirve la app Flask existente
+    Mount("/", app=WSGIMiddleware(main.app)),
+])
+
+# Para compatibilidad con servidores que buscan `application`
+application = app
+
+if __name__ == "__main__":
+    import uvicorn
+
+    port = int(os.environ.get("PORT", 5000))
+    print(f"🚀 Iniciando Alana Legal Sense (ASGI) en puerto {port}")
+    uvicorn.run(app, host="0.0.0.0", port=port)
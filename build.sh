@@ -22,6 +22,9 @@ else
     pip install -r requirements.txt
 fi
 
+# Descargar el vocabulario de tiktoken en el build: el conteo de tokens del prompt es local
+python -c "import tiktoken; tiktoken.get_encoding('o200k_base')" || echo "⚠ tiktoken no disponible: se estimarán los tokens"
+
 # Create necessary directories
 mkdir -p uploads
 mkdir -p vector_db
@@ -0,0 +1,268 @@
+# chatbot/ann.py
+# ==========================================================
+# 🧭 ÍNDICES ANN CONFIGURABLES (FLAT / IVF / IVF-PQ / HNSW)
+# FAISS.from_documents siempre crea un IndexFlatL2 (búsqueda exacta,
+# 6 KB por chunk de 1536 floats). Para corpus grandes cada segmento se
+# puede reconstruir con un índice aproximado:
+#   flat  → exacto, sin entrenamiento
+#   ivf   → IVF-Flat, entrena k-means (nlist listas) y busca `nprobe`
+#   ivfpq → IVF + Product Quantization, ~32× menos memoria
+#   hnsw  → grafo HNSW, sin entrenamiento, se ajusta con `efSearch`
+# Con "auto" el tipo depende del número de vectores del segmento.
+#
+# Informe de recall vs latencia contra el índice exacto:
+#   python -m chatbot.ann --vector-path vector_db --queries 200 --k 4
+# ==========================================================
+import argparse
+import math
+import time
+
+import numpy as np
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+INDEX_TYPES = ("flat", "ivf", "ivfpq", "hnsw")
+MIN_TRAIN_VECTORS = 1_000   # por debajo, cualquier índice aproximado se queda en flat
+IVF_MIN_VECTORS = 20_000    # "auto": desde aquí IVF-Flat
+IVFPQ_MIN_VECTORS = 500_000  # "auto": desde aquí IVF-PQ
+HNSW_M = 32
+EXACT_RANGE_MAX = 4_096      # con filtro, hasta estas posiciones se busca exacto (reconstruct_n + knn)
+HNSW_EF_MAX = 1_024
+HNSW_EF_CONSTRUCTION = 80
+PQ_BITS = 8
+
+
+def choose_index_type(n_vectors, configured="auto"):
+    """Tipo de índice para un segmento de `n_vectors` según la configuración."""
+    configured = (configured or "auto").lower()
+    if configured not in INDEX_TYPES and configured != "auto":
+        raise ValueError(f"Tipo de índice desconocido: {configured}")
+    if n_vectors < MIN_TRAIN_VECTORS:
+        return "flat"
+    if configured != "auto":
+        return configured
+    if n_vectors >= IVFPQ_MIN_VECTORS:
+        return "ivfpq"
+    if n_vectors >= IVF_MIN_VECTORS:
+        return "ivf"
+    return "flat"
+
+
+def index_type_of(index):
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return "ivfpq" if isinstance(faiss.downcast_index(ivf), faiss.IndexIVFPQ) else "ivf"
+    return "flat"
+
+
+def _nlist(n_vectors):
+    # ~4·√n listas, con al menos 39 puntos de entrenamiento por lista
+    return max(1, min(int(4 * math.sqrt(n_vectors)), n_vectors // 39))
+
+
+def _pq_subquantizers(dim):
+    for m in (64, 48, 32, 24, 16, 12, 8, 4, 2, 1):
+        if dim % m == 0:
+            return m
+    return 1
+
+
+def build_index(vectors, index_type="flat"):
+    """Crea, entrena y llena un índice FAISS L2 con `vectors` (n × d float32)."""
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    n, dim = vectors.shape
+    if index_type == "flat":
+        index = faiss.IndexFlatL2(dim)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, HNSW_M)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    elif index_type == "ivf":
+        index = faiss.IndexIVFFlat(faiss.IndexFlatL2(dim), dim, _nlist(n))
+    elif index_type == "ivfpq":
+        index = faiss.IndexIVFPQ(faiss.IndexFlatL2(dim), dim, _nlist(n), _pq_subquantizers(dim), PQ_BITS)
+    else:
+        raise ValueError(f"Tipo de índice desconocido: {index_type}")
+    if not index.is_trained:
+        index.train(vectors)
+    if n:
+        index.add(vectors)
+    return index
+
+
+def extract_vectors(index):
+    """Vectores guardados en un índice (aproximados si el índice es PQ)."""
+    if index.ntotal == 0:
+        return np.zeros((0, index.d), dtype="float32")
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+        ivf.make_direct_map()
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def read_index_mmap(path, index_type=None):
+    """
+    Lee un índice dejando los vectores en un mmap del archivo (compartido entre
+    workers por la caché de páginas). IVF mapea las listas invertidas; flat y
+    HNSW mapean el almacenamiento de códigos. Si no se puede, lectura normal.
+    """
+    if index_type in ("ivf", "ivfpq"):
+        flag = getattr(faiss, "IO_FLAG_MMAP", 0)
+    else:
+        flag = getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+    try:
+        return faiss.read_index(path, flag | faiss.IO_FLAG_READ_ONLY)
+    except RuntimeError:
+        return faiss.read_index(path)
+
+
+def id_selector(ranges):
+    """IDSelector de FAISS para las posiciones en `ranges` [(inicio, fin), ...]."""
+    if len(ranges) == 1:
+        return faiss.IDSelectorRange(*ranges[0])
+    ids = np.concatenate([np.arange(start, stop, dtype="int64") for start, stop in ranges])
+    return faiss.IDSelectorBatch(ids)
+
+
+def search_params(index, nprobe=None, ef_search=None, selector=None):
+    """SearchParameters por petición (no modifica el índice compartido entre hilos)."""
+    kind = index_type_of(index)
+    params = None
+    if kind in ("ivf", "ivfpq") and (nprobe or selector is not None):
+        params = faiss.SearchParametersIVF()
+        if nprobe:
+            params.nprobe = int(nprobe)
+    elif kind == "hnsw" and (ef_search or selector is not None):
+        params = faiss.SearchParametersHNSW()
+        if ef_search:
+            params.efSearch = int(ef_search)
+    elif selector is not None:
+        params = faiss.SearchParameters()
+    if selector is not None:
+        params.sel = selector
+    return params
+
+
+def search(index, queries, k, nprobe=None, ef_search=None, ranges=None):
+    """
+    Top-k de cada consulta. Con `ranges` solo compiten esas posiciones: un
+    índice flat, o una selección de hasta EXACT_RANGE_MAX posiciones, compara
+    solo contra los vectores de los rangos (coste del rango, no del índice).
+    En selecciones mayores IVF y HNSW usan un IDSelector, que solo filtra lo
+    que visitan: `nprobe`/`efSearch` crecen en proporción a lo poco que cubre
+    la selección para que sigan apareciendo k resultados.
+    """
+    queries = np.ascontiguousarray(np.atleast_2d(queries), dtype="float32")
+    selector = None
+    if ranges is not None:
+        kind = index_type_of(index)
+        size = sum(stop - start for start, stop in ranges)
+        if kind == "flat" or size <= EXACT_RANGE_MAX:
+            return _search_exact_ranges(index, queries, k, ranges)
+        selector = id_selector(ranges)
+        widen = index.ntotal / max(size, 1)
+        if kind in ("ivf", "ivfpq"):
+            nlist = faiss.extract_index_ivf(index).nlist
+            nprobe = min(nlist, math.ceil((nprobe or 1) * widen))
+        elif kind == "hnsw":
+            ef_search = min(HNSW_EF_MAX, max(k, math.ceil((ef_search or 16) * widen)))
+    params = search_params(index, nprobe=nprobe, ef_search=ef_search, selector=selector)
+    if params is None:
+        return index.search(queries, k)
+    return index.search(queries, k, params=params)
+
+
+def _search_exact_ranges(index, queries, k, ranges):
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+        # los segmentos lo arman al abrirse; esto solo ocurre con índices sueltos (recall_report, pruebas)
+        ivf.make_direct_map()
+    distances, ids = [], []
+    for start, stop in ranges:
+        found_d, found_i = faiss.knn(queries, index.reconstruct_n(start, stop - start), min(k, stop - start))
+        distances.append(found_d)
+        ids.append(np.where(found_i >= 0, found_i + start, -1))
+    distances, ids = np.hstack(distances), np.hstack(ids)
+    order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+    return np.take_along_axis(distances, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+
+def recall_report(vectors, k=4, n_queries=100, index_types=INDEX_TYPES,
+                  nprobes=(1, 8, 32), ef_searches=(16, 64, 128), seed=0):
+    """
+    Recall@k y latencia media por consulta de cada configuración frente a
+    IndexFlatL2. Las consultas son vectores del corpus con ruido pequeño.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(len(vectors), size=min(n_queries, len(vectors)), replace=False)
+    queries = vectors[picks] + rng.normal(0, 0.01, size=(len(picks), vectors.shape[1])).astype("float32")
+
+    exact = build_index(vectors, "flat")
+    _, truth = exact.search(queries, k)
+
+    rows = []
+    for index_type in index_types:
+        started = time.perf_counter()
+        try:
+            index = build_index(vectors, index_type)
+        except RuntimeError as e:
+            # p. ej. IVF-PQ necesita al menos 2^PQ_BITS puntos de entrenamiento
+            rows.append({"index": index_type, "error": str(e).strip().splitlines()[-1]})
+            continue
+        build_seconds = time.perf_counter() - started
+        if index_type in ("ivf", "ivfpq"):
+            settings = [{"nprobe": p} for p in nprobes]
+        elif index_type == "hnsw":
+            settings = [{"ef_search": e} for e in ef_searches]
+        else:
+            settings = [{}]
+        for setting in settings:
+            started = time.perf_counter()
+            _, found = search(index, queries, k, **setting)
+            latency_ms = (time.perf_counter() - started) * 1000 / len(queries)
+            hits = sum(len(set(t) & set(f)) for t, f in zip(truth, found))
+            rows.append({
+                "index": index_type,
+                **setting,
+                "recall": round(hits / (k * len(queries)), 4),
+                "latency_ms": round(latency_ms, 4),
+                "build_s": round(build_seconds, 2),
+            })
+    return rows
+
+
+def _load_corpus_vectors(vector_path):
+    from langchain_community.embeddings import FakeEmbeddings
+    from chatbot.segments import SegmentedVectorStore
+
+    store = SegmentedVectorStore(vector_path, FakeEmbeddings(size=1))
+    return np.vstack([extract_vectors(db.index) for db in store.segments()])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recall vs latencia de índices ANN frente a búsqueda exacta")
+    parser.add_argument("--vector-path", default="vector_db")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--types", default=",".join(INDEX_TYPES))
+    args = parser.parse_args(argv)
+
+    vectors = _load_corpus_vectors(args.vector_path)
+    print(f"📊 {len(vectors):,} vectores de dimensión {vectors.shape[1]}")
+    rows = recall_report(vectors, k=args.k, n_queries=args.queries, index_types=args.types.split(","))
+    for row in rows:
+        if "error" in row:
+            print(f"{row['index']:<6} ⚠ {row['error']}")
+            continue
+        knob = " ".join(f"{key}={row[key]}" for key in ("nprobe", "ef_search") if key in row)
+        print(f"{row['index']:<6} {knob:<14} recall@{args.k}={row['recall']:.3f}  "
+              f"{row['latency_ms']:.3f} ms/consulta  (construcción {row['build_s']}s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,364 @@
+# chatbot/cache_store.py
+# ==========================================================
+# 🗃 CACHE DE RESPUESTAS EN DISCO (LOG APPEND-ONLY POR SHARDS)
+# Cada shard es un archivo de log donde cada línea es un registro
+# JSON ({"k": key, "v": valor} o {"k": key, "d": 1}). En memoria se
+# mantiene un índice LRU (OrderedDict) y un heap de expiración, así
+# get/put son O(1) y nunca se reescribe el archivo completo salvo en
+# la compactación, que corre en segundo plano.
+# Los workers de gunicorn comparten los archivos: las escrituras se
+# serializan con flock y cada proceso lee solo lo que otros añadieron.
+# ==========================================================
+import heapq
+import json
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin bloqueo entre procesos
+    fcntl = None
+
+COMPACT_MIN_DEAD = 64  # registros obsoletos mínimos antes de compactar
+
+
+class _FileLock:
+    """Bloqueo exclusivo entre procesos basado en flock sobre un archivo .lock."""
+
+    def __init__(self, path):
+        self.path = path
+
+    @contextmanager
+    def exclusive(self):
+        fh = open(self.path, "a")
+        try:
+            if fcntl is not None:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+            fh.close()
+
+
+class _Shard:
+    """Un archivo de log con su índice LRU y su heap de expiración."""
+
+    def __init__(self, path, ttl, max_entries):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = _FileLock(path + ".lock")
+        self._mutex = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        self._entries = OrderedDict()
+        self._expiry = []  # heap de (expira_en, key)
+        self._inode = None
+        self._offset = 0
+        self._records = 0
+
+    def _expired(self, entry, now=None):
+        now = now if now is not None else time.time()
+        return now - entry.get("timestamp", now) > self.ttl
+
+    def _apply(self, record):
+        key = record.get("k")
+        if key is None:
+            return
+        if record.get("d"):
+            self._entries.pop(key, None)
+            return
+        value = record.get("v") or {}
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        heapq.heappush(self._expiry, (value.get("timestamp", 0) + self.ttl, key))
+
+    def _refresh(self):
+        """Aplica los registros que otros procesos añadieron desde la última lectura."""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            if self._inode is not None:
+                self._reset()
+            return
+        if st.st_ino == self._inode and st.st_size == self._offset:
+            return
+
+        with open(self.path, "rb") as fh:
+            fst = os.fstat(fh.fileno())
+            if fst.st_ino != self._inode or fst.st_size < self._offset:
+                # archivo nuevo o compactado por otro worker: releer desde cero
+                self._reset()
+                self._inode = fst.st_ino
+            fh.seek(self._offset)
+            data = fh.read()
+
+        end = data.rfind(b"\n")
+        if end == -1:
+            # solo hay una línea a medio escribir
+            return
+        for line in data[:end].split(b"\n"):
+            if not line.strip():
+                continue
+            try:
+                self._apply(json.loads(line))
+            except ValueError:
+                continue
+            self._records += 1
+        self._offset += end + 1
+
+    def _append(self, records):
+        payload = b"".join(
+            json.dumps(r, ensure_ascii=False).encode("utf-8") + b"\n" for r in records
+        )
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            view = memoryview(payload)
+            while view:
+                written = os.write(fd, view)
+                view = view[written:]
+        finally:
+            os.close(fd)
+
+    def _expired_victims(self, now):
+        victims = []
+        while self._expiry and self._expiry[0][0] < now:
+            expires_at, key = heapq.heappop(self._expiry)
+            entry = self._entries.get(key)
+            # el heap puede tener versiones viejas de la misma key
+            if entry is not None and entry.get("timestamp", 0) + self.ttl == expires_at:
+                victims.append(key)
+        return victims
+
+    def _lru_victims(self, skip):
+        excess = len(self._entries) - len(skip) - self.max_entries
+        victims = []
+        if excess <= 0:
+            return victims
+        for key in self._entries:
+            if key in skip:
+                continue
+            victims.append(key)
+            if len(victims) >= excess:
+                break
+        return victims
+
+    def get(self, key):
+        with self._mutex:
+            self._refresh()
+            entry = self._entries.get(key)
+            if entry is None or self._expired(entry):
+                # una entrada expirada se ignora; se borra en la siguiente escritura
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, value):
+        with self._mutex, self.lock.exclusive():
+            self._refresh()
+            self._append([{"k": key, "v": value}])
+            self._refresh()
+            expired = self._expired_victims(time.time())
+            victims = expired + self._lru_victims(set(expired))
+            if victims:
+                self._append([{"k": k, "d": 1} for k in victims])
+                self._refresh()
+            return len(victims)
+
+    def delete(self, key):
+        with self._mutex, self.lock.exclusive():
+            self._refresh()
+            if key not in self._entries:
+                return False
+            self._append([{"k": key, "d": 1}])
+            self._refresh()
+            return True
+
+    def evict_expired(self):
+        with self._mutex, self.lock.exclusive():
+            self._refresh()
+            victims = self._expired_victims(time.time())
+            if victims:
+                self._append([{"k": k, "d": 1} for k in victims])
+                self._refresh()
+            return len(victims)
+
+    def needs_compaction(self):
+        with self._mutex:
+            self._refresh()
+            dead = self._records - len(self._entries)
+            return dead > max(len(self._entries), COMPACT_MIN_DEAD)
+
+    def compact(self):
+        """Reescribe el log solo con las entradas vivas (reemplazo atómico)."""
+        with self._mutex, self.lock.exclusive():
+            self._refresh()
+            now = time.time()
+            live = [(k, v) for k, v in self._entries.items() if not self._expired(v, now)]
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "wb") as fh:
+                for key, value in live:
+                    fh.write(json.dumps({"k": key, "v": value}, ensure_ascii=False).encode("utf-8") + b"\n")
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.replace(tmp_path, self.path)
+            self._reset()
+            self._refresh()
+            return len(live)
+
+    def items(self):
+        with self._mutex:
+            self._refresh()
+            now = time.time()
+            return [(k, v) for k, v in self._entries.items() if not self._expired(v, now)]
+
+    def records_since(self, cursor):
+        """
+        Pares (key, valor) escritos en el log desde `cursor` ((inodo, offset) de
+        una llamada anterior, o None para leer todo) y el cursor nuevo. Lee solo
+        los bytes añadidos; si el log fue compactado o recreado empieza de cero.
+        No toca el índice del shard.
+        """
+        inode, offset = cursor or (None, 0)
+        try:
+            with open(self.path, "rb") as fh:
+                fst = os.fstat(fh.fileno())
+                if fst.st_ino != inode or fst.st_size < offset:
+                    offset = 0
+                fh.seek(offset)
+                data = fh.read()
+        except FileNotFoundError:
+            return [], None
+        end = data.rfind(b"\n")
+        records = []
+        for line in data[:end].split(b"\n") if end != -1 else ():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("k") is not None and not record.get("d"):
+                records.append((record["k"], record.get("v") or {}))
+        return records, (fst.st_ino, offset + end + 1)
+
+    def __len__(self):
+        with self._mutex:
+            self._refresh()
+            return len(self._entries)
+
+
+class CacheStore:
+    """
+    Cache clave→payload persistente, repartido en `shards` archivos de log.
+    El límite `max_entries` se reparte entre shards (LRU aproximado global).
+    """
+
+    def __init__(self, directory, ttl, max_entries, shards=4, compact_interval=300):
+        os.makedirs(directory, exist_ok=True)
+        per_shard = max(1, -(-max_entries // shards))
+        self.directory = str(directory)
+        self.compact_interval = compact_interval
+        self._shards = [
+            _Shard(os.path.join(self.directory, f"shard-{i}.log"), ttl, per_shard)
+            for i in range(shards)
+        ]
+        self._compactor = None
+
+    def _shard(self, key):
+        return self._shards[zlib.crc32(key.encode("utf-8")) % len(self._shards)]
+
+    def get(self, key, default=None):
+        entry = self._shard(key).get(key)
+        return entry if entry is not None else default
+
+    def put(self, key, value):
+        """Guarda el valor; devuelve cuántas entradas se desalojaron (TTL/LRU)."""
+        return self._shard(key).put(key, value)
+
+    def pop(self, key, default=None):
+        entry = self.get(key)
+        self._shard(key).delete(key)
+        return entry if entry is not None else default
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        entry = self.get(key)
+        if entry is None:
+            raise KeyError(key)
+        return entry
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def __len__(self):
+        return sum(len(s) for s in self._shards)
+
+    def items(self):
+        for shard in self._shards:
+            yield from shard.items()
+
+    def records_since(self, cursors=None):
+        """
+        Escrituras (key, valor) de todos los shards desde `cursors` (lista devuelta
+        por la llamada anterior, o None) y los cursores nuevos. Sirve para seguir
+        el cache compartido de forma incremental en lugar de recorrerlo entero.
+        """
+        cursors = cursors or [None] * len(self._shards)
+        records, updated = [], []
+        for shard, cursor in zip(self._shards, cursors):
+            shard_records, cursor = shard.records_since(cursor)
+            records.extend(shard_records)
+            updated.append(cursor)
+        return records, updated
+
+    def evict_expired(self):
+        return sum(s.evict_expired() for s in self._shards)
+
+    def compact_if_needed(self):
+        compacted = 0
+        for shard in self._shards:
+            if shard.needs_compaction():
+                shard.compact()
+                compacted += 1
+        return compacted
+
+    def start_compactor(self):
+        """Lanza (una sola vez) el hilo que compacta los shards periódicamente."""
+        if self._compactor is not None:
+            return
+
+        def _loop():
+            while True:
+                time.sleep(self.compact_interval)
+                try:
+                    compacted = self.compact_if_needed()
+                    if compacted:
+                        print(f"🧹 Cache compactado ({compacted} shard(s))")
+                except Exception as e:
+                    print(f"⚠ Error compactando cache: {e}")
+
+        self._compactor = threading.Thread(target=_loop, daemon=True)
+        self._compactor.start()
+
+    def import_legacy(self, path):
+        """Migra un qa_cache.json antiguo (dict completo) si el store está vacío."""
+        if len(self) > 0 or not os.path.exists(path):
+            return 0
+        try:
+            with open(path, "r", encoding="utf-8") as fh:
+                legacy = json.load(fh)
+        except Exception:
+            return 0
+        imported = 0
+        for key, value in legacy.items():
+            if isinstance(value, dict) and not self._shard(key)._expired(value):
+                self.put(key, value)
+                imported += 1
+        return imported
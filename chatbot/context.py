@@ -0,0 +1,169 @@
+# chatbot/context.py
+# ==========================================================
+# ✂️ ENSAMBLADO DEL CONTEXTO CON PRESUPUESTO DE TOKENS
+# Los chunks recuperados (hasta 1200 caracteres, k=6 en aclaraciones)
+# se pegaban enteros en el prompt. Aquí se cuentan los tokens en local
+# y, si el contexto no cabe en el presupuesto:
+#   1. se descartan chunks casi duplicados (Jaccard de tokens), no solo
+#      los idénticos (el md5 anterior)
+#   2. cada chunk se parte en oraciones y cada oración se puntúa contra
+#      el embedding de la pregunta (más un extra si comparte números o
+#      artículos con ella)
+#   3. se eligen las mejores oraciones hasta llenar el presupuesto y se
+#      devuelven en su orden original, marcando los saltos con […]
+# ==========================================================
+import re
+
+import numpy as np
+
+from chatbot.embeddings import estimate_tokens
+from chatbot.lexical import tokenize
+
+SECTION_SEPARATOR = "\n\n--- SECCIÓN ---\n"
+GAP_MARKER = "[…]"
+DUPLICATE_JACCARD = 0.8   # chunks/oraciones con más solapamiento de tokens se consideran repetidos
+LEXICAL_BONUS = 0.15      # extra por compartir números/artículos exactos con la pregunta
+MIN_SENTENCE_CHARS = 20
+
+# Oraciones: punto/punto y coma seguido de espacio y mayúscula, número o comilla; o salto de línea
+_SENTENCE_RE = re.compile(r"(?<=[.;:!?])\s+(?=[A-ZÁÉÍÓÚÑ0-9\"«(])|\n+")
+
+_encoder = None
+_encoder_checked = False
+
+
+def _get_encoder():
+    """tiktoken si el vocabulario está disponible en local; si no, None (estimación)."""
+    global _encoder, _encoder_checked
+    if not _encoder_checked:
+        _encoder_checked = True
+        try:
+            import tiktoken
+            _encoder = tiktoken.get_encoding("o200k_base")  # vocabulario de gpt-4o / gpt-4o-mini
+        except Exception as e:
+            print(f"⚠ tiktoken no disponible, se estiman los tokens: {e}")
+            _encoder = None
+    return _encoder
+
+
+def count_tokens(text):
+    encoder = _get_encoder()
+    if encoder is None:
+        return estimate_tokens(text)
+    return len(encoder.encode(text, disallowed_special=()))
+
+
+def split_sentences(text):
+    return [s.strip() for s in _SENTENCE_RE.split(text) if s and s.strip()]
+
+
+def _jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def drop_near_duplicates(texts, threshold=DUPLICATE_JACCARD):
+    """Índices de `texts` a conservar: el primero de cada grupo de casi duplicados."""
+    kept, kept_tokens = [], []
+    for i, text in enumerate(texts):
+        tokens = set(tokenize(text)) or {text.strip().lower()}
+        if any(_jaccard(tokens, other) >= threshold for other in kept_tokens):
+            continue
+        kept.append(i)
+        kept_tokens.append(tokens)
+    return kept
+
+
+def _cosine_scores(query_vector, vectors):
+    q = np.asarray(query_vector, dtype="float32")
+    m = np.asarray(vectors, dtype="float32")
+    norms = np.linalg.norm(m, axis=1) * (np.linalg.norm(q) or 1.0)
+    return (m @ q) / np.where(norms == 0, 1.0, norms)
+
+
+def _lexical_scores(query_text, sentences):
+    query_tokens = set(tokenize(query_text or ""))
+    scores = []
+    for sentence in sentences:
+        tokens = set(tokenize(sentence))
+        scores.append(len(tokens & query_tokens) / (len(query_tokens) or 1))
+    return np.asarray(scores, dtype="float32")
+
+
+def _exact_bonus(query_text, sentences):
+    """Extra para oraciones que repiten números o artículos citados en la pregunta."""
+    exact = {t for t in tokenize(query_text or "") if t[0].isdigit() or t.startswith("art_")}
+    if not exact:
+        return np.zeros(len(sentences), dtype="float32")
+    return np.asarray([LEXICAL_BONUS if exact & set(tokenize(s)) else 0.0 for s in sentences], dtype="float32")
+
+
+def compress(texts, query_text, budget, query_vector=None, embed=None, count=count_tokens):
+    """
+    Oraciones de `texts` (en orden de relevancia) que mejor responden a la
+    pregunta sin pasar de `budget` tokens. `embed(oraciones)` devuelve sus
+    vectores; si no hay embedding o falla, se puntúa por solapamiento léxico.
+    """
+    sentences, origin = [], []
+    for doc_index, text in enumerate(texts):
+        for position, sentence in enumerate(split_sentences(text)):
+            if len(sentence) >= MIN_SENTENCE_CHARS or any(c.isdigit() for c in sentence):
+                sentences.append(sentence)
+                origin.append((doc_index, position))
+    budget -= count(SECTION_SEPARATOR) * (len(texts) - 1)
+    keep = drop_near_duplicates(sentences)
+    sentences = [sentences[i] for i in keep]
+    origin = [origin[i] for i in keep]
+    if not sentences:
+        return []
+
+    scores = None
+    if embed is not None and query_vector is not None:
+        try:
+            scores = _cosine_scores(query_vector, embed(sentences))
+        except Exception as e:
+            print(f"⚠ Compresión sin embeddings (se usa puntuación léxica): {e}")
+    if scores is None:
+        scores = _lexical_scores(query_text, sentences)
+    scores = scores + _exact_bonus(query_text, sentences)
+
+    chosen, used = [], 0
+    for i in np.argsort(-scores, kind="stable"):
+        cost = count(sentences[i]) + 2
+        if used + cost > budget:
+            continue
+        chosen.append(int(i))
+        used += cost
+
+    # reconstruir cada sección en su orden original, marcando las partes omitidas
+    sections = {}
+    for i in sorted(chosen, key=lambda i: origin[i]):
+        sections.setdefault(origin[i][0], []).append((origin[i][1], sentences[i]))
+    result = []
+    for doc_index in sorted(sections):
+        parts, previous = [], None
+        for position, sentence in sections[doc_index]:
+            if previous is not None and position != previous + 1:
+                parts.append(GAP_MARKER)
+            parts.append(sentence)
+            previous = position
+        result.append(" ".join(parts))
+    return result
+
+
+def assemble_context(texts, query_text, budget, query_vector=None, embed=None, count=count_tokens):
+    """
+    Contexto para el prompt dentro de `budget` tokens. Devuelve (contexto, info)
+    con info = {"sections", "tokens", "compressed"}.
+    """
+    texts = [texts[i] for i in drop_near_duplicates(texts)]
+    contexto = SECTION_SEPARATOR.join(texts)
+    tokens = count(contexto)
+    if tokens <= budget:
+        return contexto, {"sections": len(texts), "tokens": tokens, "compressed": False}
+
+    sections = compress(texts, query_text, budget, query_vector=query_vector, embed=embed, count=count)
+    contexto = SECTION_SEPARATOR.join(sections)
+    return contexto, {"sections": len(sections), "tokens": count(contexto), "compressed": True,
+                      "original_tokens": tokens}
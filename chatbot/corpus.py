@@ -0,0 +1,99 @@
+# chatbot/corpus.py
+# ==========================================================
+# 🏷️ VERSIÓN DEL CORPUS
+# El corpus_id (parte de las keys del cache y columna corpus_id en
+# Supabase) sale de la sección "corpus" del manifest de la vector DB:
+#   {"generation": 7, "content_hash": "…"}
+# La ingesta la sube en la misma escritura atómica del manifest que
+# añade el segmento (ver chatbot/segments.py): generación +1 y hash
+# encadenado con el contenido del documento nuevo. Fusionar segmentos
+# no la cambia, así que el cache sobrevive a las fusiones.
+# Cada worker la tiene en memoria y solo hace un stat() del manifest
+# como mucho cada `check_interval` segundos para ver si otro la cambió.
+# ==========================================================
+import hashlib
+import json
+import os
+import threading
+import time
+
+EMPTY_CORPUS = {"generation": 0, "content_hash": hashlib.sha256(b"").hexdigest()}
+
+
+def chain_hash(previous_hash, content_hash):
+    """Hash del corpus tras añadir un documento con `content_hash`."""
+    return hashlib.sha256(f"{previous_hash}:{content_hash}".encode("utf-8")).hexdigest()
+
+
+def content_hash(texts):
+    digest = hashlib.sha256()
+    for text in texts:
+        digest.update(text.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def corpus_of(manifest):
+    """Sección "corpus" de un manifest; los manifest anteriores derivan una a partir de sus segmentos."""
+    corpus = manifest.get("corpus")
+    if corpus:
+        return corpus
+    names = sorted(entry["name"] for entry in manifest.get("segments", []))
+    if not names:
+        return dict(EMPTY_CORPUS)
+    return {"generation": 0, "content_hash": content_hash(names)}
+
+
+def format_corpus_id(corpus):
+    return f"g{corpus['generation']}-{corpus['content_hash'][:12]}"
+
+
+class CorpusVersion:
+    """Versión del corpus en memoria, revalidada con un stat() barato del manifest."""
+
+    def __init__(self, manifest_path, check_interval=1.0):
+        self.manifest_path = str(manifest_path)
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._corpus = dict(EMPTY_CORPUS)
+        self._stat = None
+        self._checked_at = None
+
+    def _stat_key(self):
+        try:
+            st = os.stat(self.manifest_path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def current(self):
+        """{"generation", "content_hash"} vigentes."""
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.check_interval:
+            return self._corpus
+        with self._lock:
+            self._checked_at = now
+            stat_key = self._stat_key()
+            if stat_key is not None and stat_key == self._stat:
+                return self._corpus
+            if stat_key is None:
+                self._corpus = dict(EMPTY_CORPUS)
+            else:
+                try:
+                    with open(self.manifest_path, "r", encoding="utf-8") as fh:
+                        self._corpus = corpus_of(json.load(fh))
+                except (OSError, ValueError) as e:
+                    print(f"⚠ No se pudo leer la versión del corpus: {e}")
+                    return self._corpus
+            self._stat = stat_key
+            return self._corpus
+
+    def update(self, corpus):
+        """El worker que escribió el manifest publica la versión nueva sin esperar al stat()."""
+        with self._lock:
+            self._corpus = dict(corpus)
+            self._stat = self._stat_key()
+            self._checked_at = time.monotonic()
+
+    def id(self):
+        return format_corpus_id(self.current())
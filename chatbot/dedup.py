@@ -0,0 +1,287 @@
+# chatbot/dedup.py
+# ==========================================================
+# 🪞 CHUNKS DUPLICADOS Y CASI DUPLICADOS (MINHASH + LSH)
+# Los corpus legales repiten mucho texto: encabezados notariales,
+# cláusulas estándar, firmas. Antes cada copia se embebía y ocupaba
+# un hueco del top-k. En la ingesta:
+#   - cada chunk se identifica por el hash de su texto normalizado
+#     (`dedup_key`: minúsculas, sin puntuación ni espacios de más); una
+#     copia con la misma clave es un duplicado exacto
+#   - opcionalmente (umbral < 1) se buscan también casi duplicados: cada
+#     chunk se resume en una firma MinHash de sus 3-gramas de tokens (los
+#     de chatbot/lexical.py) y un índice LSH por bandas propone candidatos
+#     entre los chunks ya vistos (del mismo documento y de los segmentos
+#     del corpus). La firma lleva al final un hash de los números, nombres
+#     propios y meses del texto: dos cláusulas que solo cambian la
+#     matrícula, el monto, la fecha o las partes nunca se colapsan
+#   - el duplicado no se embebe: se guarda como referencia (fuente,
+#     página) del chunk canónico, identificado por su `dedup_key`
+# Cada segmento guarda las firmas de sus chunks (minhash.npz) y las
+# referencias que recogió (refs.jsonl); las búsquedas las añaden a
+# metadata["references"] de los resultados (ver chatbot/segments.py).
+# ==========================================================
+import hashlib
+import json
+import os
+import re
+
+import numpy as np
+
+from chatbot.lexical import tokenize
+from chatbot.query_cache import normalize_query
+
+NUM_PERM = 64
+BANDS = 16                 # 16 bandas de 4 filas: con J=0.85 se es candidato con prob. >0.9999
+SHINGLE_SIZE = 3
+DEFAULT_THRESHOLD = 1.0    # 1 = solo duplicados exactos (texto normalizado); < 1 = Jaccard estimada mínima
+FACT_WORDS = 2             # uint32 al final de la firma con el hash de números y nombres propios
+SIGNATURES_FILE = "minhash.npz"
+REFERENCES_FILE = "refs.jsonl"
+
+_MERSENNE = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64(0xFFFFFFFF)
+
+
+_NUMBER_RE = re.compile(r"\d[\d.,/\-]*")
+_WORD_RE = re.compile(r"[^\W\d_]+")
+_MONTHS = {"enero", "febrero", "marzo", "abril", "mayo", "junio", "julio", "agosto",
+           "septiembre", "setiembre", "octubre", "noviembre", "diciembre"}
+
+
+def dedup_key(text):
+    """Identificador estable del chunk canónico (sobrevive a las fusiones de segmentos)."""
+    return hashlib.sha1(normalize_query(text).encode("utf-8")).hexdigest()
+
+
+def facts(text):
+    """
+    Números, nombres propios (palabras con mayúscula que no abren oración) y
+    meses: lo que distingue dos variantes de la misma cláusula.
+    """
+    found = {re.sub(r"[.,/\-]", "", m.group()) for m in _NUMBER_RE.finditer(text)}
+    for m in _WORD_RE.finditer(text):
+        word = m.group()
+        before = text[:m.start()].rstrip()
+        if word[0].isupper() and before and before[-1] not in ".;:!?\n":
+            found.add(word.lower())
+        elif word.lower() in _MONTHS:
+            found.add(word.lower())
+    return found
+
+
+def facts_digest(text):
+    """uint32[FACT_WORDS] con el hash de `facts(text)`; nunca es todo ceros (ceros = desconocido)."""
+    digest = hashlib.blake2b("|".join(sorted(facts(text))).encode("utf-8"), digest_size=4 * FACT_WORDS).digest()
+    words = np.frombuffer(digest, dtype=np.uint32).copy()
+    words[0] |= np.uint32(1)
+    return words
+
+
+def shingles(text, size=SHINGLE_SIZE):
+    tokens = tokenize(text)
+    if len(tokens) < size:
+        return set(tokens)
+    return {" ".join(tokens[i:i + size]) for i in range(len(tokens) - size + 1)}
+
+
+class MinHasher:
+    """Firmas MinHash deterministas (mismas permutaciones en todos los procesos)."""
+
+    def __init__(self, num_perm=NUM_PERM, seed=1):
+        rng = np.random.RandomState(seed)
+        self.num_perm = num_perm
+        self._a = rng.randint(1, 1 << 32, size=num_perm, dtype=np.uint64)
+        self._b = rng.randint(0, 1 << 32, size=num_perm, dtype=np.uint64)
+
+    def signature(self, text):
+        """uint32[num_perm], o None si el texto no tiene tokens."""
+        items = shingles(text)
+        if not items:
+            return None
+        hashes = np.fromiter(
+            (int.from_bytes(hashlib.blake2b(item.encode("utf-8"), digest_size=4).digest(), "little")
+             for item in items), dtype=np.uint64, count=len(items))
+        # (a·h + b) mod p, truncado a 32 bits; el desbordamiento de uint64 es parte del hash
+        with np.errstate(over="ignore"):
+            permuted = (np.outer(hashes, self._a) + self._b) % _MERSENNE & _MAX_HASH
+        return permuted.min(axis=0).astype(np.uint32)
+
+
+def similarity(a, b):
+    """Jaccard estimada entre dos firmas."""
+    return float(np.mean(a == b))
+
+
+class LSHIndex:
+    """
+    Índice por bandas: dos firmas que coinciden en una banda entera son candidatas.
+    Las firmas pueden llevar detrás de las `num_perm` filas el hash de sus datos
+    (ver `facts_digest`); un candidato solo vale si esos datos coinciden.
+    """
+
+    def __init__(self, num_perm=NUM_PERM, bands=BANDS):
+        self.num_perm = num_perm
+        self.rows = num_perm // bands
+        self.bands = bands
+        self._buckets = [{} for _ in range(bands)]
+        self._signatures = {}
+
+    def __len__(self):
+        return len(self._signatures)
+
+    def __contains__(self, key):
+        return key in self._signatures
+
+    def _band_keys(self, signature):
+        for band in range(self.bands):
+            yield band, signature[band * self.rows:(band + 1) * self.rows].tobytes()
+
+    def insert(self, key, signature):
+        if key in self._signatures:
+            return
+        self._signatures[key] = signature
+        for band, bucket in self._band_keys(signature):
+            self._buckets[band].setdefault(bucket, []).append(key)
+
+    def _same_facts(self, a, b):
+        # firmas anteriores a los datos (sin columnas o en ceros) nunca se colapsan
+        a, b = a[self.num_perm:], b[self.num_perm:]
+        return len(a) > 0 and a.any() and np.array_equal(a, b)
+
+    def best_match(self, signature, threshold):
+        """(clave, similitud) del candidato más parecido por encima de `threshold`, o None."""
+        candidates = set()
+        for band, bucket in self._band_keys(signature):
+            candidates.update(self._buckets[band].get(bucket, ()))
+        best = None
+        for key in candidates:
+            stored = self._signatures[key]
+            if not self._same_facts(signature, stored):
+                continue
+            score = similarity(signature[:self.num_perm], stored[:self.num_perm])
+            if score >= threshold and (best is None or score > best[1]):
+                best = (key, score)
+        return best
+
+
+def reference_of(metadata):
+    return {"source": metadata.get("source"), "page": metadata.get("page"), "chunk_id": metadata.get("chunk_id")}
+
+
+class ChunkDeduplicator:
+    """
+    Filtro de ingesta: deja pasar solo los chunks canónicos y acumula
+    `signatures` {dedup_key: firma} de los nuevos y `references`
+    {dedup_key canónica: [referencia, ...]} de los duplicados. Con
+    `threshold` >= 1 solo colapsa duplicados exactos (mismo texto
+    normalizado); por debajo, también casi duplicados con los mismos datos.
+    """
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD, hasher=None, existing=()):
+        self.threshold = threshold
+        self.hasher = hasher or MinHasher()
+        self.lsh = LSHIndex(self.hasher.num_perm)
+        for keys, signatures in existing:
+            for key, signature in zip(keys, signatures):
+                self.lsh.insert(str(key), signature)
+        self.signatures = {}
+        self.references = {}
+        self.collapsed = 0
+
+    def _canonical(self, key, signature):
+        if key in self.lsh:
+            return key
+        if signature is None or self.threshold >= 1:
+            return None
+        match = self.lsh.best_match(signature, self.threshold)
+        return match[0] if match is not None else None
+
+    def filter(self, chunks):
+        for chunk in chunks:
+            key = dedup_key(chunk.page_content)
+            chunk.metadata["dedup_key"] = key
+            signature = self.hasher.signature(chunk.page_content)
+            if signature is not None:
+                signature = np.concatenate([signature, facts_digest(chunk.page_content)])
+            canonical = self._canonical(key, signature)
+            if canonical is not None:
+                self.references.setdefault(canonical, []).append(reference_of(chunk.metadata))
+                self.collapsed += 1
+                continue
+            if signature is not None:
+                self.lsh.insert(key, signature)
+                self.signatures[key] = signature
+            yield chunk
+
+
+# ---------- persistencia en el segmento ----------
+def write_signatures(directory, signatures):
+    """`signatures` {dedup_key: firma}; sin firmas no se escribe nada."""
+    if not signatures:
+        return
+    keys = np.asarray(list(signatures), dtype="U40")
+    # una fusión puede juntar firmas sin datos (segmentos anteriores): se completan con ceros
+    width = max(len(row) for row in signatures.values())
+    rows = [np.pad(np.asarray(row, dtype=np.uint32), (0, width - len(row))) for row in signatures.values()]
+    np.savez(os.path.join(directory, SIGNATURES_FILE), keys=keys, signatures=np.vstack(rows))
+
+
+def read_signatures(directory):
+    """(claves, firmas) de un segmento; vacíos si el segmento es anterior a la deduplicación."""
+    path = os.path.join(directory, SIGNATURES_FILE)
+    if not os.path.exists(path):
+        return np.empty(0, dtype="U40"), np.empty((0, NUM_PERM), dtype=np.uint32)
+    with np.load(path) as data:
+        return data["keys"], data["signatures"]
+
+
+def write_references(directory, references):
+    if not references:
+        return
+    with open(os.path.join(directory, REFERENCES_FILE), "w", encoding="utf-8") as fh:
+        for key, refs in references.items():
+            for ref in refs:
+                fh.write(json.dumps({"key": key, **ref}, ensure_ascii=False, default=str) + "\n")
+
+
+def read_references(directory):
+    """{dedup_key: [referencia, ...]} guardadas en un segmento."""
+    references = {}
+    try:
+        with open(os.path.join(directory, REFERENCES_FILE), "r", encoding="utf-8") as fh:
+            for line in fh:
+                entry = json.loads(line)
+                references.setdefault(entry.pop("key"), []).append(entry)
+    except FileNotFoundError:
+        pass
+    return references
+
+
+# ---------- diversidad en la recuperación ----------
+def mmr(relevance, vectors, k, lambda_mult=0.7):
+    """
+    Maximal marginal relevance: índices de hasta `k` candidatos que equilibran
+    `relevance` (mayor es mejor) con la distancia a los ya elegidos. `vectors`
+    puede tener filas None (sin vector): esas solo compiten por relevancia.
+    """
+    n = len(relevance)
+    if n <= 1:
+        return list(range(n))
+    dim = next((len(v) for v in vectors if v is not None), 0)
+    if not dim:
+        return list(range(min(k, n)))
+    matrix = np.zeros((n, dim), dtype="float32")
+    for i, vector in enumerate(vectors):
+        if vector is not None:
+            norm = np.linalg.norm(vector)
+            matrix[i] = vector / norm if norm else vector
+    relevance = np.asarray(relevance, dtype="float32")
+    chosen = [int(np.argmax(relevance))]
+    max_similarity = matrix @ matrix[chosen[0]]
+    while len(chosen) < min(k, n):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * max_similarity
+        scores[chosen] = -np.inf
+        best = int(np.argmax(scores))
+        chosen.append(best)
+        max_similarity = np.maximum(max_similarity, matrix @ matrix[best])
+    return chosen
@@ -0,0 +1,72 @@
+# chatbot/docstore.py
+# ==========================================================
+# 📚 DOCSTORE EN DISCO INDEXADO POR POSICIÓN (SIN PICKLE)
+# Reemplaza el index.pkl de LangChain dentro de cada segmento:
+#   docs.jsonl        → un chunk por línea (id, page_content, metadata)
+#   docs.offsets.npy  → uint64 con el byte de inicio de cada línea (+ fin)
+# Los offsets se abren con mmap y cada chunk se lee bajo demanda con
+# pread, así cargar un segmento no lee ni deserializa todo el texto y
+# la caché de páginas del SO se comparte entre workers.
+# ==========================================================
+import json
+import os
+
+import numpy as np
+from langchain_core.documents import Document
+
+DOCS_FILE = "docs.jsonl"
+OFFSETS_FILE = "docs.offsets.npy"
+
+
+def write_docstore(directory, documents):
+    """Escribe `documents` (en el orden de las posiciones del índice FAISS)."""
+    os.makedirs(directory, exist_ok=True)
+    offsets = [0]
+    with open(os.path.join(directory, DOCS_FILE), "wb") as fh:
+        for doc in documents:
+            line = json.dumps({
+                "id": getattr(doc, "id", None),
+                "page_content": doc.page_content,
+                "metadata": doc.metadata,
+            }, ensure_ascii=False, default=str).encode("utf-8") + b"\n"
+            fh.write(line)
+            offsets.append(offsets[-1] + len(line))
+        fh.flush()
+        os.fsync(fh.fileno())
+    np.save(os.path.join(directory, OFFSETS_FILE), np.asarray(offsets, dtype="uint64"))
+
+
+def has_docstore(directory):
+    return os.path.exists(os.path.join(directory, OFFSETS_FILE))
+
+
+class OffsetDocstore:
+    """Lectura perezosa de chunks por posición."""
+
+    def __init__(self, directory):
+        self._offsets = np.load(os.path.join(directory, OFFSETS_FILE), mmap_mode="r")
+        self._fd = os.open(os.path.join(directory, DOCS_FILE), os.O_RDONLY)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def get(self, position):
+        start, end = int(self._offsets[position]), int(self._offsets[position + 1])
+        record = json.loads(os.pread(self._fd, end - start, start))
+        return Document(id=record.get("id"), page_content=record["page_content"],
+                        metadata=record.get("metadata") or {})
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self.get(position)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
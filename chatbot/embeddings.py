@@ -0,0 +1,261 @@
+# chatbot/embeddings.py
+# ==========================================================
+# 🔢 SERVICIO DE EMBEDDINGS POR LOTES CON CACHE POR CONTENIDO
+# Agrupa los chunks en lotes según un presupuesto de tokens, envía
+# varios lotes en paralelo (con límite) y reintenta con backoff
+# exponencial ante rate limits o fallos transitorios.
+# Cada vector calculado se guarda en disco bajo sha256(texto): un
+# archivo float32 de solo-añadir (leído con np.memmap) más un índice
+# de hashes, una línea por fila. Los chunks repetidos entre documentos
+# (cláusulas tipo, re-subidas del mismo contrato) no vuelven a la API.
+# ==========================================================
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin bloqueo entre procesos
+    fcntl = None
+
+try:
+    from openai import APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+    RETRYABLE_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+except ImportError:
+    RETRYABLE_ERRORS = ()
+
+MAX_INPUTS_PER_REQUEST = 2048  # límite de la API de embeddings
+CHARS_PER_TOKEN = 3  # estimación conservadora para texto en español
+
+
+def estimate_tokens(text):
+    """Estimación barata de tokens (sin descargar el vocabulario de tiktoken)."""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def make_batches(texts, token_budget, max_inputs=MAX_INPUTS_PER_REQUEST):
+    """Parte `texts` en lotes cuyo total estimado de tokens no supera `token_budget`."""
+    batches, current, used = [], [], 0
+    for text in texts:
+        tokens = estimate_tokens(text)
+        if current and (used + tokens > token_budget or len(current) >= max_inputs):
+            batches.append(current)
+            current, used = [], 0
+        current.append(text)
+        used += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+class EmbeddingStore:
+    """
+    Cache persistente sha256(texto) → vector.
+    `vectors.f32` guarda las filas float32 seguidas; `index.txt` guarda el
+    hash de cada fila en el mismo orden. Varios procesos pueden añadir
+    filas: las escrituras se serializan con flock y cada proceso relee
+    solo las líneas nuevas del índice.
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = str(directory)
+        self._vectors_path = os.path.join(self.directory, "vectors.f32")
+        self._index_path = os.path.join(self.directory, "index.txt")
+        self._meta_path = os.path.join(self.directory, "meta.json")
+        self._lock_path = os.path.join(self.directory, "store.lock")
+        self._mutex = threading.RLock()
+        self._rows = {}  # hash -> fila
+        self._count = 0  # filas leídas del índice
+        self._offset = 0
+        self._mmap = None
+        self.dim = self._read_dim()
+
+    def _read_dim(self):
+        try:
+            with open(self._meta_path, "r", encoding="utf-8") as fh:
+                return int(json.load(fh)["dim"])
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+    @contextmanager
+    def _exclusive(self):
+        fh = open(self._lock_path, "a")
+        try:
+            if fcntl is not None:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+            fh.close()
+
+    def _refresh(self):
+        """Lee las filas que otros procesos añadieron desde la última vez."""
+        if self.dim is None:
+            self.dim = self._read_dim()
+            if self.dim is None:
+                return
+        try:
+            with open(self._index_path, "rb") as fh:
+                fh.seek(self._offset)
+                data = fh.read()
+        except FileNotFoundError:
+            return
+        end = data.rfind(b"\n")
+        if end == -1:
+            return
+        for line in data[:end].split(b"\n"):
+            self._rows.setdefault(line.decode("ascii").strip(), self._count)
+            self._count += 1
+        self._offset += end + 1
+        self._mmap = None  # el archivo creció: volver a mapear al leer
+
+    def _vectors(self):
+        if self._mmap is None or len(self._mmap) < self._count:
+            rows = self._count
+            self._mmap = np.memmap(self._vectors_path, dtype="float32", mode="r",
+                                   shape=(rows, self.dim)) if rows else np.zeros((0, self.dim or 0), "float32")
+        return self._mmap
+
+    def get_many(self, hashes):
+        """Devuelve {hash: vector} para los hashes presentes en el cache."""
+        with self._mutex:
+            self._refresh()
+            found = [(h, self._rows[h]) for h in hashes if h in self._rows]
+            if not found:
+                return {}
+            vectors = self._vectors()
+            return {h: np.array(vectors[row]) for h, row in found}
+
+    def put_many(self, items):
+        """Añade pares (hash, vector) que aún no estén guardados."""
+        if not items:
+            return 0
+        with self._mutex, self._exclusive():
+            self._refresh()
+            if self.dim is None:
+                self.dim = len(items[0][1])
+                with open(self._meta_path, "w", encoding="utf-8") as fh:
+                    json.dump({"dim": self.dim}, fh)
+            fresh, seen = [], set()
+            for h, vector in items:
+                if h in self._rows or h in seen or len(vector) != self.dim:
+                    continue
+                seen.add(h)
+                fresh.append((h, vector))
+            if not fresh:
+                return 0
+            # primero los vectores y luego el índice: una fila sin hash se ignora
+            block = np.asarray([v for _, v in fresh], dtype="float32")
+            with open(self._vectors_path, "ab") as fh:
+                fh.truncate(self._count * self.dim * 4)  # descarta restos de una escritura cortada
+                fh.write(block.tobytes())
+            with open(self._index_path, "ab") as fh:
+                fh.write("".join(f"{h}\n" for h, _ in fresh).encode("ascii"))
+            self._refresh()
+            return len(fresh)
+
+    def __len__(self):
+        with self._mutex:
+            self._refresh()
+            return len(self._rows)
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings de LangChain sobre el cliente de OpenAI, con lotes por
+    presupuesto de tokens, `max_workers` lotes en paralelo y cache en disco.
+    `client` debe crearse sin reintentos propios: el backoff se hace aquí.
+    """
+
+    def __init__(self, client, cache_dir, model="text-embedding-ada-002",
+                 token_budget=100_000, max_workers=4, max_retries=5,
+                 backoff_base=1.0, backoff_max=30.0):
+        self.client = client
+        self.model = model
+        self.token_budget = token_budget
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.store = EmbeddingStore(os.path.join(str(cache_dir), model))
+        self.cache_hits = 0
+        self.api_texts = 0
+        self.api_calls = 0
+
+    def _retry_delay(self, attempt, error):
+        retry_after = None
+        response = getattr(error, "response", None)
+        if response is not None:
+            try:
+                retry_after = float(response.headers.get("retry-after"))
+            except (TypeError, ValueError):
+                retry_after = None
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        delay = min(self.backoff_base * (2 ** attempt), self.backoff_max)
+        return delay * random.uniform(0.5, 1.0)  # jitter para no sincronizar los hilos
+
+    def _embed_batch(self, texts):
+        attempt = 0
+        while True:
+            try:
+                response = self.client.embeddings.create(model=self.model, input=texts)
+                self.api_calls += 1
+                return [item.embedding for item in sorted(response.data, key=lambda d: d.index)]
+            except RETRYABLE_ERRORS as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._retry_delay(attempt, e)
+                print(f"⏳ Embeddings: {type(e).__name__}, reintento en {delay:.1f}s")
+                time.sleep(delay)
+                attempt += 1
+
+    def embed_documents(self, texts):
+        texts = list(texts)
+        hashes = [text_hash(t) for t in texts]
+        cached = self.store.get_many(set(hashes))
+
+        missing = {}
+        for h, text in zip(hashes, texts):
+            if h not in cached and h not in missing:
+                missing[h] = text
+        self.cache_hits += len(texts) - sum(1 for h in hashes if h not in cached)
+
+        if missing:
+            pending = list(missing.items())
+            batches = make_batches([t for _, t in pending], self.token_budget)
+            workers = max(1, min(self.max_workers, len(batches)))
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(self._embed_batch, batches))
+            vectors = [v for batch in results for v in batch]
+            fresh = [(h, v) for (h, _), v in zip(pending, vectors)]
+            self.api_texts += len(fresh)
+            self.store.put_many(fresh)
+            cached.update({h: np.asarray(v, dtype="float32") for h, v in fresh})
+
+        return [cached[h].tolist() for h in hashes]
+
+    def embed_query(self, text):
+        return self._embed_batch([text])[0]
+
+    def stats(self):
+        return {
+            "cached_vectors": len(self.store),
+            "cache_hits": self.cache_hits,
+            "api_texts": self.api_texts,
+            "api_calls": self.api_calls,
+        }
@@ -0,0 +1,124 @@
+# chatbot/history.py
+# ==========================================================
+# 🕘 SERVICIO DE HISTORIAL
+# /history pedía `select("*")` ordenado por fecha en cada carga y traía
+# respuestas, fuentes y evidencias completas para luego descartarlas.
+# Aquí:
+#   - solo se piden las columnas que usa la interfaz
+#   - paginación por cursor (keyset) sobre (created_at, id): cada página
+#     usa el índice de created_at en vez de un OFFSET cada vez más caro
+#   - filtros opcionales por session_id, corpus_id y tenant_id, todos
+#     indexados; sin tenant se filtra por tenant_id NULL solo cuando hay
+#     tenants en uso (`tenants_in_use()`): una base sin esa columna sigue
+#     sirviendo el historial del corpus global
+#   - cache en memoria de pocas páginas con TTL corto, que se invalida
+#     cuando la cola write-behind escribe conversaciones nuevas
+# ==========================================================
+import base64
+import json
+import threading
+import time
+from collections import OrderedDict
+
+HISTORY_FIELDS = "id,user_question,bot_response,confidence,created_at,cross_references"
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(row):
+    raw = json.dumps([row["created_at"], row["id"]], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, row_id = json.loads(raw)
+    except Exception as e:
+        raise InvalidCursor("cursor inválido") from e
+    if not isinstance(created_at, str) or not isinstance(row_id, str):
+        raise InvalidCursor("cursor inválido")
+    return created_at, row_id
+
+
+def _quote(value):
+    # valores entre comillas dobles: las fechas ISO llevan ':' '.' y '+'
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+class HistoryService:
+    """Páginas del historial de conversaciones con cache de lectura de TTL corto."""
+
+    def __init__(self, get_client, table="conversations", ttl=10.0, max_pages=64, tenants_in_use=None):
+        self.get_client = get_client
+        self.tenants_in_use = tenants_in_use or (lambda: False)
+        self.table = table
+        self.ttl = ttl
+        self.max_pages = max_pages
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self):
+        """Descarta las páginas cacheadas (hay conversaciones nuevas)."""
+        with self._lock:
+            self._generation += 1
+            self._pages.clear()
+
+    def _query(self, client, limit, cursor, session_id, corpus_id, tenant_id=None):
+        query = client.table(self.table).select(HISTORY_FIELDS)
+        if session_id:
+            query = query.eq("session_id", session_id)
+        if corpus_id:
+            query = query.eq("corpus_id", corpus_id)
+        if tenant_id:
+            query = query.eq("tenant_id", tenant_id)
+        elif self.tenants_in_use():
+            # el historial global no ve conversaciones de ningún tenant
+            query = query.is_("tenant_id", "null")
+        if cursor:
+            created_at, row_id = decode_cursor(cursor)
+            query = query.or_(f"created_at.lt.{_quote(created_at)},"
+                              f"and(created_at.eq.{_quote(created_at)},id.lt.{_quote(row_id)})")
+        # una fila de más indica si hay página siguiente
+        return query.order("created_at", desc=True).order("id", desc=True).limit(limit + 1).execute().data
+
+    def page(self, limit=20, cursor=None, session_id=None, corpus_id=None, tenant_id=None):
+        """{"items": [...], "next_cursor": str | None}. Lanza InvalidCursor si el cursor no es válido."""
+        if cursor:
+            decode_cursor(cursor)
+        key = (limit, cursor, session_id, corpus_id, tenant_id)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._pages.get(key)
+            if cached is not None and cached[0] > now:
+                self._pages.move_to_end(key)
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+            generation = self._generation
+
+        client = self.get_client()
+        if not client:
+            return {"items": [], "next_cursor": None}
+        rows = self._query(client, limit, cursor, session_id, corpus_id, tenant_id) or []
+        items = rows[:limit]
+        result = {"items": items,
+                  "next_cursor": encode_cursor(items[-1]) if len(rows) > limit and items else None}
+
+        with self._lock:
+            # si hubo escrituras mientras se consultaba, la página puede estar vieja: no cachearla
+            if generation == self._generation:
+                self._pages[key] = (time.monotonic() + self.ttl, result)
+                self._pages.move_to_end(key)
+                while len(self._pages) > self.max_pages:
+                    self._pages.popitem(last=False)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {"pages": len(self._pages), "hits": self.hits, "misses": self.misses, "ttl": self.ttl}
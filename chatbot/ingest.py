@@ -0,0 +1,211 @@
+# chatbot/ingest.py
+# ==========================================================
+# 🚰 INGESTA EN STREAMING
+# loader.load() traía todas las páginas a memoria antes de partir nada
+# y los embeddings empezaban solo al final. Ahora todo es un pipeline
+# de generadores:
+#   páginas → chunks → lotes de embeddings → índice FAISS
+#   - PDF: las páginas se extraen por rangos en un pool de procesos
+#     (spawn), con pocos rangos en vuelo a la vez; los PDF pequeños se
+#     leen página a página en el mismo proceso
+#   - DOCX: word/document.xml se recorre con iterparse, por bloques de
+#     párrafos; TXT: por bloques de líneas
+#   - cada lote de chunks se embebe en un hilo mientras se sigue
+#     parseando el siguiente
+# La memoria de parseo queda acotada por el lote, no por el documento.
+# ==========================================================
+import multiprocessing
+import os
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+from xml.etree.ElementTree import iterparse
+
+PAGES_PER_TASK = 8          # páginas de PDF por tarea del pool
+PARALLEL_MIN_PAGES = 24     # por debajo, el pool cuesta más de lo que ahorra
+BLOCK_CHARS = 4000          # tamaño de los bloques de DOCX/TXT
+EST_CHARS_PER_PDF_PAGE = 2000
+DOCX_XML_OVERHEAD = 6       # bytes de XML por carácter de texto (aprox.)
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+
+def chunk_params(total_chars):
+    """(chunk_size, chunk_overlap) según el tamaño del documento."""
+    if total_chars < 5000:  # Documento muy pequeño
+        return 400, 30
+    if total_chars < 20000:  # Documento pequeño
+        return 600, 50
+    if total_chars < 50000:  # Documento mediano
+        return 900, 80
+    return 1200, 100  # Documento grande: chunks más grandes para menos procesamiento
+
+
+def pdf_page_count(file_path):
+    from pypdf import PdfReader
+
+    return len(PdfReader(file_path).pages)
+
+
+def estimate_total_chars(file_path, ext):
+    """Tamaño aproximado del texto sin extraerlo (para elegir el tamaño de chunk)."""
+    if ext == "pdf":
+        return pdf_page_count(file_path) * EST_CHARS_PER_PDF_PAGE
+    if ext == "docx":
+        with zipfile.ZipFile(file_path) as archive:
+            return archive.getinfo("word/document.xml").file_size // DOCX_XML_OVERHEAD
+    return os.path.getsize(file_path)
+
+
+# ---------- extracción ----------
+def _extract_pdf_range(file_path, start, stop):
+    """Texto de las páginas [start, stop) (se ejecuta en un proceso del pool)."""
+    from pypdf import PdfReader
+
+    reader = PdfReader(file_path)
+    return [(number, reader.pages[number].extract_text() or "") for number in range(start, stop)]
+
+
+def _iter_pdf_texts(file_path, workers):
+    from pypdf import PdfReader
+
+    reader = PdfReader(file_path)
+    total = len(reader.pages)
+    if workers <= 1 or total < PARALLEL_MIN_PAGES:
+        for number, page in enumerate(reader.pages):
+            yield number, total, page.extract_text() or ""
+        return
+    del reader
+
+    ranges = iter([(start, min(start + PAGES_PER_TASK, total)) for start in range(0, total, PAGES_PER_TASK)])
+    # spawn: el worker de gunicorn tiene hilos y un fork podría heredar locks tomados
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        # solo 2 rangos por proceso en vuelo: el resto espera a que el consumidor avance
+        pending = deque(pool.submit(_extract_pdf_range, file_path, *r) for r in islice(ranges, workers * 2))
+        while pending:
+            pages = pending.popleft().result()
+            following = next(ranges, None)
+            if following is not None:
+                pending.append(pool.submit(_extract_pdf_range, file_path, *following))
+            for number, text in pages:
+                yield number, total, text
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def _docx_paragraphs(file_path):
+    with zipfile.ZipFile(file_path) as archive, archive.open("word/document.xml") as xml:
+        parts, body = [], None
+        for event, element in iterparse(xml, events=("start", "end")):
+            if event == "start":
+                if element.tag == _W + "body":
+                    body = element
+                continue
+            if element.tag == _W + "t" and element.text:
+                parts.append(element.text)
+            elif element.tag == _W + "tab":
+                parts.append("\t")
+            elif element.tag in (_W + "br", _W + "cr"):
+                parts.append("\n")
+            elif element.tag == _W + "p":
+                yield "".join(parts)
+                parts = []
+                element.clear()
+            # soltar párrafos y tablas ya leídos para que el árbol no crezca con el documento
+            if body is not None and len(body) and body[-1] is element:
+                body.remove(element)
+
+
+def _text_lines(file_path):
+    try:
+        with open(file_path, "r", encoding="utf-8") as fh:
+            yield from fh
+    except UnicodeDecodeError:
+        with open(file_path, "r", encoding="latin-1") as fh:
+            yield from fh
+
+
+def _blocks(pieces, separator):
+    """Agrupa párrafos/líneas en bloques de ~BLOCK_CHARS."""
+    block, size = [], 0
+    for piece in pieces:
+        block.append(piece)
+        size += len(piece)
+        if size >= BLOCK_CHARS:
+            yield separator.join(block)
+            block, size = [], 0
+    if block:
+        yield separator.join(block)
+
+
+def iter_pages(file_path, ext, workers=1):
+    """Documentos de LangChain (uno por página o bloque), generados bajo demanda."""
+    from langchain_core.documents import Document
+
+    if ext == "pdf":
+        for number, total, text in _iter_pdf_texts(file_path, workers):
+            yield Document(page_content=text, metadata={"source": file_path, "page": number, "total_pages": total})
+    elif ext == "docx":
+        for text in _blocks(_docx_paragraphs(file_path), "\n"):
+            yield Document(page_content=text, metadata={"source": file_path})
+    elif ext == "txt":
+        for text in _blocks(_text_lines(file_path), ""):
+            yield Document(page_content=text, metadata={"source": file_path})
+    else:
+        raise ValueError(f"Tipo de archivo no soportado: {ext}")
+
+
+def iter_chunks(pages, splitter):
+    """Parte cada página en cuanto llega, descartando chunks vacíos (la API de embeddings los rechaza)."""
+    if hasattr(splitter, "split_stream"):
+        # el splitter jurídico recorre las páginas seguidas: un artículo puede cruzar de página
+        chunks = splitter.split_stream(pages)
+    else:
+        chunks = (chunk for page in pages if page.page_content.strip()
+                  for chunk in splitter.split_documents([page]))
+    for chunk in chunks:
+        if chunk.page_content.strip():
+            yield chunk
+
+
+# ---------- embeddings en lotes ----------
+def embed_chunks(chunks, embeddings, batch_size=256, on_first_batch=None):
+    """
+    FAISS con todos los `chunks`, embebidos por lotes: mientras un lote está
+    en la API, el generador sigue parseando el siguiente. Devuelve
+    (vector store | None si no hubo texto, número de chunks, total de caracteres).
+    """
+    from langchain_community.vectorstores import FAISS
+
+    store, count, chars = None, 0, 0
+    in_flight = None  # (future, textos, metadatos)
+
+    def _add(batch):
+        nonlocal store
+        future, texts, metadatas = batch
+        pairs = list(zip(texts, future.result()))
+        if store is None:
+            store = FAISS.from_embeddings(pairs, embeddings, metadatas=metadatas)
+        else:
+            store.add_embeddings(pairs, metadatas=metadatas)
+
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="embed") as executor:
+        chunks = iter(chunks)
+        while True:
+            batch = list(islice(chunks, batch_size))
+            if not batch:
+                break
+            texts = [chunk.page_content for chunk in batch]
+            count += len(batch)
+            chars += sum(len(text) for text in texts)
+            if in_flight is None and on_first_batch is not None:
+                on_first_batch()
+            future = executor.submit(embeddings.embed_documents, texts)
+            if in_flight is not None:
+                _add(in_flight)
+            in_flight = (future, texts, [chunk.metadata for chunk in batch])
+        if in_flight is not None:
+            _add(in_flight)
+    return store, count, chars
@@ -0,0 +1,132 @@
+# chatbot/jobs.py
+# ==========================================================
+# 🧵 COLA DE TRABAJOS DE INGESTA EN SEGUNDO PLANO
+# /upload encola cada archivo y responde de inmediato con un job id.
+# Un pool de hilos procesa los archivos y va actualizando el estado:
+#   queued → parsing → embedding → indexing → done | failed
+# El estado de cada job se guarda como un JSON pequeño en disco para
+# que cualquier worker de gunicorn pueda responder /jobs/<id>.
+# ==========================================================
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+JOB_PROGRESS = {
+    "queued": 0,
+    "parsing": 10,
+    "embedding": 40,
+    "indexing": 80,
+    "done": 100,
+    "failed": 100,
+}
+FINAL_STATES = ("done", "failed")
+
+
+class IngestionJobs:
+    """Pool de ingesta con estados persistidos en `jobs_dir`."""
+
+    def __init__(self, jobs_dir, max_workers=2, retention=24 * 3600):
+        self.jobs_dir = str(jobs_dir)
+        self.retention = retention
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ingest")
+        self._futures = {}
+        self._lock = threading.Lock()
+        os.makedirs(self.jobs_dir, exist_ok=True)
+
+    def _path(self, job_id):
+        return os.path.join(self.jobs_dir, f"{job_id}.json")
+
+    def _write(self, job):
+        tmp_path = self._path(job["id"]) + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fh:
+            json.dump(job, fh, ensure_ascii=False)
+        os.replace(tmp_path, self._path(job["id"]))
+
+    def get(self, job_id):
+        # los ids son hex de uuid4: evita rutas arbitrarias
+        if not job_id or not all(c in "0123456789abcdef" for c in job_id):
+            return None
+        try:
+            with open(self._path(job_id), "r", encoding="utf-8") as fh:
+                return json.load(fh)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            job = self.get(job_id) or {"id": job_id}
+            job.update(fields)
+            if "status" in fields:
+                job["progress"] = JOB_PROGRESS.get(fields["status"], job.get("progress", 0))
+            job["updated_at"] = datetime.now().isoformat()
+            self._write(job)
+            return job
+
+    def submit(self, handler, **info):
+        """
+        Encola `handler(progress)` donde `progress(status)` actualiza el estado.
+        El handler devuelve (success, message). `info` se guarda en el job.
+        """
+        self.prune()
+        job_id = uuid.uuid4().hex
+        now = datetime.now().isoformat()
+        job = {"id": job_id, "status": "queued", "progress": 0, "message": "",
+               "created_at": now, "updated_at": now}
+        job.update(info)
+        with self._lock:
+            self._write(job)
+        future = self._executor.submit(self._run, job_id, handler)
+        self._futures[job_id] = future
+        future.add_done_callback(lambda _f: self._futures.pop(job_id, None))
+        return job
+
+    def _run(self, job_id, handler):
+        started = time.time()
+        try:
+            success, message = handler(lambda status: self.update(job_id, status=status))
+        except Exception as e:
+            success, message = False, f"❌ Error procesando archivo: {str(e)[:100]}"
+        self.update(job_id, status="done" if success else "failed", success=success,
+                    message=message, duration=round(time.time() - started, 2))
+
+    def wait(self, job_id, timeout=None):
+        """Espera a que termine un job de este proceso y devuelve su estado final."""
+        future = self._futures.get(job_id)
+        if future is not None:
+            future.result(timeout=timeout)
+        return self.get(job_id)
+
+    def prune(self):
+        """
+        Borra estados de jobs terminados más viejos que `retention`. Un job sin
+        terminar que lleva `retention` sin actualizarse (p. ej. su worker se
+        recicló a mitad) no se borra: se marca `failed` para que /jobs lo diga.
+        """
+        cutoff = time.time() - self.retention
+        try:
+            names = os.listdir(self.jobs_dir)
+        except FileNotFoundError:
+            return
+        for name in names:
+            path = os.path.join(self.jobs_dir, name)
+            job_id = name[:-len(".json")]
+            try:
+                if not name.endswith(".json") or os.path.getmtime(path) >= cutoff or job_id in self._futures:
+                    continue
+            except OSError:
+                continue
+            job = self.get(job_id)
+            if job is None:
+                continue
+            if job.get("status") in FINAL_STATES:
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+            else:
+                self.update(job_id, status="failed", success=False,
+                            message="❌ El trabajo se interrumpió antes de terminar")
@@ -0,0 +1,57 @@
+# chatbot/lazy.py
+# ==========================================================
+# 💤 RECURSOS DE INICIALIZACIÓN PEREZOSA
+# Importar main no debe tocar la red, entrenar modelos ni cargar
+# sklearn/LangChain: Supabase, el modelo de clústers o el servicio de
+# embeddings se crean la primera vez que se usan (o en el warm-up de
+# /readyz). Cada recurso se inicializa una sola vez aunque lo pidan
+# varios hilos a la vez, y recuerda cuánto tardó y si falló. Un fallo
+# no es definitivo (Supabase o la API pueden estar caídos un momento):
+# pasados `retry_after` segundos el siguiente get() lo intenta de nuevo.
+# ==========================================================
+import threading
+import time
+
+
+class Lazy:
+    """Valor que `factory()` construye en el primer `get()`; si falla devuelve None y se reintenta más tarde."""
+
+    def __init__(self, name, factory, retry_after=30):
+        self.name = name
+        self._factory = factory
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self._value = None
+        self._done = False
+        self._failed_at = None
+        self.seconds = None
+        self.error = None
+
+    def _backing_off(self):
+        return self._failed_at is not None and time.monotonic() - self._failed_at < self.retry_after
+
+    def get(self):
+        if not self._done and not self._backing_off():
+            with self._lock:
+                if not self._done and not self._backing_off():
+                    started = time.perf_counter()
+                    try:
+                        self._value = self._factory()
+                    except Exception as e:
+                        print(f"⚠ Error inicializando {self.name} (se reintentará en {self.retry_after}s): {e}")
+                        self.error = str(e)
+                        self._failed_at = time.monotonic()
+                    else:
+                        self.error = None
+                        self._failed_at = None
+                        self._done = True
+                    self.seconds = round(time.perf_counter() - started, 3)
+        return self._value
+
+    @property
+    def loaded(self):
+        return self._done
+
+    def status(self):
+        return {"loaded": self._done, "ok": self._done and self.error is None,
+                "seconds": self.seconds, "error": self.error}
@@ -0,0 +1,207 @@
+# chatbot/legal_splitter.py
+# ==========================================================
+# ⚖️ SPLITTER POR ESTRUCTURA JURÍDICA
+# RecursiveCharacterTextSplitter cortaba artículos y cláusulas a mitad
+# de frase según el tamaño del documento. Este splitter reconoce los
+# encabezados al inicio de línea:
+#   LIBRO > TÍTULO > CAPÍTULO > SECCIÓN          (jerarquía)
+#   ARTÍCULO n, CLÁUSULA n, PRIMERA.-, 1.2 TÍTULO (disposiciones)
+#   bloques notariales (ESCRITURA PÚBLICA No., COMPARECIÓ, OTORGAMIENTO…)
+#   PARÁGRAFO n                                   (dentro de una disposición)
+# Cada disposición es un "padre" (el texto que va al prompt) y se parte
+# en hijos pequeños, uno por parágrafo o por ~child_size caracteres,
+# que son los que se embeben y se buscan. Los hijos llevan
+# section_path, parent_id y offsets (posiciones en el texto del
+# documento con las páginas unidas por salto de línea); los padres se
+# guardan aparte en el segmento (ver chatbot/segments.py).
+# Recorre las páginas en streaming: un artículo puede cruzar páginas.
+# ==========================================================
+import re
+import unicodedata
+from bisect import bisect_right
+
+_ORDINAL = (r"(?:(?:DECIM|VIGESIM|TRIGESIM)[OA]\s*)?"
+            r"(?:PRIMER[OA]?|SEGUND[OA]|TERCER[OA]?|CUART[OA]|QUINT[OA]|SEXT[OA]|SEPTIM[OA]|OCTAV[OA]|NOVEN[OA])"
+            r"|UNDECIM[OA]|DUODECIM[OA]|DECIM[OA]|VIGESIM[OA]|TRIGESIM[OA]|UNIC[OA]|TRANSITORI[OA]")
+_NUMBER = rf"(?:\d+[A-Z]?(?:\s*[O°º](?![A-Z]))?|[IVXLC]+(?![A-Z])|{_ORDINAL})"
+
+# (tipo, nivel, patrón sobre la línea en mayúsculas y sin tildes)
+HEADINGS = [
+    ("libro", 0, re.compile(rf"LIBRO\s+{_NUMBER}")),
+    ("titulo", 1, re.compile(rf"TITULO\s+{_NUMBER}")),
+    ("capitulo", 2, re.compile(rf"CAPITULO\s+{_NUMBER}")),
+    ("seccion", 3, re.compile(rf"SECCION\s+{_NUMBER}")),
+    ("articulo", 4, re.compile(rf"(?:ARTICULO|ART\.)\s*{_NUMBER}")),
+    ("clausula", 4, re.compile(rf"CLAUSULA\s+{_NUMBER}")),
+    ("clausula", 4, re.compile(rf"(?:{_ORDINAL})(?=\s*(?:\.-|\.|:|-|\)))")),
+    ("notarial", 4, re.compile(r"(?:ESCRITURA\s+PUBLICA\s+(?:NUMERO|NO\.?|N°)|COMPARECI(?:O|ERON)|OTORGAMIENTO"
+                               r"|AUTORIZACION|DERECHOS\s+NOTARIALES|NOTA\s+DE\s+ADVERTENCIA|CONSTANCIA"
+                               r"|HOJA\s+DE\s+FIRMAS|FIRMAS)\b")),
+    ("paragrafo", 5, re.compile(rf"PARAGRAFO(?:\s+{_NUMBER})?")),
+]
+# "1.2 OBLIGACIONES DEL ARRENDATARIO": solo si toda la línea es un título en mayúsculas
+_NUMBERED_SECTION = re.compile(r"(\d+(?:\.\d+)*)\.?\s+[A-ZÑ][A-ZÑ ,;]{3,}$")
+
+PROVISION_LEVEL = 4
+SHORT_HEADER_CHARS = 200  # un LIBRO/TÍTULO/CAPÍTULO con menos texto se une a la disposición siguiente
+
+
+def _fold(line):
+    """Mayúsculas sin tildes, con la misma longitud que la línea (para recortar el título)."""
+    return "".join(unicodedata.normalize("NFD", c)[0].upper()[0] for c in line)
+
+
+def _is_heading(kind, stripped, end):
+    """
+    Descarta citas que caen al inicio de una línea cortada ("artículo 1602 del
+    Código Civil"): el encabezado empieza en mayúscula y tras él viene puntuación,
+    fin de línea o un título en mayúsculas. Los bloques notariales van en mayúsculas.
+    """
+    if not stripped[0].isupper():
+        return False
+    if kind == "notarial":
+        return stripped[:end] == stripped[:end].upper()
+    rest = stripped[end:].lstrip()
+    return not rest or rest[0] in ".:-–)°º" or rest == rest.upper()
+
+
+def match_heading(line):
+    """(tipo, nivel, título) si la línea empieza con un encabezado jurídico, o None."""
+    stripped = unicodedata.normalize("NFC", line.strip())
+    if not stripped or len(stripped) < 4:
+        return None
+    folded = _fold(stripped)
+    for kind, level, pattern in HEADINGS:
+        match = pattern.match(folded)
+        if match and _is_heading(kind, stripped, match.end()):
+            return kind, level, stripped[:match.end()].strip(" .:-")
+    if stripped == stripped.upper() and len(stripped) <= 120:
+        match = _NUMBERED_SECTION.match(folded)
+        if match:
+            return "seccion", PROVISION_LEVEL, stripped
+    return None
+
+
+class _Unit:
+    """Disposición en construcción (el futuro padre)."""
+
+    def __init__(self, kind, level, title, path, start, page):
+        self.kind = kind
+        self.level = level
+        self.title = title
+        self.path = path
+        self.start = start
+        self.parts = []
+        self.size = 0
+        self.children = [(0, title)]   # (offset relativo, título) donde empieza cada hijo lógico
+        self.pages = [(0, page)]       # (offset relativo, página)
+
+    def append(self, text, page):
+        if page != self.pages[-1][1]:
+            self.pages.append((self.size, page))
+        self.parts.append(text)
+        self.size += len(text)
+
+    def page_at(self, offset):
+        return self.pages[bisect_right([o for o, _ in self.pages], offset) - 1][1]
+
+    def absorb(self, header):
+        """Antepone el texto de un encabezado sin cuerpo (p. ej. "CAPÍTULO I\nDISPOSICIONES")."""
+        self.start = header.start
+        self.parts = header.parts
+        self.size = header.size
+        self.pages = header.pages
+
+
+class LegalStructureSplitter:
+    """
+    Splitter en streaming: `split_stream(páginas)` genera los hijos y va
+    dejando los padres en `self.parents` (la posición es su parent_id).
+    """
+
+    def __init__(self, child_size=500, child_overlap=50, parent_max_chars=2400):
+        from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+        self.parent_max_chars = parent_max_chars
+        self.child_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=child_size, chunk_overlap=child_overlap, add_start_index=True, keep_separator="end",
+            separators=["\n\n", "\n", ". ", "; ", ", ", " ", ""])
+        self.parents = []
+
+    def split_documents(self, documents):
+        return list(self.split_stream(documents))
+
+    def split_stream(self, pages):
+        offset, hierarchy, unit, base = 0, [], None, {}
+        for page in pages:
+            base = {key: value for key, value in page.metadata.items() if key in ("source", "total_pages")}
+            page_number = page.metadata.get("page")
+            text = page.page_content
+            if text and not text.endswith("\n"):
+                text += "\n"
+            for line in text.splitlines(keepends=True):
+                heading = match_heading(line)
+                if heading is not None and heading[1] <= PROVISION_LEVEL:
+                    kind, level, title = heading
+                    header = None
+                    if unit is not None:
+                        if unit.level < PROVISION_LEVEL and unit.size < SHORT_HEADER_CHARS:
+                            header = unit  # solo el encabezado: pasa a la disposición siguiente
+                        else:
+                            yield from self._flush(unit, base)
+                    if level < PROVISION_LEVEL:
+                        hierarchy = [h for h in hierarchy if h[0] < level] + [(level, title)]
+                    path = [h[1] for h in hierarchy]
+                    if level == PROVISION_LEVEL:
+                        path.append(title)
+                    unit = _Unit(kind, level, title, path, offset, page_number)
+                    if header is not None:
+                        unit.absorb(header)
+                elif unit is None or (unit.size >= self.parent_max_chars // 2
+                                      and unit.size + len(line) > self.parent_max_chars):
+                    # texto antes del primer encabezado, o disposición demasiado larga: padre nuevo
+                    if unit is not None:
+                        yield from self._flush(unit, base)
+                    previous = unit
+                    if previous is None:
+                        unit = _Unit("texto", -1, None, [h[1] for h in hierarchy], offset, page_number)
+                    else:
+                        unit = _Unit(previous.kind, previous.level, previous.title, previous.path, offset, page_number)
+                if heading is not None and heading[1] > PROVISION_LEVEL:
+                    if unit.size:
+                        unit.children.append((unit.size, heading[2]))
+                    else:
+                        unit.children[0] = (0, heading[2])
+                unit.append(line, page_number)
+                offset += len(line)
+        if unit is not None:
+            yield from self._flush(unit, base)
+
+    def _flush(self, unit, base):
+        from langchain_core.documents import Document
+
+        text = "".join(unit.parts)
+        if not text.strip():
+            return
+        parent_id = len(self.parents)
+        section_path = " > ".join(unit.path)
+        self.parents.append(Document(page_content=text, metadata={
+            **base, "page": unit.page_at(0), "section_path": section_path, "unit_type": unit.kind,
+            "start_offset": unit.start, "end_offset": unit.start + len(text)}))
+
+        bounds = unit.children + [(len(text), None)]
+        for (start, title), (end, _) in zip(bounds, bounds[1:]):
+            for piece in self.child_splitter.create_documents([text[start:end]]):
+                content = piece.page_content
+                if not content.strip():
+                    continue
+                relative = start + piece.metadata["start_index"]
+                label = " > ".join(dict.fromkeys(t for t in (unit.title, title) if t))
+                # el hijo lleva su encabezado: "artículo 5" también encuentra el final del artículo
+                if label and not content.lstrip().startswith(label):
+                    content = f"{label}\n{content}"
+                yield Document(page_content=content, metadata={
+                    **base, "page": unit.page_at(relative), "section": label, "section_path": section_path,
+                    "unit_type": unit.kind, "parent_id": parent_id,
+                    "start_offset": unit.start + relative,
+                    "end_offset": unit.start + relative + len(piece.page_content)})
@@ -0,0 +1,175 @@
+# chatbot/lexical.py
+# ==========================================================
+# 🔤 ÍNDICE LÉXICO BM25 POR SEGMENTO
+# Las preguntas jurídicas dependen de tokens exactos ("matrícula
+# inmobiliaria No. 028-0016030", "escritura pública número 2.061",
+# "Art. 15") que la búsqueda por embeddings suele pasar por alto.
+# Cada segmento guarda, junto a su índice FAISS, un índice invertido:
+#   bm25.terms.json  → término → [inicio, df] en las listas de postings
+#   bm25.docs.npy    → posición del chunk de cada posting (uint32)
+#   bm25.tf.npy      → frecuencia del término en ese chunk (uint16)
+#   bm25.lens.npy    → longitud en tokens de cada chunk
+# Los .npy se abren con mmap. Las estadísticas globales (N, avgdl, df)
+# se suman entre segmentos al consultar, así el índice se actualiza de
+# forma incremental: cada subida solo escribe el de su segmento.
+# ==========================================================
+import json
+import math
+import os
+import re
+import unicodedata
+
+import numpy as np
+
+TERMS_FILE = "bm25.terms.json"
+DOCS_FILE = "bm25.docs.npy"
+TF_FILE = "bm25.tf.npy"
+LENS_FILE = "bm25.lens.npy"
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+RRF_K = 60
+
+STOPWORDS = {
+    "a", "al", "ante", "con", "como", "cual", "cuales", "de", "del", "el", "ella", "en", "entre",
+    "es", "esta", "este", "esto", "fue", "ha", "hay", "la", "las", "le", "lo", "los", "mas", "me",
+    "mi", "muy", "o", "para", "pero", "por", "que", "se", "segun", "ser", "si", "sin", "sobre",
+    "son", "su", "sus", "u", "un", "una", "uno", "unos", "y", "ya", "dice", "dicen", "cuanto",
+    "cuando", "donde", "quien", "quienes",
+}
+
+# "Art. 15", "artículo 15A", "arts. 15" → art_15 / art_15a
+_ARTICLE_RE = re.compile(r"\bart(?:iculo|s)?\.?\s*(?:n(?:o|um|umero)?\.?\s*)?(\d+[a-z]?)\b")
+# números con separadores internos se conservan enteros: 028-0016030, 2.061, 15/03/2020
+_TOKEN_RE = re.compile(r"\d+(?:[.,\-/]\d+)*|[a-zñ]+")
+
+
+def _fold(text):
+    """Minúsculas y sin tildes (la ñ se conserva)."""
+    text = text.lower().replace("ñ", "\0")
+    text = "".join(c for c in unicodedata.normalize("NFD", text) if unicodedata.category(c) != "Mn")
+    return text.replace("\0", "ñ")
+
+
+def tokenize(text):
+    """Tokens en español que preservan números y referencias a artículos."""
+    text = _fold(text)
+    tokens = [f"art_{m.group(1)}" for m in _ARTICLE_RE.finditer(text)]
+    for token in _TOKEN_RE.findall(text):
+        if token[0].isdigit():
+            tokens.append(token)
+            parts = re.split(r"[.,\-/]", token)
+            if len(parts) > 1:
+                # "2.061" también debe coincidir con "2061" o con "028 0016030"
+                tokens.append("".join(parts))
+                tokens.extend(parts)
+        elif len(token) > 1 and token not in STOPWORDS:
+            tokens.append(token)
+    return tokens
+
+
+def write_bm25(directory, texts):
+    """Construye y guarda el índice invertido de los chunks (en orden de posición)."""
+    postings = {}
+    lengths = []
+    for position, text in enumerate(texts):
+        tokens = tokenize(text)
+        lengths.append(len(tokens))
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for token, tf in counts.items():
+            postings.setdefault(token, []).append((position, tf))
+
+    terms, doc_ids, tfs = {}, [], []
+    for token in sorted(postings):
+        terms[token] = [len(doc_ids), len(postings[token])]
+        for position, tf in postings[token]:
+            doc_ids.append(position)
+            tfs.append(min(tf, 65535))
+
+    np.save(os.path.join(directory, DOCS_FILE), np.asarray(doc_ids, dtype="uint32"))
+    np.save(os.path.join(directory, TF_FILE), np.asarray(tfs, dtype="uint16"))
+    np.save(os.path.join(directory, LENS_FILE), np.asarray(lengths, dtype="uint32"))
+    # el diccionario de términos va al final: su presencia marca el índice como completo
+    tmp_path = os.path.join(directory, TERMS_FILE + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as fh:
+        json.dump(terms, fh, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp_path, os.path.join(directory, TERMS_FILE))
+
+
+def has_bm25(directory):
+    return os.path.exists(os.path.join(directory, TERMS_FILE))
+
+
+class BM25Index:
+    """Índice invertido de un segmento, leído con mmap."""
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, TERMS_FILE), "r", encoding="utf-8") as fh:
+            self.terms = json.load(fh)
+        self.doc_ids = np.load(os.path.join(directory, DOCS_FILE), mmap_mode="r")
+        self.tfs = np.load(os.path.join(directory, TF_FILE), mmap_mode="r")
+        self.lengths = np.load(os.path.join(directory, LENS_FILE), mmap_mode="r")
+        self.total_length = int(np.sum(self.lengths, dtype="uint64"))
+
+    def df(self, term):
+        entry = self.terms.get(term)
+        return entry[1] if entry else 0
+
+    def postings(self, term):
+        start, count = self.terms[term]
+        return self.doc_ids[start:start + count], self.tfs[start:start + count]
+
+
+def _in_ranges(positions, ranges):
+    mask = np.zeros(len(positions), dtype=bool)
+    for start, stop in ranges:
+        mask |= (positions >= start) & (positions < stop)
+    return mask
+
+
+def bm25_search(indexes, query, k, ranges=None):
+    """
+    BM25 sobre varios índices con estadísticas globales.
+    `indexes` es una lista de (clave, BM25Index); devuelve [(clave, posición, score)].
+    `ranges` {clave: [(inicio, fin), ...]} limita las posiciones de esos índices.
+    """
+    terms = list(dict.fromkeys(tokenize(query)))
+    indexes = [(key, idx) for key, idx in indexes if len(idx.lengths)]
+    if not terms or not indexes:
+        return []
+    n_docs = sum(len(idx.lengths) for _, idx in indexes)
+    avgdl = max(sum(idx.total_length for _, idx in indexes) / n_docs, 1.0)
+    idf = {}
+    for term in terms:
+        df = sum(idx.df(term) for _, idx in indexes)
+        if df:
+            idf[term] = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+
+    hits = []
+    for key, idx in indexes:
+        scores = {}
+        for term, weight in idf.items():
+            if term not in idx.terms:
+                continue
+            positions, tfs = idx.postings(term)
+            if ranges and ranges.get(key) is not None:
+                keep = _in_ranges(positions, ranges[key])
+                positions, tfs = positions[keep], tfs[keep]
+            tfs = tfs.astype("float32")
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * idx.lengths[positions] / avgdl)
+            for position, score in zip(positions.tolist(), (weight * tfs * (BM25_K1 + 1) / (tfs + norm)).tolist()):
+                scores[position] = scores.get(position, 0.0) + score
+        hits.extend((key, position, score) for position, score in scores.items())
+    hits.sort(key=lambda hit: hit[2], reverse=True)
+    return hits[:k]
+
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    """Fusiona listas ordenadas de claves: score = Σ 1 / (k + rango)."""
+    scores = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
@@ -0,0 +1,318 @@
+# chatbot/llm_gateway.py
+# ==========================================================
+# 🛰️ GATEWAY ÚNICO PARA LAS LLAMADAS AL LLM
+# Todas las llamadas de chat pasan por aquí:
+#   - un cliente OpenAI persistente (pool de conexiones keep-alive)
+#     compartido por los hilos del worker, y uno asíncrono para asgi.py
+#   - plazo por petición (Deadline): la búsqueda gasta su parte y la
+#     generación recibe solo el tiempo que queda
+#   - reintentos con backoff exponencial y jitter, sin pasarse del plazo
+#   - circuit breaker: tras varios fallos seguidos deja de llamar durante
+#     `cooldown` segundos y el llamador cae directo a los clústers
+#   - métricas por llamada: latencia, tokens, errores y reintentos
+# ==========================================================
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+
+import httpx
+from openai import (APIConnectionError, APITimeoutError, AsyncOpenAI, DefaultAsyncHttpxClient,
+                    DefaultHttpxClient, InternalServerError, OpenAI, RateLimitError)
+
+RETRYABLE_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return round(sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))], 1)
+
+
+class LLMUnavailable(Exception):
+    """El LLM no respondió a tiempo, agotó los reintentos o el circuito está abierto."""
+
+
+class CircuitOpenError(LLMUnavailable):
+    pass
+
+
+class DeadlineExceeded(LLMUnavailable, TimeoutError):
+    pass
+
+
+class Deadline:
+    """Plazo total de una petición (búsqueda + generación)."""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+
+class CircuitBreaker:
+    """
+    closed → open tras `threshold` fallos seguidos. Pasado `cooldown` queda
+    half_open: deja pasar una sola llamada de prueba; si falla vuelve a abrirse.
+    """
+
+    def __init__(self, threshold=5, cooldown=30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half_open"
+        return "open"
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.opened_at is not None or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+    def release(self):
+        """La llamada terminó sin decir nada del servicio (p. ej. un error de programación)."""
+        with self._lock:
+            self._probing = False
+
+
+class LLMGateway:
+    """Cliente de chat con pool persistente, plazos, reintentos, circuit breaker y métricas."""
+
+    def __init__(self, api_key, model="gpt-4o-mini", timeout=15.0, retries=1,
+                 max_connections=100, breaker_threshold=5, breaker_cooldown=30.0,
+                 backoff_base=0.5, backoff_max=4.0, min_attempt_seconds=1.0, latency_window=1000):
+        self.api_key = api_key
+        self.model = model
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.min_attempt_seconds = min_attempt_seconds
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_cooldown)
+
+        # Un solo pool por proceso: las conexiones TLS se reutilizan entre peticiones.
+        # Los clientes se crean al primer uso: construir el gateway (importar main)
+        # no lee certificados ni exige la API key, y con preload_app cada worker
+        # de gunicorn abre su propio pool después del fork
+        self._limits = httpx.Limits(max_connections=max_connections,
+                                    max_keepalive_connections=max(1, max_connections // 5))
+        self._client_lock = threading.RLock()
+        self._http_client = None
+        self._client = None
+        self._aclient = None
+
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=latency_window)
+        self.calls = 0
+        self.errors = 0
+        self.retried = 0
+        self.short_circuited = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    @property
+    def http_client(self):
+        if self._http_client is None:
+            with self._client_lock:
+                if self._http_client is None:
+                    self._http_client = DefaultHttpxClient(limits=self._limits)
+        return self._http_client
+
+    @property
+    def client(self):
+        """Cliente OpenAI síncrono sobre el pool compartido (se crea al primer uso)."""
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = OpenAI(api_key=self.api_key, max_retries=0, timeout=self.timeout,
+                                          http_client=self.http_client)
+        return self._client
+
+    @client.setter
+    def client(self, value):
+        self._client = value
+
+    @property
+    def aclient(self):
+        """Cliente asíncrono (se crea al primer uso, dentro del event loop de asgi.py)."""
+        if self._aclient is None:
+            self._aclient = AsyncOpenAI(api_key=self.api_key, max_retries=0, timeout=self.timeout,
+                                        http_client=DefaultAsyncHttpxClient(limits=self._limits))
+        return self._aclient
+
+    # ---------- métricas ----------
+    def _record_call(self, started, usage=None):
+        with self._lock:
+            self.calls += 1
+            self._latencies.append((time.perf_counter() - started) * 1000)
+        if usage is not None:
+            self._record_usage(usage)
+
+    def _record_usage(self, usage):
+        with self._lock:
+            self.prompt_tokens += int(getattr(usage, "prompt_tokens", 0) or 0)
+            self.completion_tokens += int(getattr(usage, "completion_tokens", 0) or 0)
+
+    def _record_error(self):
+        with self._lock:
+            self.errors += 1
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            return {
+                "circuit": self.breaker.state,
+                "calls": self.calls,
+                "errors": self.errors,
+                "retries": self.retried,
+                "short_circuited": self.short_circuited,
+                "latency_ms": {
+                    "avg": round(sum(latencies) / len(latencies), 1) if latencies else None,
+                    "p50": _percentile(latencies, 0.5),
+                    "p95": _percentile(latencies, 0.95),
+                },
+                "tokens": {"prompt": self.prompt_tokens, "completion": self.completion_tokens},
+            }
+
+    # ---------- política de cada intento ----------
+    def _begin_attempt(self, deadline, timeout):
+        """Timeout del intento (lo que quede del plazo) o excepción si no se debe llamar."""
+        if deadline is not None:
+            remaining = deadline.remaining()
+            if remaining < self.min_attempt_seconds:
+                raise DeadlineExceeded(f"plazo agotado ({remaining:.1f}s restantes)")
+            timeout = min(timeout, remaining) if timeout else remaining
+        timeout = timeout or self.timeout
+        if not self.breaker.allow():
+            with self._lock:
+                self.short_circuited += 1
+            raise CircuitOpenError("circuito abierto: demasiados fallos seguidos del LLM")
+        return timeout
+
+    def _retry_delay(self, error, attempt, retries, deadline):
+        """Registra el fallo y devuelve la espera antes de reintentar, o lanza LLMUnavailable."""
+        self.breaker.record_failure()
+        self._record_error()
+        if attempt >= retries:
+            raise LLMUnavailable(f"{type(error).__name__}: {error}") from error
+        delay = min(self.backoff_base * (2 ** attempt), self.backoff_max) * random.uniform(0.5, 1.0)
+        if deadline is not None:
+            delay = min(delay, deadline.remaining())
+        with self._lock:
+            self.retried += 1
+        print(f"⏳ LLM: {type(error).__name__}, reintento en {delay:.1f}s")
+        return delay
+
+    def _failed_request(self, error):
+        # 4xx: el servicio respondió, así que no cuenta como caída
+        self._record_error()
+        if getattr(error, "status_code", None) is not None:
+            self.breaker.record_success()
+        else:
+            self.breaker.release()
+
+    # ---------- llamadas ----------
+    def chat(self, messages, model=None, deadline=None, timeout=None, retries=None, stream=False, **kwargs):
+        """chat.completions.create pasando por el gateway. Con stream=True devuelve un iterador de chunks."""
+        retries = self.retries if retries is None else retries
+        if stream:
+            kwargs.setdefault("stream_options", {"include_usage": True})
+        attempt = 0
+        while True:
+            attempt_timeout = self._begin_attempt(deadline, timeout)
+            started = time.perf_counter()
+            try:
+                response = self.client.chat.completions.create(
+                    model=model or self.model, messages=messages, stream=stream, timeout=attempt_timeout, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                time.sleep(self._retry_delay(e, attempt, retries, deadline))
+                attempt += 1
+                continue
+            except Exception as e:
+                self._failed_request(e)
+                raise
+            self.breaker.record_success()
+            if stream:
+                return self._metered_stream(response, started)
+            self._record_call(started, getattr(response, "usage", None))
+            return response
+
+    def _metered_stream(self, stream, started):
+        try:
+            for chunk in stream:
+                usage = getattr(chunk, "usage", None)
+                if usage is not None:
+                    self._record_usage(usage)
+                yield chunk
+        except RETRYABLE_ERRORS:
+            self.breaker.record_failure()
+            self._record_error()
+            raise
+        self._record_call(started)
+
+    async def achat(self, messages, model=None, deadline=None, timeout=None, retries=None, stream=False, **kwargs):
+        """Versión asíncrona de chat() (mismo breaker y mismas métricas)."""
+        retries = self.retries if retries is None else retries
+        if stream:
+            kwargs.setdefault("stream_options", {"include_usage": True})
+        attempt = 0
+        while True:
+            attempt_timeout = self._begin_attempt(deadline, timeout)
+            started = time.perf_counter()
+            try:
+                response = await self.aclient.chat.completions.create(
+                    model=model or self.model, messages=messages, stream=stream, timeout=attempt_timeout, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                await asyncio.sleep(self._retry_delay(e, attempt, retries, deadline))
+                attempt += 1
+                continue
+            except Exception as e:
+                self._failed_request(e)
+                raise
+            self.breaker.record_success()
+            if stream:
+                return self._ametered_stream(response, started)
+            self._record_call(started, getattr(response, "usage", None))
+            return response
+
+    async def _ametered_stream(self, stream, started):
+        try:
+            async for chunk in stream:
+                usage = getattr(chunk, "usage", None)
+                if usage is not None:
+                    self._record_usage(usage)
+                yield chunk
+        except RETRYABLE_ERRORS:
+            self.breaker.record_failure()
+            self._record_error()
+            raise
+        self._record_call(started)
@@ -1,8 +1,6 @@
 # chatbot/model.py
 import os
 import pickle
-from sklearn.feature_extraction.text import CountVectorizer
-from sklearn.cluster import KMeans
 
 MODEL_DIR = "models"
 MODEL_PATH = os.path.join(MODEL_DIR, "unsupervised_model.pkl")
@@ -13,6 +11,10 @@ def build_and_train_model(train_texts, n_clusters=6):
     """
     Entrena un modelo no supervisado (KMeans) para agrupar frases similares.
     """
+    # sklearn solo se importa al entrenar (o al deserializar el modelo)
+    from sklearn.feature_extraction.text import CountVectorizer
+    from sklearn.cluster import KMeans
+
     vectorizer = CountVectorizer()
     X = vectorizer.fit_transform(train_texts)
 
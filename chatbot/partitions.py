@@ -0,0 +1,142 @@
+# chatbot/partitions.py
+# ==========================================================
+# 🗂️ PARTICIONES Y FILTROS DE BÚSQUEDA
+# Cada entrada del manifest lista las particiones que contiene: un
+# documento subido es una partición con su rango de posiciones en el
+# índice del segmento,
+#   {"source", "corpus_id", "generation", "created_at", "start", "stop"}
+# Un segmento recién ingestado tiene una sola; uno fusionado concatena
+# las de sus víctimas desplazando los rangos. Un filtro de /chat
+#   {"document": [...], "corpus": "g7-…", "since": "2026-01-01", "until": …}
+# se resuelve contra el manifest en {segmento: None | [(inicio, fin)]}:
+# los segmentos sin partición elegida no se consultan y en los
+# fusionados solo compiten los rangos elegidos (ver chatbot/ann.py).
+# "corpus" es el corpus_id que devolvió /chat o guardó Supabase: elige
+# los documentos que ya estaban en esa versión del corpus.
+# Un chunk que la deduplicación colapsó en el chunk canónico de otro
+# documento solo existe como referencia (ver chatbot/dedup.py): el
+# filtro suma la posición del canónico si alguna de sus referencias
+# nombra un documento elegido (`matching_sources` + `add_positions`).
+# ==========================================================
+import json
+from datetime import datetime
+
+from chatbot.corpus import corpus_of, format_corpus_id
+
+FILTER_FIELDS = ("document", "corpus", "since", "until")
+
+
+def partitions_of(entry):
+    """Particiones de una entrada del manifest; los segmentos anteriores cuentan como una sola."""
+    partitions = entry.get("partitions")
+    if partitions is not None:
+        return partitions
+    return [{"source": entry.get("source"), "corpus_id": None, "generation": 0,
+             "created_at": entry.get("created_at"), "start": 0, "stop": entry.get("vectors", 0)}]
+
+
+def shift_partitions(partitions, offset):
+    return [{**partition, "start": partition["start"] + offset, "stop": partition["stop"] + offset}
+            for partition in partitions]
+
+
+def _check_date(value, field):
+    try:
+        datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"{field} debe ser una fecha ISO (AAAA-MM-DD)") from None
+    return value
+
+
+def normalize_filter(spec):
+    """
+    Filtro canónico (sin campos vacíos, documentos ordenados) o None si no
+    filtra nada. ValueError si una fecha no es ISO.
+    """
+    if not spec:
+        return None
+    normalized = {}
+    documents = spec.get("document")
+    if isinstance(documents, str):
+        documents = [documents]
+    documents = sorted({str(d).strip() for d in documents or () if str(d).strip()})
+    if documents:
+        normalized["document"] = documents
+    corpus = str(spec.get("corpus") or "").strip()
+    if corpus:
+        normalized["corpus"] = corpus
+    for field in ("since", "until"):
+        value = str(spec.get(field) or "").strip()
+        if value:
+            normalized[field] = _check_date(value, field)
+    return normalized or None
+
+
+def filter_key(spec):
+    """JSON estable del filtro (para las keys del cache)."""
+    return json.dumps(spec, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+
+
+def corpus_generation(manifest, corpus_id):
+    """Generación del corpus `corpus_id` (el vigente o el de alguna ingesta). ValueError si no existe."""
+    if corpus_id == format_corpus_id(corpus_of(manifest)):
+        return corpus_of(manifest)["generation"]
+    for entry in manifest.get("segments", []):
+        for partition in partitions_of(entry):
+            if partition.get("corpus_id") == corpus_id:
+                return partition["generation"]
+    raise ValueError(f"corpus desconocido: {corpus_id}")
+
+
+def _matches(partition, spec, generation):
+    if "document" in spec and partition.get("source") not in spec["document"]:
+        return False
+    if generation is not None and partition.get("generation", 0) > generation:
+        return False
+    created_at = partition.get("created_at") or ""
+    if "since" in spec and created_at[:len(spec["since"])] < spec["since"]:
+        return False
+    if "until" in spec and created_at[:len(spec["until"])] > spec["until"]:
+        return False
+    return True
+
+
+def _merge_ranges(ranges):
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def matching_sources(manifest, spec):
+    """Fuentes (documentos) de las particiones que cumplen `spec`."""
+    generation = corpus_generation(manifest, spec["corpus"]) if "corpus" in spec else None
+    return {p.get("source") for entry in manifest.get("segments", []) for p in partitions_of(entry)
+            if _matches(p, spec, generation)}
+
+
+def add_positions(ranges, positions):
+    """`ranges` [(inicio, fin)] ampliados con las posiciones sueltas `positions`."""
+    return _merge_ranges(list(ranges or ()) + [(p, p + 1) for p in positions])
+
+
+def select(manifest, spec):
+    """
+    {nombre de segmento: None (todas sus posiciones) | [(inicio, fin), ...]}
+    con los segmentos que tienen alguna partición que cumple `spec`.
+    """
+    generation = corpus_generation(manifest, spec["corpus"]) if "corpus" in spec else None
+    selection = {}
+    for entry in manifest.get("segments", []):
+        partitions = partitions_of(entry)
+        chosen = [p for p in partitions if _matches(p, spec, generation)]
+        if not chosen:
+            continue
+        if len(chosen) == len(partitions):
+            selection[entry["name"]] = None
+        else:
+            selection[entry["name"]] = _merge_ranges((p["start"], p["stop"]) for p in chosen if p["stop"] > p["start"])
+    return selection
@@ -0,0 +1,98 @@
+# chatbot/query_cache.py
+# ==========================================================
+# 🧭 LRU DE EMBEDDINGS DE PREGUNTAS
+# El embedding de la pregunta se calcula una vez por petición y se
+# reutiliza en el cache semántico, la búsqueda FAISS y la compresión
+# del contexto. Este LRU en memoria evita además volver a pedirlo a la
+# API cuando la misma pregunta llega otra vez, aunque cambien las
+# mayúsculas, los signos de puntuación o los espacios (la misma
+# normalización que las keys del cache exacto). Las keys incluyen el
+# modelo para no mezclar espacios vectoriales.
+# ==========================================================
+import re
+import threading
+from collections import OrderedDict
+
+
+def normalize_query(text):
+    """Palabras en minúsculas separadas por un espacio (sin signos de puntuación)."""
+    return " ".join(re.findall(r"\w+", (text or "").lower()))
+
+
+def embedder_model(embedder):
+    model = getattr(embedder, "model", None)
+    return model if isinstance(model, str) else type(embedder).__name__
+
+
+class QueryEmbeddingCache:
+    """LRU acotado {(modelo, pregunta normalizada): embedding}, seguro entre hilos."""
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, text, model):
+        return (model or "", normalize_query(text))
+
+    def get(self, text, model=None):
+        key = self._key(text, model)
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return vector
+
+    def put(self, text, vector, model=None):
+        if vector is None or self.max_entries <= 0:
+            return
+        key = self._key(text, model)
+        with self._lock:
+            self._entries[key] = list(vector)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def embed(self, embedder, text):
+        """embedder.embed_query(text), salvo que ya esté en el LRU."""
+        model = embedder_model(embedder)
+        vector = self.get(text, model)
+        if vector is None:
+            vector = embedder.embed_query(text)
+            self.put(text, vector, model)
+        return vector
+
+    async def aembed(self, embedder, text):
+        model = embedder_model(embedder)
+        vector = self.get(text, model)
+        if vector is None:
+            vector = await embedder.aembed_query(text)
+            self.put(text, vector, model)
+        return vector
+
+    def embed_many(self, embedder, texts):
+        """Embeddings de `texts` pidiendo a la API (en una sola llamada) solo los que faltan."""
+        model = embedder_model(embedder)
+        vectors = [self.get(text, model) for text in texts]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            fresh = embedder.embed_documents([texts[i] for i in missing])
+            for i, vector in zip(missing, fresh):
+                vectors[i] = vector
+                self.put(texts[i], vector, model)
+        return vectors
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self._entries), "max_entries": self.max_entries,
+                    "hits": self.hits, "misses": self.misses,
+                    "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0}
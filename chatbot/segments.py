@@ -0,0 +1,942 @@
+# chatbot/segments.py
+# ==========================================================
+# 🧱 VECTOR DB POR SEGMENTOS (ESCRITURA INCREMENTAL)
+# Cada documento subido se guarda como un segmento propio en
+# vector_db/segments/<nombre>/ y un manifest.json lista los segmentos
+# vivos con un número de generación. Subir un documento cuesta lo que
+# mide el documento, no el corpus: nunca se reescribe el índice entero.
+# Las búsquedas consultan todos los segmentos y fusionan resultados.
+# Otros workers detectan un manifest nuevo y cargan solo los segmentos
+# que les faltan. Un hilo en segundo plano fusiona segmentos pequeños
+# para que su número no crezca sin límite.
+#
+# Recarga tipo read-copy-update: las búsquedas leen una sola vez la
+# referencia al Snapshot vigente (manifest + segmentos ya cargados) y
+# terminan sobre él aunque mientras tanto aparezca otro. El hilo
+# vigilante (start_watcher) hace un stat() del manifest y, si cambió,
+# arma el snapshot nuevo aparte (índices y BM25 ya abiertos) y solo
+# entonces cambia la referencia: nadie espera la carga ni ve un índice
+# a medio cargar. Los archivos de segmentos fusionados siguen abiertos
+# (mmap/fd) mientras un snapshot viejo los use.
+#
+# Formato de un segmento (inmutable una vez escrito):
+#   index.faiss       → índice FAISS, abierto con mmap
+#   docs.jsonl        → chunks (ver chatbot/docstore.py), leídos por posición
+#   docs.offsets.npy
+#   bm25.*            → índice léxico (ver chatbot/lexical.py)
+# Con `hybrid` las búsquedas que traen el texto de la pregunta fusionan
+# el ranking vectorial y el BM25 con reciprocal rank fusion.
+# Nada se deserializa con pickle. El vector_db antiguo de LangChain
+# (index.faiss + index.pkl) se convierte una sola vez al abrirlo.
+# El tipo de índice de cada segmento (flat/ivf/ivfpq/hnsw) lo decide
+# chatbot/ann.py según `index_type` y el tamaño del segmento.
+# El manifest lleva además la versión del corpus ("corpus", ver
+# chatbot/corpus.py), que solo cambia cuando se añade contenido.
+# Cada segmento guarda también las firmas MinHash de sus chunks y las
+# referencias de los casi duplicados que se colapsaron en ellos
+# (minhash.npz, refs.jsonl; ver chatbot/dedup.py). Con `mmr_lambda`
+# los resultados se reordenan con MMR para no repetir contenido.
+# Con el splitter jurídico (chatbot/legal_splitter.py) el índice guarda
+# los chunks hijos y parents/ las disposiciones completas: cada hijo
+# encontrado trae el texto de su padre en metadata["parent_content"].
+# Cada entrada del manifest lista sus particiones (un documento = un
+# rango de posiciones, ver chatbot/partitions.py): con `filter` solo se
+# consultan los segmentos y rangos elegidos. `evict()` suelta de la
+# memoria los segmentos que no se usan; se reabren al buscarlos. Un
+# segmento fusionado (retirado del manifest) no se suelta ni se reabre:
+# lo que ya tenía abierto sigue sirviendo a los snapshots viejos.
+# ==========================================================
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+import faiss
+import numpy as np
+
+from chatbot.ann import build_index, choose_index_type, extract_vectors, index_type_of, read_index_mmap, search
+from chatbot.corpus import chain_hash, content_hash, corpus_of, format_corpus_id
+from chatbot.dedup import mmr, read_references, read_signatures, write_references, write_signatures
+from chatbot.docstore import OffsetDocstore, has_docstore, write_docstore
+from chatbot.lexical import BM25Index, bm25_search, has_bm25, reciprocal_rank_fusion, write_bm25
+from chatbot.partitions import add_positions, matching_sources, normalize_filter, partitions_of, select, shift_partitions
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin bloqueo entre procesos
+    fcntl = None
+
+MANIFEST_NAME = "manifest.json"
+SEGMENTS_DIR = "segments"
+INDEX_FILE = "index.faiss"
+LEGACY_PICKLE = "index.pkl"
+PARENTS_DIR = "parents"  # docstore con las disposiciones padre (mismo formato que docs.jsonl)
+NEUTRAL_DISTANCE = 2.0  # L2² entre embeddings normalizados ortogonales
+
+
+def _new_segment_name(suffix=""):
+    return f"seg-{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}{suffix}"
+
+
+def faiss_store_parts(db):
+    """(índice, documentos en orden de posición) de un vector store FAISS de LangChain."""
+    documents = [db.docstore.search(db.index_to_docstore_id[pos]) for pos in range(db.index.ntotal)]
+    return db.index, documents
+
+
+class SegmentGone(RuntimeError):
+    """El segmento ya no está en el manifest (fusionado) y sus archivos no se pueden reabrir."""
+
+
+class Segment:
+    """
+    Un segmento: índice en mmap, docstore y padres (offsets en mmap + fd) y
+    BM25, abiertos juntos al cargarlo. Lo abierto sigue legible aunque otro
+    worker borre la carpeta al fusionar. `release()` lo suelta y la siguiente
+    búsqueda lo reabre, salvo que el segmento ya esté retirado del manifest:
+    ese no se suelta ni se reabre. Las búsquedas lo fijan con acquire()/unpin()
+    y un release() durante una búsqueda espera a que termine la última.
+    """
+
+    def __init__(self, directory, index_type=None, vectors=None, lexical=False):
+        self.directory = directory
+        self.name = os.path.basename(os.path.normpath(directory))
+        self.index_type = index_type
+        self.lexical = lexical  # abrir también el BM25 (modo híbrido)
+        self.retired = False    # fuera del manifest vigente
+        self._vectors = vectors
+        self._load_lock = threading.Lock()
+        self._index = None
+        self._docs = None
+        self._bm25 = None
+        self._parents = None
+        self._disk_bytes = None
+        self._users = 0               # búsquedas en curso (acquire)
+        self._release_pending = False
+        self._references = read_references(directory)
+        self._dedup_positions = None
+        with self._load_lock:
+            self._open()
+
+    def _open(self):
+        """Abre todo lo que leen las búsquedas (con `_load_lock` tomado)."""
+        if self.retired:
+            raise SegmentGone(f"segmento {self.name} retirado del manifest")
+        if not os.path.exists(os.path.join(self.directory, INDEX_FILE)):
+            raise SegmentGone(f"segmento {self.name} borrado del disco")
+        index = read_index_mmap(os.path.join(self.directory, INDEX_FILE), self.index_type)
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None:
+            # reconstruct (MMR, distancia de los hits de BM25) necesita el mapa
+            # posición → lista: se arma aquí, una vez, y no desde las búsquedas
+            ivf.make_direct_map()
+        docs = OffsetDocstore(self.directory)
+        parents_dir = os.path.join(self.directory, PARENTS_DIR)
+        parents = OffsetDocstore(parents_dir) if has_docstore(parents_dir) else False
+        bm25 = self._open_bm25() if self.lexical else None
+        self._vectors = index.ntotal
+        self._docs, self._parents, self._bm25 = docs, parents, bm25
+        self._index = index
+
+    def _open_bm25(self):
+        if not has_bm25(self.directory):
+            # segmento escrito antes del índice léxico: se construye una vez
+            write_bm25(self.directory, [doc.page_content for doc in OffsetDocstore(self.directory)])
+        return BM25Index(self.directory)
+
+    def _field(self, name):
+        value = getattr(self, name)
+        if value is None:
+            with self._load_lock:
+                if self._index is None:
+                    self._open()
+                if name == "_bm25" and self._bm25 is None:
+                    self._bm25 = self._open_bm25()
+                value = getattr(self, name)
+        return value
+
+    @property
+    def index(self):
+        return self._field("_index")
+
+    @property
+    def docs(self):
+        return self._field("_docs")
+
+    @property
+    def resident(self):
+        return self._index is not None
+
+    @property
+    def disk_bytes(self):
+        """Tamaño de los archivos del segmento (índice, BM25, offsets): lo que ocupa abierto."""
+        if self._disk_bytes is None:
+            self._disk_bytes = sum(entry.stat().st_size for entry in os.scandir(self.directory) if entry.is_file())
+        return self._disk_bytes
+
+    def acquire(self):
+        """Abre el segmento si hace falta y lo fija hasta el unpin() correspondiente."""
+        with self._load_lock:
+            if self._index is None:
+                self._open()
+            self._users += 1
+
+    def unpin(self):
+        with self._load_lock:
+            self._users -= 1
+            if self._users == 0 and self._release_pending:
+                self._release_pending = False
+                self._drop()
+
+    def _drop(self):
+        self._index = self._docs = self._bm25 = self._parents = None
+
+    def release(self):
+        """
+        Suelta las estructuras en memoria; los archivos quedan en disco. Con
+        búsquedas en curso se suelta cuando termina la última. Un segmento
+        retirado no se suelta.
+        """
+        with self._load_lock:
+            if self.retired or self._index is None:
+                return False
+            if self._users:
+                self._release_pending = True
+            else:
+                self._drop()
+        return True
+
+    @staticmethod
+    def write(directory, index, documents, signatures=None, references=None, parents=None):
+        os.makedirs(directory, exist_ok=True)
+        write_docstore(directory, documents)
+        if parents:
+            write_docstore(os.path.join(directory, PARENTS_DIR), parents)
+        write_bm25(directory, [doc.page_content for doc in documents])
+        write_signatures(directory, signatures)
+        write_references(directory, references)
+        faiss.write_index(index, os.path.join(directory, INDEX_FILE))
+
+    @property
+    def bm25(self):
+        return self._field("_bm25")
+
+    @property
+    def references(self):
+        """{dedup_key: [referencias]} de los casi duplicados colapsados en este segmento."""
+        return self._references
+
+    def signatures(self):
+        return read_signatures(self.directory)
+
+    def dedup_positions(self):
+        """{dedup_key: posición} de los chunks del segmento; se arma al primer filtro que lo necesita."""
+        if self._dedup_positions is None:
+            self.acquire()
+            try:
+                self._dedup_positions = {doc.metadata["dedup_key"]: position
+                                         for position, doc in enumerate(self._docs)
+                                         if doc.metadata.get("dedup_key")}
+            finally:
+                self.unpin()
+        return self._dedup_positions
+
+    @property
+    def parents(self):
+        """Docstore de las disposiciones padre, o None si el segmento no tiene."""
+        return self._field("_parents") or None
+
+    def parent(self, parent_id):
+        parents = self.parents
+        if parents is None or not 0 <= parent_id < len(parents):
+            return None
+        return parents.get(parent_id)
+
+    @property
+    def ntotal(self):
+        # sin abrir el índice si está liberado
+        if self._vectors is None:
+            return self.index.ntotal
+        return self._vectors
+
+    @property
+    def kind(self):
+        return self.index_type or index_type_of(self.index)
+
+    def document(self, position):
+        return self.docs.get(position)
+
+
+class Snapshot:
+    """Vista inmutable de la vector DB: manifest y {nombre: Segment} ya cargados."""
+
+    __slots__ = ("manifest", "segments", "stat", "loaded_at", "_references")
+
+    def __init__(self, manifest, segments, stat=None):
+        self.manifest = manifest
+        self.segments = segments
+        self.stat = stat
+        self.loaded_at = time.time()
+        self._references = None
+
+    @property
+    def generation(self):
+        return self.manifest.get("generation", 0)
+
+    @property
+    def references(self):
+        """Referencias de casi duplicados de todos los segmentos, por dedup_key canónica."""
+        if self._references is None:
+            merged = {}
+            for seg in self.segments.values():
+                for key, refs in seg.references.items():
+                    merged.setdefault(key, []).extend(refs)
+            self._references = merged
+        return self._references
+
+
+class SegmentedVectorStore:
+    """
+    Vector store de solo-añadir formado por segmentos FAISS independientes.
+    Expone la parte de la interfaz de LangChain que usa el chat
+    (`similarity_search_with_score[_by_vector]` y `embeddings`).
+    `nprobe`/`ef_search` son los valores por defecto de los índices IVF/HNSW;
+    cada búsqueda puede pasar los suyos.
+    """
+
+    def __init__(self, directory, embeddings, max_segments=8, refresh_interval=1.0,
+                 merge_interval=600, index_type="auto", nprobe=16, ef_search=64, hybrid=True,
+                 mmr_lambda=None):
+        self.directory = str(directory)
+        self.embeddings = embeddings
+        self.hybrid = hybrid
+        self.mmr_lambda = mmr_lambda  # None: top-k por relevancia, sin MMR
+        self.index_type = index_type
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.max_segments = max_segments
+        self.refresh_interval = refresh_interval
+        self.merge_interval = merge_interval
+        self._manifest_path = os.path.join(self.directory, MANIFEST_NAME)
+        self._lock_path = os.path.join(self.directory, "manifest.lock")
+        self._mutex = threading.RLock()         # escrituras del manifest (ingesta y fusión)
+        self._reload_lock = threading.Lock()    # un solo hilo arma el snapshot siguiente
+        self._snapshot = Snapshot({"generation": 0, "segments": []}, {})
+        self._last_check = 0.0
+        self._merger = None
+        self._watcher = None
+        self._closed = threading.Event()
+        self.reloads = 0
+        os.makedirs(os.path.join(self.directory, SEGMENTS_DIR), exist_ok=True)
+        self._migrate_legacy()
+        self.refresh(force=True)
+
+    # ------------------------------------------------------------------
+    # Manifest
+    # ------------------------------------------------------------------
+    @contextmanager
+    def _exclusive(self):
+        fh = open(self._lock_path, "a")
+        try:
+            if fcntl is not None:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+            fh.close()
+
+    def _read_manifest(self):
+        try:
+            with open(self._manifest_path, "r", encoding="utf-8") as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return {"generation": 0, "segments": []}
+
+    def _write_manifest(self, manifest):
+        manifest.setdefault("corpus", corpus_of(manifest))
+        manifest["generation"] = manifest.get("generation", 0) + 1
+        manifest["updated_at"] = datetime.now().isoformat()
+        tmp_path = self._manifest_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fh:
+            json.dump(manifest, fh, ensure_ascii=False, indent=1)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp_path, self._manifest_path)
+        return manifest
+
+    def _segment_dir(self, entry):
+        return os.path.join(self.directory, entry["path"])
+
+    def _convert_pickled(self, source_dir, name, source):
+        """Convierte un índice guardado con FAISS.save_local al formato de segmento (una vez)."""
+        from langchain_community.vectorstores import FAISS
+
+        db = FAISS.load_local(source_dir, self.embeddings, allow_dangerous_deserialization=True)
+        index, documents = faiss_store_parts(db)
+        entry = {
+            "name": name,
+            "path": os.path.join(SEGMENTS_DIR, name),
+            "vectors": index.ntotal,
+            "index_type": index_type_of(index),
+            "source": source,
+            "created_at": datetime.now().isoformat(),
+        }
+        Segment.write(self._segment_dir(entry), index, documents)
+        print(f"📦 Índice con pickle convertido a segmento {name} ({index.ntotal} vectores)")
+        return entry
+
+    def _migrate_legacy(self):
+        """
+        Migra a segmentos sin pickle: el vector_db antiguo de la raíz y los
+        segmentos escritos con save_local. Los archivos de la raíz no se borran.
+        """
+        manifest = self._read_manifest()
+        root_legacy = (not os.path.exists(self._manifest_path)
+                       and os.path.exists(os.path.join(self.directory, LEGACY_PICKLE)))
+        pickled = [e for e in manifest.get("segments", []) if not has_docstore(self._segment_dir(e))]
+        if not root_legacy and not pickled:
+            return
+
+        with self._exclusive():
+            manifest = self._read_manifest()
+            changed = False
+            if not os.path.exists(self._manifest_path) and os.path.exists(os.path.join(self.directory, LEGACY_PICKLE)):
+                manifest["segments"] = [self._convert_pickled(self.directory, _new_segment_name("-legacy"), "vector_db")]
+                changed = True
+            upgraded = []
+            for entry in manifest.get("segments", []):
+                if has_docstore(self._segment_dir(entry)):
+                    upgraded.append(entry)
+                    continue
+                old_dir = self._segment_dir(entry)
+                new_entry = self._convert_pickled(old_dir, _new_segment_name("-legacy"), entry.get("source", ""))
+                upgraded.append(new_entry)
+                if os.path.abspath(old_dir) != os.path.abspath(self.directory):
+                    shutil.rmtree(old_dir, ignore_errors=True)
+                changed = True
+            if changed:
+                manifest["segments"] = upgraded
+                self._write_manifest(manifest)
+
+    def _manifest_stat(self):
+        try:
+            st = os.stat(self._manifest_path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _load_segment(self, entry):
+        # todo (también el BM25 en modo híbrido) queda abierto antes de publicar el snapshot
+        return Segment(self._segment_dir(entry), entry.get("index_type"), entry.get("vectors"), lexical=self.hybrid)
+
+    def refresh(self, force=False):
+        """
+        Si el manifest cambió, arma un Snapshot nuevo (reutilizando los segmentos
+        ya cargados) y lo publica. Sin `force`, si otro hilo ya está recargando
+        se vuelve enseguida y las búsquedas siguen con el snapshot actual.
+        """
+        now = time.monotonic()
+        if not force and now - self._last_check < self.refresh_interval:
+            return False
+        self._last_check = now
+        stat_key = self._manifest_stat()
+        if not force and stat_key == self._snapshot.stat:
+            return False
+        if not self._reload_lock.acquire(blocking=force):
+            return False
+        try:
+            current = self._snapshot
+            if not force and stat_key == current.stat:
+                return False
+            manifest = self._read_manifest()
+            loaded = {}
+            for entry in manifest.get("segments", []):
+                name = entry["name"]
+                if name in current.segments:
+                    loaded[name] = current.segments[name]
+                    continue
+                try:
+                    loaded[name] = self._load_segment(entry)
+                except Exception as e:
+                    # p. ej. fusionado y borrado por otro worker entre la lectura y la carga
+                    print(f"⚠ No se pudo cargar el segmento {name}: {e}")
+                    stat_key = None  # reintentar en el próximo refresh
+            # publicar: una sola asignación, las búsquedas en curso conservan el snapshot anterior
+            self._snapshot = Snapshot(manifest, loaded, stat_key)
+            for name, seg in current.segments.items():
+                if name not in loaded:
+                    # fusionado: quizá ya sin carpeta; sigue abierto para los snapshots viejos
+                    seg.retired = True
+            self.reloads += 1
+        finally:
+            self._reload_lock.release()
+        if current.generation != manifest.get("generation", 0):
+            print(f"🔄 Vector DB recargada: generación {manifest.get('generation', 0)}, {len(loaded)} segmentos")
+        return True
+
+    def start_watcher(self):
+        """
+        Lanza (una sola vez) el hilo que revisa el manifest cada `refresh_interval`
+        segundos y publica los snapshots nuevos. Con el vigilante activo las
+        búsquedas ya no revisan el manifest por su cuenta.
+        """
+        if self._watcher is not None:
+            return
+
+        def _loop():
+            while not self._closed.wait(self.refresh_interval):
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f"⚠ Error recargando la vector DB: {e}")
+
+        self._watcher = threading.Thread(target=_loop, name="vector-db-watcher", daemon=True)
+        self._watcher.start()
+
+    # ------------------------------------------------------------------
+    # Escritura
+    # ------------------------------------------------------------------
+    def _with_index_type(self, index):
+        """Reconstruye (y entrena) el índice si el tamaño del segmento pide otro tipo."""
+        wanted = choose_index_type(index.ntotal, self.index_type)
+        if index_type_of(index) == wanted:
+            return index
+        return build_index(extract_vectors(index), wanted)
+
+    def _write_segment(self, index, documents, source, suffix="", signatures=None, references=None, parents=None,
+                       **extra):
+        name = _new_segment_name(suffix)
+        entry = {
+            "name": name,
+            "path": os.path.join(SEGMENTS_DIR, name),
+            "vectors": index.ntotal,
+            "index_type": index_type_of(index),
+            "source": source,
+            "created_at": datetime.now().isoformat(),
+            **extra,
+        }
+        Segment.write(self._segment_dir(entry), index, documents, signatures, references, parents)
+        return entry
+
+    def add_segment(self, vectors, source="", signatures=None, references=None, parents=None):
+        """
+        Persiste `vectors` (un FAISS con los chunks de un documento) como segmento
+        nuevo y sube la versión del corpus en la misma escritura del manifest.
+        `signatures`/`references` vienen de ChunkDeduplicator; si todos los chunks
+        eran duplicados, `vectors` es None y el segmento solo lleva las referencias.
+        `parents` son las disposiciones a las que apunta metadata["parent_id"].
+        """
+        if vectors is None:
+            dimension = next((seg.index.d for seg in self._snapshot.segments.values()), None)
+            if dimension is None or not references:
+                raise ValueError("segmento sin vectores ni referencias")
+            index, documents = faiss.IndexFlatL2(dimension), []
+        else:
+            index, documents = faiss_store_parts(vectors)
+            index = self._with_index_type(index)
+        digest = content_hash(doc.page_content for doc in documents)
+        # el segmento se escribe completo antes de aparecer en el manifest
+        entry = self._write_segment(index, documents, source, signatures=signatures, references=references,
+                                    parents=parents, content_hash=digest)
+        with self._mutex, self._exclusive():
+            manifest = self._read_manifest()
+            previous = corpus_of(manifest)
+            manifest.setdefault("segments", []).append(entry)
+            manifest["corpus"] = {"generation": previous["generation"] + 1,
+                                  "content_hash": chain_hash(previous["content_hash"], digest)}
+            # el documento es una partición del segmento, con la versión del corpus que estrena
+            entry["partitions"] = [{"source": source, "corpus_id": format_corpus_id(manifest["corpus"]),
+                                    "generation": manifest["corpus"]["generation"],
+                                    "created_at": entry["created_at"], "start": 0, "stop": index.ntotal}]
+            self._write_manifest(manifest)
+        self.refresh(force=True)
+        return entry
+
+    def merge_small_segments(self):
+        """Fusiona los segmentos más pequeños si hay más de `max_segments`."""
+        with self._mutex, self._exclusive():
+            manifest = self._read_manifest()
+            segments = manifest.get("segments", [])
+            if len(segments) <= self.max_segments:
+                return 0
+            # la versión del corpus no cambia al fusionar (fijarla antes de renombrar segmentos)
+            manifest.setdefault("corpus", corpus_of(manifest))
+            victims = sorted(segments, key=lambda e: e.get("vectors", 0))
+            victims = victims[:len(segments) - self.max_segments // 2 + 1]
+
+            loaded = self._snapshot.segments
+            parts = [loaded.get(e["name"]) or Segment(self._segment_dir(e), e.get("index_type"))
+                     for e in victims]
+            for seg in parts:
+                seg.acquire()  # que un evict()/close() concurrente no los suelte a mitad de la fusión
+            try:
+                partitions, offset = [], 0
+                for entry, seg in zip(victims, parts):
+                    partitions.extend(shift_partitions(partitions_of(entry), offset))
+                    offset += seg.ntotal
+                vectors = np.vstack([extract_vectors(seg.index) for seg in parts])
+                documents, parents = [], []
+                for seg in parts:
+                    # los parent_id son posiciones dentro de cada segmento: desplazarlos al concatenar
+                    for doc in seg.docs:
+                        if doc.metadata.get("parent_id") is not None:
+                            doc.metadata["parent_id"] += len(parents)
+                        documents.append(doc)
+                    if seg.parents is not None:
+                        parents.extend(seg.parents)
+                signatures, references = {}, {}
+                for seg in parts:
+                    keys, rows = seg.signatures()
+                    signatures.update(zip(keys.tolist(), rows))
+                    for key, refs in seg.references.items():
+                        references.setdefault(key, []).extend(refs)
+                index = build_index(vectors, choose_index_type(len(vectors), self.index_type))
+            finally:
+                for seg in parts:
+                    seg.unpin()
+            new_entry = self._write_segment(index, documents, "merge", suffix="-m", signatures=signatures,
+                                            references=references, parents=parents,
+                                            merged=[e["name"] for e in victims], partitions=partitions)
+
+            victim_names = {e["name"] for e in victims}
+            manifest["segments"] = [e for e in segments if e["name"] not in victim_names] + [new_entry]
+            self._write_manifest(manifest)
+
+            # los workers que aún tengan estos archivos en mmap siguen leyéndolos sin problema
+            for entry in victims:
+                shutil.rmtree(self._segment_dir(entry), ignore_errors=True)
+        self.refresh(force=True)
+        print(f"🧱 {len(victims)} segmentos fusionados en {new_entry['name']} ({index.ntotal} vectores)")
+        return len(victims)
+
+    def start_merger(self):
+        """Lanza (una sola vez) el hilo que fusiona segmentos periódicamente."""
+        if self._merger is not None:
+            return
+
+        def _loop():
+            while not self._closed.wait(self.merge_interval):
+                try:
+                    self.merge_small_segments()
+                except Exception as e:
+                    print(f"⚠ Error fusionando segmentos: {e}")
+
+        self._merger = threading.Thread(target=_loop, daemon=True)
+        self._merger.start()
+
+    # ------------------------------------------------------------------
+    # Lectura
+    # ------------------------------------------------------------------
+    def snapshot(self):
+        """Snapshot vigente; sin vigilante en segundo plano, revisa antes el manifest."""
+        if self._watcher is None:
+            self.refresh()
+        return self._snapshot
+
+    def segments(self):
+        return list(self.snapshot().segments.values())
+
+    def existing_signatures(self):
+        """[(claves, firmas MinHash)] de los segmentos vigentes, para deduplicar una ingesta."""
+        return [seg.signatures() for seg in self.snapshot().segments.values()]
+
+    @staticmethod
+    def _decorate(snapshot, seg, doc):
+        """Añade al resultado las referencias de sus casi duplicados y el texto de su disposición padre."""
+        refs = snapshot.references.get(doc.metadata.get("dedup_key"))
+        if refs:
+            doc.metadata["references"] = refs
+        parent_id = doc.metadata.get("parent_id")
+        if parent_id is not None:
+            parent = seg.parent(parent_id)
+            if parent is not None:
+                doc.metadata["parent_content"] = parent.page_content
+        return doc
+
+    @staticmethod
+    def _selection(snapshot, filter):
+        """
+        ({nombre: Segment} a consultar, {nombre: [(inicio, fin)]} de los que solo
+        cuentan en parte) según el filtro de metadatos (ver chatbot/partitions.py).
+        Incluye los chunks canónicos cuyas referencias nombran un documento elegido.
+        """
+        spec = normalize_filter(filter)
+        if spec is None:
+            return snapshot.segments, {}
+        selection = select(snapshot.manifest, spec)
+        for name, positions in SegmentedVectorStore._referenced(snapshot, spec, selection).items():
+            selection[name] = add_positions(selection.get(name), positions)
+        segments = {name: seg for name, seg in snapshot.segments.items()
+                    if name in selection and selection[name] != []}
+        return segments, {name: selection[name] for name in segments if selection[name] is not None}
+
+    @staticmethod
+    def _referenced(snapshot, spec, selection):
+        """
+        {nombre: [posiciones]} de los chunks canónicos que la selección no cubre y
+        que representan a un chunk colapsado de un documento elegido.
+        """
+        references = snapshot.references
+        if not references:
+            return {}
+        sources = matching_sources(snapshot.manifest, spec)
+        keys = {key for key, refs in references.items() if any(ref.get("source") in sources for ref in refs)}
+        found = {}
+        if not keys:
+            return found
+        for name, seg in snapshot.segments.items():
+            if name in selection and selection[name] is None:
+                continue  # el segmento ya cuenta entero
+            positions = seg.dedup_positions()
+            hits = sorted(positions[key] for key in keys if key in positions)
+            if hits:
+                found[name] = hits
+        return found
+
+    @contextmanager
+    def _reading(self, filter=None):
+        """
+        (snapshot, {nombre: Segment}, rangos) de una búsqueda, con los segmentos
+        abiertos y fijados hasta que termina (evict/close no los sueltan antes).
+        Si uno liberado ya no se puede reabrir (otro worker lo fusionó y borró)
+        se recarga el manifest y se busca sobre el snapshot nuevo.
+        """
+        for attempt in range(3):
+            snapshot = self.snapshot()
+            pinned = []
+            try:
+                segments, ranges = self._selection(snapshot, filter)
+                for seg in segments.values():
+                    seg.acquire()
+                    pinned.append(seg)
+                break
+            except (SegmentGone, OSError) as e:
+                for seg in pinned:
+                    seg.unpin()
+                if attempt == 2:
+                    raise
+                print(f"⚠ Segmento fusionado mientras estaba liberado ({e}); recargando el manifest")
+                self.refresh(force=True)
+        try:
+            yield snapshot, segments, ranges
+        finally:
+            for seg in pinned:
+                seg.unpin()
+
+    def _vector_hits(self, segments, embeddings, k, nprobe, ef_search, ranges=None):
+        """
+        Top-k de cada fila de `embeddings`: una sola búsqueda matricial por segmento.
+        `ranges` {nombre: [(inicio, fin)]} limita las posiciones de esos segmentos.
+        """
+        queries = np.atleast_2d(np.asarray(embeddings, dtype="float32"))
+        hits = [[] for _ in range(len(queries))]
+        ranges = ranges or {}
+        for seg in segments:
+            if seg.ntotal == 0:
+                continue
+            seg_ranges = ranges.get(seg.name)
+            size = seg.ntotal if seg_ranges is None else sum(stop - start for start, stop in seg_ranges)
+            distances, ids = search(seg.index, queries, min(k, size),
+                                    nprobe=nprobe, ef_search=ef_search, ranges=seg_ranges)
+            for row, (row_distances, row_ids) in enumerate(zip(distances, ids)):
+                for distance, pos in zip(row_distances, row_ids):
+                    if pos >= 0:
+                        hits[row].append((seg.name, int(pos), float(distance)))
+        # todos los segmentos usan distancia L2: menor es mejor
+        for row_hits in hits:
+            row_hits.sort(key=lambda hit: hit[2])
+            del row_hits[k:]
+        return hits
+
+    def lexical_search(self, query, k=4, filter=None):
+        """Top-k BM25 sobre todos los segmentos (o los del filtro): [(Document, score)]."""
+        with self._reading(filter) as (snapshot, segments, ranges):
+            hits = bm25_search([(name, seg.bm25) for name, seg in segments.items()], query, k, ranges)
+            return [(self._decorate(snapshot, segments[name], segments[name].document(pos)), score)
+                    for name, pos, score in hits]
+
+    @staticmethod
+    def _vector(seg, pos):
+        """Vector guardado de un chunk, o None si el índice no permite reconstruirlo (solo lectura)."""
+        try:
+            return seg.index.reconstruct(pos)
+        except RuntimeError:
+            return None
+
+    @classmethod
+    def _distance(cls, seg, pos, embedding):
+        """Distancia L2 de un chunk encontrado solo por BM25 (para el filtro de score)."""
+        vector = cls._vector(seg, pos)
+        if vector is None:
+            return NEUTRAL_DISTANCE
+        diff = np.asarray(vector, dtype="float32") - np.asarray(embedding, dtype="float32").ravel()
+        return float(np.dot(diff, diff))
+
+    def _select(self, segments, candidates, k, embedding):
+        """Los k candidatos finales: en orden, o con MMR si `mmr_lambda` está configurado."""
+        if self.mmr_lambda is None or len(candidates) <= 1:
+            return candidates[:k]
+        vectors = [self._vector(segments[name], pos) for name, pos in candidates]
+        # relevancia = similitud coseno real con la pregunta, en la misma escala que la redundancia de mmr()
+        query = np.asarray(embedding, dtype="float32").ravel()
+        query = query / (np.linalg.norm(query) or 1.0)
+        relevance = [0.0 if vector is None else float(np.dot(query, vector) / (np.linalg.norm(vector) or 1.0))
+                     for vector in vectors]
+        return [candidates[i] for i in mmr(relevance, vectors, k, self.mmr_lambda)]
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, nprobe=None, ef_search=None,
+                                               query_text=None, filter=None):
+        """
+        Devuelve [(Document, distancia L2)]. Si se pasa `query_text` y el modo
+        híbrido está activo, el orden es la fusión RRF de vector + BM25 y cada
+        Document lleva metadata["retrieval"] = vector | lexical | both.
+        `filter` ({"document", "corpus", "since", "until"}) limita la búsqueda
+        a esas particiones; ValueError si el corpus no existe.
+        """
+        return self.similarity_search_with_score_by_vectors(
+            [embedding], k=k, nprobe=nprobe, ef_search=ef_search, query_texts=[query_text], filter=filter)[0]
+
+    def similarity_search_with_score_by_vectors(self, embeddings, k=4, nprobe=None, ef_search=None,
+                                                query_texts=None, filter=None):
+        """
+        Varias consultas a la vez (p. ej. /chat/batch): la parte vectorial es una
+        búsqueda matricial por segmento. Devuelve una lista de resultados por consulta.
+        """
+        if not len(embeddings):
+            return []
+        nprobe = nprobe or self.nprobe
+        ef_search = ef_search or self.ef_search
+        query_texts = query_texts or [None] * len(embeddings)
+        hybrid = self.hybrid and any(query_texts)
+        depth = max(k * 4, 20) if hybrid or self.mmr_lambda is not None else k
+        # toda la búsqueda sobre el mismo snapshot
+        with self._reading(filter) as (snapshot, segments, ranges):
+            all_hits = self._vector_hits(segments.values(), embeddings, depth, nprobe, ef_search, ranges)
+            return [
+                self._fuse(snapshot, segments, ranges, embedding, hits, query_text, k)
+                for embedding, hits, query_text in zip(embeddings, all_hits, query_texts)
+            ]
+
+    def _fuse(self, snapshot, segments, ranges, embedding, vector_hits, query_text, k):
+        if not (self.hybrid and query_text):
+            # el texto solo se lee del disco para los k finales
+            distances = {(name, pos): distance for name, pos, distance in vector_hits}
+            chosen = self._select(segments, [(name, pos) for name, pos, _ in vector_hits], k, embedding)
+            return [(self._decorate(snapshot, segments[name], segments[name].document(pos)), distances[(name, pos)])
+                    for name, pos in chosen]
+
+        depth = max(k * 4, 20)
+        lexical_hits = bm25_search([(name, seg.bm25) for name, seg in segments.items()], query_text, depth, ranges)
+        distances = {(name, pos): distance for name, pos, distance in vector_hits}
+        lexical_keys = {(name, pos) for name, pos, _ in lexical_hits}
+        fused = reciprocal_rank_fusion([
+            [(name, pos) for name, pos, _ in vector_hits],
+            [(name, pos) for name, pos, _ in lexical_hits],
+        ])
+
+        results = []
+        for name, pos in self._select(segments, fused[:depth], k, embedding):
+            seg = segments[name]
+            doc = self._decorate(snapshot, seg, seg.document(pos))
+            in_vector = (name, pos) in distances
+            in_lexical = (name, pos) in lexical_keys
+            doc.metadata["retrieval"] = "both" if in_vector and in_lexical else ("vector" if in_vector else "lexical")
+            distance = distances.get((name, pos))
+            if distance is None:
+                distance = self._distance(seg, pos, embedding)
+            results.append((doc, distance))
+        return results
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        embedding = self.embeddings.embed_query(query)
+        kwargs.setdefault("query_text", query)
+        return self.similarity_search_with_score_by_vector(embedding, k=k, **kwargs)
+
+    def __len__(self):
+        return sum(seg.ntotal for seg in self._snapshot.segments.values())
+
+    def corpus(self):
+        """Versión del corpus del snapshot vigente: {"generation", "content_hash"}."""
+        return corpus_of(self._snapshot.manifest)
+
+    def stats(self):
+        snapshot = self._snapshot
+        index_types = {}
+        for seg in snapshot.segments.values():
+            index_types[seg.kind] = index_types.get(seg.kind, 0) + 1
+        return {
+            "generation": snapshot.generation,
+            "corpus_generation": corpus_of(snapshot.manifest)["generation"],
+            "segments": len(snapshot.segments),
+            "vectors": sum(seg.ntotal for seg in snapshot.segments.values()),
+            "resident_segments": sum(seg.resident for seg in snapshot.segments.values()),
+            "resident_bytes": self.resident_bytes(),
+            "index_types": index_types,
+            "reloads": self.reloads,
+            "snapshot_age": round(time.time() - snapshot.loaded_at, 1),
+        }
+
+    # ------------------------------------------------------------------
+    # Particiones
+    # ------------------------------------------------------------------
+    def check_filter(self, filter):
+        """Filtro normalizado (o None); ValueError si una fecha no es ISO o el corpus no existe."""
+        spec = normalize_filter(filter)
+        if spec is not None:
+            select(self._snapshot.manifest, spec)
+        return spec
+
+    def resident_bytes(self):
+        return sum(seg.disk_bytes for seg in self._snapshot.segments.values() if seg.resident)
+
+    def close(self):
+        """
+        Detiene los hilos de recarga y fusión (espera a que terminen, también una
+        fusión en curso) y suelta los segmentos; los que estén en una búsqueda se
+        sueltan cuando esta termina. Todo queda en disco.
+        """
+        self._closed.set()
+        for thread in (self._watcher, self._merger):
+            if thread is not None and thread is not threading.current_thread():
+                thread.join()
+        for seg in self._snapshot.segments.values():
+            seg.release()
+
+    def partitions(self):
+        """Particiones (documentos) del snapshot vigente con su segmento y si está en memoria."""
+        snapshot = self._snapshot
+        listing = []
+        for entry in snapshot.manifest.get("segments", []):
+            seg = snapshot.segments.get(entry["name"])
+            for partition in partitions_of(entry):
+                listing.append({**partition, "vectors": partition["stop"] - partition["start"],
+                                "segment": entry["name"], "index_type": entry.get("index_type"),
+                                "resident": seg is not None and seg.resident})
+        return listing
+
+    def evict(self, document=None):
+        """
+        Libera de la memoria los segmentos que contienen `document` (o todos).
+        No borra nada: la siguiente búsqueda que los necesite los vuelve a abrir.
+        Devuelve los nombres de los segmentos liberados.
+        """
+        snapshot = self._snapshot
+        # solo los que siguen en el manifest del disco: uno ya fusionado no podría reabrirse
+        live = {entry["name"] for entry in self._read_manifest().get("segments", [])}
+        released = []
+        for entry in snapshot.manifest.get("segments", []):
+            seg = snapshot.segments.get(entry["name"])
+            if seg is None or entry["name"] not in live:
+                continue
+            if document is not None and all(p.get("source") != document for p in partitions_of(entry)):
+                continue
+            if seg.release():
+                released.append(entry["name"])
+        if released:
+            print(f"📤 {len(released)} segmentos liberados de la memoria")
+        return released
@@ -0,0 +1,187 @@
+# chatbot/semantic_cache.py
+# ==========================================================
+# 🧠 CACHE SEMÁNTICO DE RESPUESTAS
+# Guarda el embedding de cada pregunta cacheada en un índice FAISS
+# pequeño por corpus_id (producto interno sobre vectores normalizados
+# = similitud coseno). Si una pregunta nueva es lo bastante parecida a
+# una ya respondida, se reutiliza la respuesta sin búsqueda ni LLM.
+# Cada ingesta estrena corpus_id (y por tanto espacio): los índices se
+# guardan en un LRU de `max_namespaces` para que los de versiones
+# viejas del corpus no se acumulen en la memoria del worker.
+# Las entradas de otros workers se incorporan siguiendo el log del
+# cache compartido desde el último offset leído, como mucho cada
+# `sync_interval` segundos; solo el primer uso de un espacio en el
+# worker recorre el cache completo.
+# ==========================================================
+import base64
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+
+def encode_vector(vector):
+    """Serializa un embedding como base64 de float32 (compacto para el cache en disco)."""
+    arr = np.asarray(vector, dtype="float32").ravel()
+    return base64.b64encode(arr.tobytes()).decode("ascii")
+
+
+def decode_vector(data):
+    return np.frombuffer(base64.b64decode(data), dtype="float32")
+
+
+def _normalize(vector):
+    arr = np.asarray(vector, dtype="float32").reshape(1, -1).copy()
+    norm = np.linalg.norm(arr)
+    if norm > 0:
+        arr /= norm
+    return arr
+
+
+class SemanticCache:
+    """
+    Índices FAISS (IndexFlatIP) por corpus con las preguntas ya respondidas.
+    `threshold` es la similitud coseno mínima para servir una respuesta;
+    las consultas que quedan a menos de `near_miss_margin` cuentan como
+    casi-aciertos (útil para calibrar el umbral).
+    """
+
+    def __init__(self, threshold=0.95, near_miss_margin=0.03, candidates=3, max_namespaces=32, sync_interval=5):
+        self.threshold = threshold
+        self.near_miss_margin = near_miss_margin
+        self.candidates = candidates
+        self.max_namespaces = max_namespaces
+        self.sync_interval = sync_interval
+        self._indexes = OrderedDict()  # corpus_id -> {"index", "keys", "seen"}, el menos usado primero
+        self._lock = threading.Lock()
+        self._cursors = None  # posición en el log del cache compartido (CacheStore.records_since)
+        self._synced_at = None
+        self.hits = 0
+        self.misses = 0
+        self.near_misses = 0
+        self.evicted_namespaces = 0
+
+    def _partition(self, corpus_id):
+        part = self._indexes.get(corpus_id)
+        if part is None:
+            part = {"index": None, "keys": [], "seen": set()}  # el índice se crea con el primer vector
+            self._indexes[corpus_id] = part
+            while len(self._indexes) > self.max_namespaces:
+                self._indexes.popitem(last=False)
+                self.evicted_namespaces += 1
+        self._indexes.move_to_end(corpus_id)
+        return part
+
+    def add(self, corpus_id, key, vector):
+        if faiss is None or vector is None:
+            return
+        arr = _normalize(vector)
+        with self._lock:
+            part = self._partition(corpus_id)
+            if part["index"] is None:
+                part["index"] = faiss.IndexFlatIP(arr.shape[1])
+            if key in part["seen"] or part["index"].d != arr.shape[1]:
+                return
+            part["index"].add(arr)
+            part["keys"].append(key)
+            part["seen"].add(key)
+
+    def sync(self, corpus_id, entries):
+        """Indexa entradas del cache compartido (p. ej. escritas por otros workers)."""
+        for key, entry in entries:
+            if entry.get("corpus_id") != corpus_id or not entry.get("query_embedding"):
+                continue
+            with self._lock:
+                part = self._indexes.get(corpus_id)
+                if part is not None and key in part["seen"]:
+                    continue
+            try:
+                self.add(corpus_id, key, decode_vector(entry["query_embedding"]))
+            except Exception:
+                continue
+
+    def refresh(self, corpus_id, store):
+        """
+        Pone al día el espacio `corpus_id` con lo que otros workers escribieron
+        en `store` (CacheStore). La primera vez que el worker usa el espacio lo
+        indexa recorriendo el cache; después solo lee los registros nuevos del
+        log, como mucho una vez cada `sync_interval` segundos.
+        """
+        if faiss is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            known = corpus_id in self._indexes
+            if not known:
+                self._partition(corpus_id)
+            due = self._synced_at is None or now - self._synced_at >= self.sync_interval
+            if due:
+                self._synced_at = now
+            cursors = self._cursors
+        if not known:
+            self.sync(corpus_id, store.items())
+        if not due:
+            return
+        records, cursors = store.records_since(cursors)
+        with self._lock:
+            self._cursors = cursors
+            namespaces = set(self._indexes)
+        # los espacios que este worker aún no usa se indexarán completos cuando los use
+        for namespace in namespaces:
+            self.sync(namespace, records)
+
+    def lookup(self, corpus_id, vector, resolve):
+        """
+        Busca la pregunta más parecida del corpus. `resolve(key)` debe devolver
+        el payload cacheado o None (p. ej. si ya fue desalojado).
+        Devuelve (payload, similitud) o (None, mejor_similitud).
+        """
+        if faiss is None or vector is None:
+            return None, 0.0
+        arr = _normalize(vector)
+        with self._lock:
+            part = self._indexes.get(corpus_id)
+            index = part["index"] if part is not None else None
+            if index is None or index.ntotal == 0 or index.d != arr.shape[1]:
+                self.misses += 1
+                return None, 0.0
+            self._indexes.move_to_end(corpus_id)
+            k = min(self.candidates, part["index"].ntotal)
+            sims, ids = part["index"].search(arr, k)
+            keys = [part["keys"][i] if i >= 0 else None for i in ids[0]]
+
+        best = float(sims[0][0]) if len(sims[0]) else 0.0
+        for sim, key in zip(sims[0], keys):
+            if key is None or sim < self.threshold:
+                break
+            payload = resolve(key)
+            if payload is not None:
+                self.hits += 1
+                return payload, float(sim)
+
+        if self.threshold - self.near_miss_margin <= best < self.threshold:
+            self.near_misses += 1
+        else:
+            self.misses += 1
+        return None, best
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.near_misses
+        with self._lock:
+            entries = {cid: part["index"].ntotal if part["index"] is not None else 0
+                       for cid, part in self._indexes.items()}
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "near_misses": self.near_misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "threshold": self.threshold,
+            "entries": entries,
+            "evicted_namespaces": self.evicted_namespaces,
+        }
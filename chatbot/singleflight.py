@@ -0,0 +1,118 @@
+# chatbot/singleflight.py
+# ==========================================================
+# 🛬 COALESCENCIA DE PETICIONES EN VUELO (SINGLE-FLIGHT)
+# Si varias peticiones con la misma cache_key llegan a la vez, solo
+# la primera llama al LLM; las demás esperan a que termine y luego
+# leen la respuesta del cache compartido.
+# Funciona entre hilos (threading.Lock por key) y entre workers de
+# gunicorn (flock sobre un archivo de bloqueo por key, nombrado por su
+# hash y borrado al liberar). Sin `lock_dir` se comporta como sustituto
+# solo en proceso, útil para pruebas.
+# ==========================================================
+import hashlib
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: solo coalescencia dentro del proceso
+    fcntl = None
+
+
+class SingleFlight:
+    """
+    `with flight.claim(key) as waited:` — `waited` es True si otra petición
+    tenía la key en vuelo y ya terminó (hay que revisar el cache antes de
+    generar de nuevo). Si la espera supera `wait_timeout`, se continúa sin
+    bloqueo para no colgar la petición.
+    """
+
+    def __init__(self, lock_dir=None, wait_timeout=60, poll_interval=0.05):
+        self.lock_dir = str(lock_dir) if lock_dir else None
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self._guard = threading.Lock()
+        self._locks = {}  # key -> [threading.Lock, refcount]
+        self.coalesced = 0
+        if self.lock_dir:
+            os.makedirs(self.lock_dir, exist_ok=True)
+
+    def _thread_lock(self, key):
+        with self._guard:
+            slot = self._locks.setdefault(key, [threading.Lock(), 0])
+            slot[1] += 1
+            return slot[0]
+
+    def _release_thread_lock(self, key):
+        with self._guard:
+            slot = self._locks.get(key)
+            if slot is None:
+                return
+            slot[1] -= 1
+            if slot[1] <= 0:
+                self._locks.pop(key, None)
+
+    def _lock_path(self, key):
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.lock_dir, f"inflight-{digest}.lock")
+
+    def _acquire_file_lock(self, key, deadline):
+        """Devuelve (handle, waited). handle es None si no hay bloqueo entre procesos."""
+        if not self.lock_dir or fcntl is None:
+            return None, False
+        path = self._lock_path(key)
+        waited = False
+        while True:
+            fh = open(path, "a")
+            try:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                fh.close()
+                waited = True
+                if time.monotonic() >= deadline:
+                    return None, waited
+                time.sleep(self.poll_interval)
+                continue
+            # el dueño anterior pudo borrar el archivo entre open() y flock():
+            # solo vale el bloqueo si sigue siendo el archivo de la ruta
+            try:
+                current = os.stat(path)
+            except FileNotFoundError:
+                current = None
+            if current is not None and os.path.samestat(current, os.fstat(fh.fileno())):
+                return fh, waited
+            fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+            fh.close()
+
+    def _release_file_lock(self, key, fh):
+        # se borra antes de soltar el flock: quien espere reabre un archivo nuevo
+        try:
+            os.unlink(self._lock_path(key))
+        except FileNotFoundError:
+            pass
+        fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+        fh.close()
+
+    @contextmanager
+    def claim(self, key):
+        deadline = time.monotonic() + self.wait_timeout
+        lock = self._thread_lock(key)
+        waited = not lock.acquire(blocking=False)
+        acquired = True
+        if waited:
+            acquired = lock.acquire(timeout=self.wait_timeout)
+        fh = None
+        try:
+            fh, waited_file = self._acquire_file_lock(key, deadline)
+            waited = waited or waited_file
+            if waited:
+                self.coalesced += 1
+            yield waited
+        finally:
+            if fh is not None:
+                self._release_file_lock(key, fh)
+            if acquired:
+                lock.release()
+            self._release_thread_lock(key)
@@ -0,0 +1,78 @@
+# chatbot/startup_bench.py
+# ==========================================================
+# ⏱️ BENCHMARK DE ARRANQUE
+# Mide en procesos nuevos (arranque en frío de verdad, como un worker
+# de gunicorn reciclado por max_requests):
+#   import_s         → importar main
+#   first_request_s  → primera petición a /chat (saludo: modelo de clústers)
+#   readyz_s         → warm-up completo vía /readyz (vector DB incluida)
+#   second_request_s → la misma petición ya en caliente
+#
+#   python -m chatbot.startup_bench --runs 5
+# ==========================================================
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+PROBE = r"""
+import json, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+client = main.app.test_client()
+client.post("/chat", data={"message": "hola"})
+first = time.perf_counter()
+ready = client.get("/readyz")
+warmed = time.perf_counter()
+client.post("/chat", data={"message": "hola"})
+second = time.perf_counter()
+print("@@" + json.dumps({
+    "import_s": imported - started,
+    "first_request_s": first - imported,
+    "readyz_s": warmed - first,
+    "second_request_s": second - warmed,
+    "ready": ready.status_code == 200,
+}))
+"""
+
+METRICS = ("import_s", "first_request_s", "readyz_s", "second_request_s")
+
+
+def run_once(cwd):
+    result = subprocess.run([sys.executable, "-c", PROBE], cwd=cwd, capture_output=True, text=True,
+                            env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"})
+    for line in result.stdout.splitlines():
+        if line.startswith("@@"):
+            return json.loads(line[2:])
+    raise RuntimeError(f"La sonda de arranque falló:\n{result.stderr[-2000:]}")
+
+
+def benchmark(runs=3, cwd=None):
+    """Mediana y máximo de cada métrica sobre `runs` procesos nuevos."""
+    cwd = cwd or os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    samples = [run_once(cwd) for _ in range(runs)]
+    report = {}
+    for metric in METRICS:
+        values = [s[metric] for s in samples]
+        report[metric] = {"median": round(statistics.median(values), 3), "max": round(max(values), 3)}
+    report["ready"] = all(s["ready"] for s in samples)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Latencia de import en frío y de la primera petición")
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    report = benchmark(args.runs)
+    print(f"⏱️ Arranque ({args.runs} procesos nuevos, mediana / máximo):")
+    for metric in METRICS:
+        print(f"  {metric:<17} {report[metric]['median']:.3f}s / {report[metric]['max']:.3f}s")
+    print(f"  /readyz listo: {'sí' if report['ready'] else 'no'}")
+
+
+if __name__ == "__main__":
+    main()
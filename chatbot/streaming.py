@@ -0,0 +1,143 @@
+# chatbot/streaming.py
+# ==========================================================
+# 📡 UTILIDADES PARA RESPUESTAS EN STREAMING (SSE)
+# Formatea eventos Server-Sent Events y parsea de forma tolerante
+# el JSON estructurado que el LLM va generando token a token.
+# ==========================================================
+import json
+import re
+
+_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+_LITERAL_RE = re.compile(r"-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?|true|false|null")
+
+
+def format_sse(event, data):
+    """
+    Serializa un evento SSE (`event:` + `data:` en JSON) listo para enviar al cliente.
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class _PartialScanner:
+    """Recorre un JSON posiblemente incompleto devolviendo (valor, completo)."""
+
+    def __init__(self, text, pos=0):
+        self.text = text
+        self.pos = pos
+        self.n = len(text)
+
+    def _skip_ws(self):
+        while self.pos < self.n and self.text[self.pos] in " \t\r\n":
+            self.pos += 1
+
+    def value(self):
+        self._skip_ws()
+        if self.pos >= self.n:
+            return None, False
+        ch = self.text[self.pos]
+        if ch == "{":
+            return self.obj()
+        if ch == "[":
+            return self.array()
+        if ch == '"':
+            return self.string()
+        m = _LITERAL_RE.match(self.text, self.pos)
+        if not m or m.end() >= self.n:
+            # literal al final del buffer: todavía puede crecer
+            return None, False
+        self.pos = m.end()
+        return json.loads(m.group(0)), True
+
+    def string(self):
+        self.pos += 1  # comilla de apertura
+        out = []
+        while self.pos < self.n:
+            ch = self.text[self.pos]
+            if ch == '"':
+                self.pos += 1
+                return "".join(out), True
+            if ch == "\\":
+                if self.pos + 1 >= self.n:
+                    break
+                esc = self.text[self.pos + 1]
+                if esc == "u":
+                    code = self.text[self.pos + 2:self.pos + 6]
+                    if len(code) < 4:
+                        break
+                    try:
+                        out.append(chr(int(code, 16)))
+                    except ValueError:
+                        out.append(code)
+                    self.pos += 6
+                    continue
+                out.append(_ESCAPES.get(esc, esc))
+                self.pos += 2
+                continue
+            out.append(ch)
+            self.pos += 1
+        return "".join(out), False
+
+    def array(self):
+        self.pos += 1
+        items = []
+        while True:
+            self._skip_ws()
+            if self.pos >= self.n:
+                return items, False
+            ch = self.text[self.pos]
+            if ch == "]":
+                self.pos += 1
+                return items, True
+            if ch == ",":
+                self.pos += 1
+                continue
+            item, complete = self.value()
+            if not complete:
+                # solo se exponen los elementos ya cerrados
+                return items, False
+            items.append(item)
+
+    def obj(self):
+        self.pos += 1
+        result = {}
+        while True:
+            self._skip_ws()
+            if self.pos >= self.n:
+                return result, False
+            ch = self.text[self.pos]
+            if ch == "}":
+                self.pos += 1
+                return result, True
+            if ch == ",":
+                self.pos += 1
+                continue
+            if ch != '"':
+                return result, False
+            key, complete = self.string()
+            if not complete:
+                return result, False
+            self._skip_ws()
+            if self.pos >= self.n or self.text[self.pos] != ":":
+                return result, False
+            self.pos += 1
+            value, complete = self.value()
+            if value is not None or complete:
+                result[key] = value
+            if not complete:
+                return result, False
+
+
+def parse_partial_json(text):
+    """
+    Parsea el primer objeto JSON de `text` aunque esté incompleto.
+    Las cadenas pueden venir truncadas; de las listas solo se devuelven
+    los elementos ya cerrados. Devuelve {} si aún no hay objeto.
+    """
+    start = text.find("{")
+    if start == -1:
+        return {}
+    try:
+        value, _ = _PartialScanner(text, start).value()
+    except Exception:
+        return {}
+    return value if isinstance(value, dict) else {}
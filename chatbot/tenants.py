@@ -0,0 +1,132 @@
+# chatbot/tenants.py
+# ==========================================================
+# 🏢 VECTOR DB POR TENANT (LRU DE ÍNDICES RESIDENTES)
+# Cada tenant (un despacho, un cliente) tiene su propia vector DB por
+# segmentos en <root>/<tenant>/, con su manifest y su corpus_id: sus
+# búsquedas no ven documentos de otros y su versión del corpus no
+# invalida cachés ajenos. Los stores se abren bajo demanda y se
+# guardan en un LRU:
+#   - como mucho `max_resident` tenants abiertos a la vez
+#   - como mucho `max_bytes` de segmentos abiertos (índices en mmap,
+#     BM25, offsets del docstore) sumando todos los tenants
+# Al pasarse se cierra el menos usado: se espera a que terminen sus
+# hilos y se sueltan sus segmentos (los que esté usando una búsqueda
+# en curso, cuando esta acaba). Todo sigue en disco (los segmentos se
+# escriben completos en la ingesta), así que un tenant inactivo no
+# ocupa RAM y vuelve a abrirse en su próxima pregunta.
+# El tenant por defecto (sin identificador) sigue siendo la vector DB
+# global de main.py y no cuenta en el LRU.
+# ==========================================================
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from chatbot.segments import MANIFEST_NAME
+
+TENANT_ID = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]{0,63}$")
+
+
+def check_tenant(tenant):
+    """Identificador de tenant válido (también como nombre de carpeta), o ValueError."""
+    if not isinstance(tenant, str) or not TENANT_ID.match(tenant) or ".." in tenant:
+        raise ValueError("tenant inválido: letras, números, '_', '-' o '.', hasta 64 caracteres")
+    return tenant
+
+
+class TenantStores:
+    """LRU de vector stores por tenant. `open_store(directorio)` crea el store."""
+
+    def __init__(self, root, open_store, max_resident=8, max_bytes=0):
+        self.root = str(root)
+        self.open_store = open_store
+        self.max_resident = max_resident
+        self.max_bytes = max_bytes  # 0: sin techo de memoria
+        self._stores = OrderedDict()
+        self._lock = threading.RLock()
+        self.opened = 0
+        self.evictions = 0
+
+    def path(self, tenant):
+        return os.path.join(self.root, check_tenant(tenant))
+
+    def exists(self, tenant):
+        return os.path.exists(os.path.join(self.path(tenant), MANIFEST_NAME))
+
+    def any_on_disk(self):
+        """True si algún tenant ya tiene vector DB en disco."""
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return False
+        return any(os.path.exists(os.path.join(self.root, name, MANIFEST_NAME)) for name in names)
+
+    def get(self, tenant, create=False):
+        """
+        Store del tenant, abierto si hace falta. Sin `create`, un tenant que
+        todavía no subió documentos devuelve None (no se crea nada en disco).
+        """
+        path = self.path(tenant)
+        with self._lock:
+            store = self._stores.get(tenant)
+            if store is None:
+                if not create and not self.exists(tenant):
+                    return None
+                store = self.open_store(path)
+                self._stores[tenant] = store
+                self.opened += 1
+                print(f"🏢 Vector DB del tenant {tenant} abierta ({len(self._stores)} residentes)")
+            self._stores.move_to_end(tenant)
+            closing = self._enforce(keep=tenant)
+        # cerrar espera a los hilos del store: fuera del lock para no frenar a los demás tenants
+        self._close(closing)
+        return store
+
+    def resident_bytes(self):
+        with self._lock:
+            return sum(store.resident_bytes() for store in self._stores.values())
+
+    def _enforce(self, keep=None):
+        """
+        Saca del LRU los tenants menos usados hasta respetar los límites (nunca
+        `keep`) y los devuelve [(tenant, store)] para cerrarlos fuera del lock.
+        """
+        closing = []
+        while len(self._stores) > 1:
+            over_count = len(self._stores) > self.max_resident
+            over_memory = self.max_bytes and self.resident_bytes() > self.max_bytes
+            if not (over_count or over_memory):
+                break
+            oldest = next(iter(self._stores))
+            if oldest == keep:
+                break
+            closing.append((oldest, self._stores.pop(oldest)))
+            self.evictions += 1
+        return closing
+
+    @staticmethod
+    def _close(closing):
+        # las búsquedas en curso sobre el store terminan antes de soltar sus segmentos
+        for tenant, store in closing:
+            store.close()
+            print(f"📤 Vector DB del tenant {tenant} liberada de la memoria")
+
+    def evict(self, tenant=None):
+        """Cierra un tenant (o todos). Devuelve los tenants liberados."""
+        with self._lock:
+            names = [tenant] if tenant is not None else list(self._stores)
+            closing = [(name, self._stores.pop(name)) for name in names if name in self._stores]
+            self.evictions += len(closing)
+        self._close(closing)
+        return [name for name, _ in closing]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "resident": list(self._stores),
+                "resident_bytes": self.resident_bytes(),
+                "max_resident": self.max_resident,
+                "max_bytes": self.max_bytes,
+                "opened": self.opened,
+                "evictions": self.evictions,
+            }
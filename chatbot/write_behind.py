@@ -0,0 +1,267 @@
+# chatbot/write_behind.py
+# ==========================================================
+# 📮 PERSISTENCIA WRITE-BEHIND PARA SUPABASE
+# Las peticiones ya no esperan a Supabase: las filas (conversations,
+# documents, analytics) se encolan en memoria y un hilo las escribe
+# en lotes, una inserción por tabla, cuando se juntan `max_batch`
+# filas o pasan `flush_interval` segundos.
+# Si Supabase no responde, el lote se escribe en un journal local
+# (JSON Lines, un archivo por proceso) y se reintenta más tarde; cada
+# worker reclama los archivos pendientes renombrándolos bajo flock,
+# así que dos workers nunca repiten el mismo journal. Mientras dura la
+# caída las filas nuevas van directo al journal, sin esperar timeouts.
+# Las filas llevan su id y el sink hace upsert ignorando duplicados:
+# un replay parcial no duplica nada.
+# ==========================================================
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+from collections import deque
+
+try:
+    import fcntl
+except ImportError:  # Windows: el journal solo se protege dentro del proceso
+    fcntl = None
+
+STALE_REPLAY_SECONDS = 300  # un replay- más viejo que esto es de un proceso que murió
+
+
+def _open_locked(path, mode):
+    """Abre `path` con flock exclusivo, o None si ya no existe o se renombró mientras se esperaba."""
+    while True:
+        try:
+            fh = open(path, mode, encoding="utf-8")
+        except FileNotFoundError:
+            return None
+        if fcntl is None:
+            return fh
+        fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+        try:
+            if os.fstat(fh.fileno()).st_ino == os.stat(path).st_ino:
+                return fh
+        except FileNotFoundError:
+            pass
+        fh.close()
+        if mode == "r":
+            return None
+
+
+class WriteBehindQueue:
+    """
+    `sink(table, rows)` escribe un lote y lanza excepción si el destino no
+    está disponible (el lote va al journal). Si devuelve False, el destino
+    no está configurado y las filas se descartan.
+    """
+
+    def __init__(self, sink, journal_dir, max_batch=50, flush_interval=2.0,
+                 retry_interval=30.0, max_buffer=5000):
+        self.sink = sink
+        self.journal_dir = str(journal_dir)
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.retry_interval = retry_interval
+        self.max_buffer = max_buffer
+        self._buffer = deque()
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()  # un solo vaciado a la vez (hilo o flush() explícito)
+        self._journal_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self._retry_at = 0.0
+        self.enqueued = 0
+        self.written = 0
+        self.batches = 0
+        self.spilled = 0
+        self.replayed = 0
+        self.dropped = 0
+        self.failures = 0
+        self.last_error = None
+
+    # ---------- productor (hilo de la petición) ----------
+    def enqueue(self, table, row):
+        """Encola una fila; nunca hace E/S de red en el hilo llamador."""
+        overflow = []
+        with self._cond:
+            self._buffer.append((table, row))
+            self.enqueued += 1
+            # si el hilo no da abasto, lo más viejo va al journal en vez de crecer sin límite
+            while len(self._buffer) > self.max_buffer:
+                overflow.append(self._buffer.popleft())
+            if len(self._buffer) >= self.max_batch:
+                self._cond.notify()
+        if overflow:
+            self._spill(overflow)
+        self._ensure_thread()
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            with self._cond:
+                if self._thread is None and not self._closed:
+                    self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+                    self._thread.start()
+                    atexit.register(self.close)
+
+    # ---------- consumidor ----------
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed and len(self._buffer) < self.max_batch:
+                    self._cond.wait(self.flush_interval)
+                closed = self._closed
+            self.flush()
+            if closed:
+                return
+
+    def _drain(self):
+        with self._cond:
+            items = list(self._buffer)
+            self._buffer.clear()
+        return items
+
+    def flush(self):
+        """Escribe lo encolado (y, si toca, reintenta el journal). Devuelve las filas escritas."""
+        with self._flush_lock:
+            items = self._drain()
+            if time.monotonic() < self._retry_at:
+                # el destino falló hace poco: al journal sin intentar
+                if items:
+                    self._spill(items)
+                return 0
+            written, failed = self._write(items)
+            if failed:
+                self._spill(failed)
+            else:
+                written += self._replay()
+            return written
+
+    def _write(self, items):
+        """Escribe `items` por tabla. Devuelve (filas escritas, filas que fallaron)."""
+        by_table = {}
+        for table, row in items:
+            by_table.setdefault(table, []).append(row)
+        written, failed = 0, []
+        for table, rows in by_table.items():
+            for start in range(0, len(rows), self.max_batch):
+                chunk = rows[start:start + self.max_batch]
+                if failed:
+                    # el destino ya falló en este vaciado: no insistir con cada lote
+                    failed.extend((table, row) for row in chunk)
+                    continue
+                try:
+                    result = self.sink(table, chunk)
+                except Exception as e:
+                    self.failures += 1
+                    self.last_error = f"{type(e).__name__}: {e}"
+                    self._retry_at = time.monotonic() + self.retry_interval
+                    print(f"⚠ Supabase no disponible, {len(chunk)} filas de {table} al journal: {e}")
+                    failed.extend((table, row) for row in chunk)
+                    continue
+                if result is False:
+                    self.dropped += len(chunk)
+                    continue
+                self.batches += 1
+                written += len(chunk)
+        self.written += written
+        return written, failed
+
+    # ---------- journal ----------
+    def _journal_path(self):
+        return os.path.join(self.journal_dir, f"pending-{os.getpid()}.jsonl")
+
+    def _spill(self, items):
+        os.makedirs(self.journal_dir, exist_ok=True)
+        data = "".join(json.dumps({"table": table, "row": row}, ensure_ascii=False) + "\n" for table, row in items)
+        with self._journal_lock:
+            fh = _open_locked(self._journal_path(), "a")
+            try:
+                fh.write(data)
+                fh.flush()
+                os.fsync(fh.fileno())
+            finally:
+                fh.close()
+        self.spilled += len(items)
+
+    def _claim_journals(self):
+        """Renombra los journals pendientes (de cualquier worker) para procesarlos en exclusiva."""
+        paths = glob.glob(os.path.join(self.journal_dir, "pending-*.jsonl"))
+        stale = time.time() - STALE_REPLAY_SECONDS
+        for path in glob.glob(os.path.join(self.journal_dir, "replay-*.jsonl")):
+            try:
+                if os.path.getmtime(path) < stale:
+                    paths.append(path)
+            except OSError:
+                continue
+        claimed = []
+        for path in paths:
+            fh = _open_locked(path, "r")
+            if fh is None:
+                continue  # otro worker lo reclamó primero
+            try:
+                target = os.path.join(self.journal_dir, f"replay-{os.getpid()}-{time.time_ns()}.jsonl")
+                os.rename(path, target)
+                os.utime(target)  # el mtime marca desde cuándo está reclamado
+                claimed.append(target)
+            except OSError:
+                continue
+            finally:
+                fh.close()
+        return claimed
+
+    def _replay(self):
+        if not os.path.isdir(self.journal_dir):
+            return 0
+        written = 0
+        for path in self._claim_journals():
+            items = []
+            with open(path, "r", encoding="utf-8") as fh:
+                for line in fh:
+                    try:
+                        entry = json.loads(line)
+                        items.append((entry["table"], entry["row"]))
+                    except (ValueError, KeyError):
+                        continue  # línea truncada por un corte a mitad de escritura
+            if time.monotonic() < self._retry_at:
+                done, failed = 0, items  # falló un archivo anterior: devolverlo todo al journal
+            else:
+                done, failed = self._write(items)
+            if failed:
+                self._spill(failed)
+            os.remove(path)
+            self.replayed += done
+            written += done
+            if done:
+                print(f"📮 Reenviadas {done} filas pendientes del journal a Supabase")
+        return written
+
+    def pending_journal_rows(self):
+        total = 0
+        for path in glob.glob(os.path.join(self.journal_dir, "*.jsonl")):
+            try:
+                with open(path, "rb") as fh:
+                    total += sum(1 for _ in fh)
+            except OSError:
+                continue
+        return total
+
+    # ---------- ciclo de vida ----------
+    def close(self, timeout=5.0):
+        """Vacía lo pendiente (al salir del proceso); lo que no se pueda escribir queda en el journal."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+        if self._buffer:
+            self.flush()
+
+    def stats(self):
+        with self._cond:
+            queued = len(self._buffer)
+        return {"queued": queued, "enqueued": self.enqueued, "written": self.written, "batches": self.batches,
+                "spilled": self.spilled, "replayed": self.replayed, "dropped": self.dropped,
+                "failures": self.failures, "journal_rows": self.pending_journal_rows(),
+                "last_error": self.last_error}
@@ -32,4 +32,11 @@ worker_tmp_dir = '/dev/shm'
 # Security
 limit_request_line = 4096
 limit_request_fields = 100
-limit_request_field_size = 8190
\ No newline at end of file
+limit_request_field_size = 8190
+
+
+def post_fork(server, worker):
+    # Con preload_app main se importa en el master: los hilos de mantenimiento
+    # (compactador del cache) se arrancan en cada worker, que es quien sirve
+    import main
+    main.CACHE_MAINTENANCE.get()
@@ -2,7 +2,7 @@
 # main.py — Chatbot con GPT + RAG + FAISS (2025)
 # ==========================================================
 
-from flask import Flask, render_template, request, jsonify
+from flask import Blueprint, Flask, Response, current_app, render_template, request, jsonify, stream_with_context
 import os
 import random
 import json
@@ -10,13 +10,15 @@ import re
 import time
 import hashlib
 from pathlib import Path
+from types import SimpleNamespace
 import uuid
+import threading
+import contextlib
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-try:
-    from supabase import create_client, Client
-except Exception:
-    create_client = None
-    Client = None
+
+import click
 
 # ==========================================================
 # 🔐 VARIABLES DE ENTORNO (CARGAR ANTES DE USAR OPENAI)
@@ -32,30 +34,64 @@ SUPABASE_KEY = os.getenv("SUPABASE_ANON_KEY")
 print("API KEY DETECTADA:", OPENAI_KEY)
 print("SUPABASE URL:", SUPABASE_URL[:30] + "..." if SUPABASE_URL else "No configurado")
 
-# Inicializar Supabase
-supabase: Client = None
-if SUPABASE_URL and SUPABASE_KEY:
+from chatbot.lazy import Lazy
+
+
+def connect_supabase():
+    """Cliente de Supabase (None si falta configuración o el paquete)."""
+    if not (SUPABASE_URL and SUPABASE_KEY):
+        print("⚠ Configuración de Supabase incompleta")
+        return None
     try:
-        supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-        print("✅ Supabase conectado")
-    except Exception as e:
-        print("⚠ Error conectando Supabase:", e)
-else:
-    print("⚠ Configuración de Supabase incompleta")
+        from supabase import create_client
+    except Exception:
+        print("⚠ Paquete supabase no disponible")
+        return None
+    client = create_client(SUPABASE_URL, SUPABASE_KEY)
+    print("✅ Supabase conectado")
+    return client
+
+
+# Supabase se conecta en el primer uso (o en el warm-up de /readyz), no al importar
+SUPABASE = Lazy("supabase", connect_supabase)
 
 # ==========================================================
-# 🔧 OpenAI SDK nuevo (2025)
+# 🔧 OpenAI SDK nuevo (2025) detrás del gateway de LLM
 # ==========================================================
-from openai import OpenAI
-client = OpenAI(api_key=OPENAI_KEY)
+from chatbot.llm_gateway import LLMGateway, Deadline, LLMUnavailable
+
+# Plazos (segundos) y reintentos de las llamadas a OpenAI
+RAG_TIMEOUT = float(os.getenv("RAG_TIMEOUT", "8"))               # plazo total de una pregunta RAG
+RETRIEVAL_TIMEOUT = float(os.getenv("RETRIEVAL_TIMEOUT", "5"))   # parte del plazo para el embedding de la pregunta
+GPT_TIMEOUT = float(os.getenv("GPT_TIMEOUT", "6"))               # respuesta sin documentos
+OPENAI_RETRIES = int(os.getenv("OPENAI_RETRIES", "1"))
+LLM_BREAKER_THRESHOLD = 5   # fallos seguidos que abren el circuito
+LLM_BREAKER_COOLDOWN = 30   # segundos con el circuito abierto antes de probar de nuevo
+
+# El cliente OpenAI se crea en la primera llamada (LLM.client), no al importar
+LLM = LLMGateway(OPENAI_KEY, model="gpt-4o-mini", timeout=GPT_TIMEOUT, retries=OPENAI_RETRIES,
+                 breaker_threshold=LLM_BREAKER_THRESHOLD, breaker_cooldown=LLM_BREAKER_COOLDOWN)
 
 # ==========================================================
 # 📦 IMPORTS DEL CHATBOT
 # ==========================================================
-from chatbot.data import training_data
 from chatbot.model import build_and_train_model, load_model, predict_cluster
-from chatbot.responses import (get_respuesta_by_tipo, get_respuesta_no_encontrado_inteligente, 
+from chatbot.responses import (get_respuesta_by_tipo, get_respuesta_no_encontrado_inteligente,
                               RESPUESTAS_CONTEXTUALES, RESPUESTAS_CONFIANZA)
+from chatbot.streaming import format_sse, parse_partial_json
+from chatbot.cache_store import CacheStore
+from chatbot.singleflight import SingleFlight
+from chatbot.semantic_cache import SemanticCache, encode_vector
+from chatbot.query_cache import QueryEmbeddingCache, normalize_query
+from chatbot.jobs import IngestionJobs
+from chatbot.write_behind import WriteBehindQueue
+from chatbot.history import HistoryService, InvalidCursor
+from chatbot.corpus import EMPTY_CORPUS, CorpusVersion, format_corpus_id
+from chatbot.partitions import FILTER_FIELDS, filter_key, normalize_filter
+from chatbot.tenants import TenantStores, check_tenant
+from chatbot.ingest import chunk_params, embed_chunks, estimate_total_chars, iter_chunks, iter_pages
+from chatbot.dedup import ChunkDeduplicator
+from chatbot.legal_splitter import LegalStructureSplitter
 
 def safe_predict_cluster(text, model, vectorizer):
     """Función segura para predecir cluster con manejo de errores"""
@@ -72,89 +108,135 @@ def safe_predict_cluster(text, model, vectorizer):
         else:
             return 5  # no_entiendo
 
-# Procesamiento de documentos
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import PyPDFLoader, TextLoader, Docx2txtLoader
-from langchain_openai import OpenAIEmbeddings
-from langchain_community.vectorstores import FAISS
-
+# Procesamiento de documentos: LangChain, FAISS y sklearn se importan dentro
+# de las funciones que los usan para que importar main sea rápido
 VECTOR_PATH = "vector_db"
-CACHE_PATH = Path("qa_cache.json")
+CACHE_PATH = Path("qa_cache.json")  # formato antiguo, solo para migración
 VECTOR_DB = None
 VECTOR_DB_LOADING = False
-VECTOR_DB_LOCK = None
-
-# Configuration: timeouts and retries (seconds)
-RAG_TIMEOUT = 8
-GPT_TIMEOUT = 6
-OPENAI_RETRIES = 1
-
-# Helper: call OpenAI with a timeout to avoid long blocking requests
-import concurrent.futures
-import math
-def openai_chat_with_timeout(*, model, messages, timeout=12, retries=1, backoff_factor=1.5):
-    """Call OpenAI chat completion with a timeout and simple retry/backoff.
-
-    - `timeout`: max seconds to wait per attempt
-    - `retries`: number of extra attempts after the first (0 = no retry)
-    - `backoff_factor`: multiplier for sleep between retries
-    Raises TimeoutError on timeout, or the original exception on other errors.
-    """
-    attempt = 0
-    last_exc = None
-    while attempt <= retries:
-        attempt += 1
-        def _call():
-            return client.chat.completions.create(model=model, messages=messages)
-
-        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as ex:
-            fut = ex.submit(_call)
-            try:
-                return fut.result(timeout=timeout)
-            except concurrent.futures.TimeoutError as te:
-                fut.cancel()
-                last_exc = TimeoutError("OpenAI request timed out")
-            except Exception as e:
-                last_exc = e
+VECTOR_DB_WRITE_LOCK = threading.Lock()
+VECTOR_MAX_SEGMENTS = 8       # por encima, el hilo de fusión junta los segmentos pequeños
+VECTOR_MERGE_INTERVAL = 600   # segundos entre revisiones de fusión
+VECTOR_INDEX_TYPE = os.getenv("VECTOR_INDEX_TYPE", "auto")  # auto | flat | ivf | ivfpq | hnsw
+VECTOR_NPROBE = int(os.getenv("VECTOR_NPROBE", "16"))        # listas IVF visitadas por búsqueda
+VECTOR_EF_SEARCH = int(os.getenv("VECTOR_EF_SEARCH", "64"))  # amplitud de búsqueda HNSW
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "1") != "0"       # fusionar vector + BM25
+VECTOR_RELOAD_INTERVAL = float(os.getenv("VECTOR_RELOAD_INTERVAL", "1"))  # segundos entre revisiones del manifest
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv("NEAR_DUPLICATE_THRESHOLD", "1"))  # 1 solo exactos; <1 Jaccard MinHash; 0 desactiva
+VECTOR_MMR_LAMBDA = float(os.getenv("VECTOR_MMR_LAMBDA", "1"))  # 1 = solo relevancia (sin MMR, por defecto)
+# Ingesta en streaming (chatbot/ingest.py)
+PDF_PARSE_WORKERS = int(os.getenv("PDF_PARSE_WORKERS", str(min(4, os.cpu_count() or 1))))  # procesos por PDF grande
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "256"))  # chunks por llamada a embed_documents
+# Chunking por estructura jurídica: hijos pequeños para buscar, la disposición completa como contexto
+LEGAL_CHUNKING = os.getenv("LEGAL_CHUNKING", "1") != "0"
+LEGAL_CHILD_CHARS = int(os.getenv("LEGAL_CHILD_CHARS", "500"))
+LEGAL_PARENT_CHARS = int(os.getenv("LEGAL_PARENT_CHARS", "2400"))
+# Vector DB por tenant (chatbot/tenants.py): LRU de stores abiertos con techo de memoria
+TENANTS_PATH = os.path.join(VECTOR_PATH, "tenants")
+TENANT_MAX_RESIDENT = int(os.getenv("TENANT_MAX_RESIDENT", "8"))   # tenants con la vector DB abierta
+TENANT_MEMORY_MB = float(os.getenv("TENANT_MEMORY_MB", "512"))     # segmentos abiertos entre todos; 0 = sin techo
+# Despliegue con tenants: /history sin tenant filtra por tenant_id NULL (requiere la columna).
+# También se activa solo en cuanto algún tenant sube documentos a este disco
+MULTI_TENANT = os.getenv("MULTI_TENANT", "0") == "1"
+
+# Versión del corpus (sección "corpus" del manifest): cambia con cada ingesta y
+# cambia las keys del cache; los demás workers la ven con un stat() por segundo
+CORPUS = CorpusVersion(Path(VECTOR_PATH) / "manifest.json")
 
-        # if we will retry, sleep with exponential backoff
-        if attempt <= retries:
-            sleep_sec = backoff_factor ** (attempt - 1)
-            try:
-                time.sleep(min(sleep_sec, 10))
-            except Exception:
-                pass
+def make_key(question: str) -> str:
+    norm = normalize_query(question)
+    return hashlib.sha256(norm.encode("utf-8")).hexdigest()
 
-    # no successful attempt
-    if isinstance(last_exc, TimeoutError):
-        raise last_exc
-    raise last_exc if last_exc is not None else TimeoutError("OpenAI request failed after retries")
 
+CACHE_DIR = Path("qa_cache")
+CACHE_TTL = 3600  # 1 hora de cache
+MAX_CACHE_SIZE = 200  # Más entradas en cache
+CACHE_SHARDS = 4
 
-def load_cache():
-    if CACHE_PATH.exists():
-        try:
-            return json.loads(CACHE_PATH.read_text(encoding="utf-8"))
-        except Exception:
-            return {}
-    return {}
+# Cache en disco: log append-only por shards, compartido entre workers
+QA_CACHE = CacheStore(CACHE_DIR, ttl=CACHE_TTL, max_entries=MAX_CACHE_SIZE, shards=CACHE_SHARDS)
 
 
-def save_cache(cache):
-    try:
-        CACHE_PATH.write_text(json.dumps(cache, ensure_ascii=False, indent=2), encoding="utf-8")
-    except Exception as e:
-        print("⚠ Error saving cache:", e)
+def start_cache_maintenance(store):
+    """Migra el qa_cache.json antiguo y arranca el hilo compactador en este proceso."""
+    migrated = store.import_legacy(CACHE_PATH)
+    if migrated:
+        print(f"📦 Migradas {migrated} entradas de {CACHE_PATH} al cache por shards")
+    store.start_compactor()
+    return store
 
 
-def make_key(question: str) -> str:
-    norm = " ".join(re.findall(r"\w+", question.lower()))
-    return hashlib.sha256(norm.encode("utf-8")).hexdigest()
+# En el primer uso del cache (o en el post_fork de gunicorn.conf.py), no al importar:
+# con preload_app un hilo lanzado al importar viviría solo en el master
+CACHE_MAINTENANCE = Lazy("qa_cache", lambda: start_cache_maintenance(QA_CACHE))
 
+# Coalescencia de peticiones idénticas en vuelo (entre hilos y workers)
+INFLIGHT_WAIT_TIMEOUT = 60
+INFLIGHT = SingleFlight(CACHE_DIR / "inflight", wait_timeout=INFLIGHT_WAIT_TIMEOUT)
 
-QA_CACHE = load_cache()
-CACHE_TTL = 3600  # 1 hora de cache
-MAX_CACHE_SIZE = 200  # Más entradas en cache
+# Cache semántico: reutiliza respuestas de preguntas parecidas (similitud coseno)
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+SEMANTIC_CACHE_NAMESPACES = int(os.getenv("SEMANTIC_CACHE_NAMESPACES", "32"))  # corpus/tenant/filtro con índice en memoria
+SEMANTIC_CACHE_SYNC_INTERVAL = float(os.getenv("SEMANTIC_CACHE_SYNC_INTERVAL", "5"))  # segundos entre lecturas del log compartido
+SEMANTIC_CACHE = SemanticCache(threshold=SEMANTIC_CACHE_THRESHOLD, max_namespaces=SEMANTIC_CACHE_NAMESPACES,
+                               sync_interval=SEMANTIC_CACHE_SYNC_INTERVAL)
+
+# Embeddings de preguntas ya vistas: una pregunta repetida no vuelve a llamar a la API
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "1024"))
+QUERY_EMBEDDINGS = QueryEmbeddingCache(max_entries=QUERY_EMBEDDING_CACHE_SIZE)
+
+# Embeddings de ingesta: lotes paralelos + cache sha256(chunk) → vector en disco
+EMBEDDING_CACHE_DIR = Path("embedding_cache")
+EMBEDDING_BATCH_TOKENS = int(os.getenv("EMBEDDING_BATCH_TOKENS", "100000"))
+EMBEDDING_WORKERS = int(os.getenv("EMBEDDING_WORKERS", "4"))
+
+
+def create_ingest_embeddings():
+    from chatbot.embeddings import CachedEmbeddings  # arrastra langchain_core
+
+    return CachedEmbeddings(
+        LLM.client.with_options(max_retries=0, timeout=30),  # el backoff lo hace CachedEmbeddings
+        EMBEDDING_CACHE_DIR,
+        token_budget=EMBEDDING_BATCH_TOKENS,
+        max_workers=EMBEDDING_WORKERS
+    )
+
+
+EMBEDDINGS = Lazy("embeddings", create_ingest_embeddings)
+
+# Presupuesto de tokens del contexto RAG; al pasarlo se comprime por oraciones
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+
+
+# Vectores de las oraciones del contexto: LRU en memoria (no el cache en disco de la ingesta,
+# que crecería con cada petición) y la llamada a la API se descuenta del plazo de la petición
+SENTENCE_EMBEDDING_CACHE_SIZE = int(os.getenv("SENTENCE_EMBEDDING_CACHE_SIZE", "4096"))
+SENTENCE_EMBEDDINGS = QueryEmbeddingCache(max_entries=SENTENCE_EMBEDDING_CACHE_SIZE)
+SENTENCE_EMBEDDING_MIN_SECONDS = 0.5  # con menos plazo la compresión puntúa por solapamiento léxico
+SENTENCE_EMBEDDING_MODEL = "text-embedding-ada-002"  # el mismo espacio que el embedding de la pregunta
+
+
+def sentence_embedder(deadline=None):
+    """`embed(oraciones)` para comprimir el contexto, o None si el plazo no da para otra llamada.
+    Usa como máximo la mitad de lo que le queda a la petición: el resto es para la generación."""
+    timeout = RETRIEVAL_TIMEOUT
+    if deadline is not None:
+        timeout = min(timeout, deadline.remaining() / 2)
+    if timeout < SENTENCE_EMBEDDING_MIN_SECONDS:
+        return None
+
+    def embed_documents(texts):
+        # el cliente solo se pide si hay que comprimir; si falla, compress puntúa por solapamiento léxico
+        client = LLM.client.with_options(max_retries=0, timeout=timeout)
+        response = client.embeddings.create(model=SENTENCE_EMBEDDING_MODEL, input=texts)
+        return [item.embedding for item in sorted(response.data, key=lambda d: d.index)]
+
+    embedder = SimpleNamespace(model=SENTENCE_EMBEDDING_MODEL, embed_documents=embed_documents)
+    return lambda sentences: SENTENCE_EMBEDDINGS.embed_many(embedder, sentences)
+
+
+# Campos internos del cache que no se envían al frontend
+CACHE_INTERNAL_FIELDS = ('timestamp', 'query_embedding')
 
 # Cache en memoria para respuestas ultra-rápidas
 MEMORY_CACHE = {}
@@ -163,39 +245,38 @@ MEMORY_CACHE_TTL = 300  # 5 minutos
 
 def clean_expired_cache():
     """Limpia entradas expiradas del cache."""
-    now = int(time.time())
-    expired_keys = [k for k, v in QA_CACHE.items() 
-                   if now - v.get('timestamp', now) > CACHE_TTL]
-    for key in expired_keys:
-        QA_CACHE.pop(key, None)
-    if expired_keys:
-        save_cache(QA_CACHE)
-        print(f"🧹 Limpiadas {len(expired_keys)} entradas expiradas del cache")
-
-def respond_and_cache(key: str, payload: dict):
+    CACHE_MAINTENANCE.get()
+    removed = QA_CACHE.evict_expired()
+    if removed:
+        print(f"🧹 Limpiadas {removed} entradas expiradas del cache")
+
+def respond_and_cache(key: str, payload: dict, corpus_id: str = None, query_vector=None):
+    return jsonify(cache_payload(key, payload, corpus_id, query_vector))
+
+def cache_payload(key: str, payload: dict, corpus_id: str = None, query_vector=None) -> dict:
+    """Guarda el payload en cache y devuelve la versión lista para el frontend.
+    Si se pasa el embedding de la pregunta, queda también en el cache semántico
+    (las aclaraciones no lo pasan: su respuesta simplificada no sirve para paráfrasis normales)."""
     # normalize stored payload and include timestamp
     stored = payload.copy()
     stored.setdefault("sources", [])
     stored.setdefault("confidence", None)
     stored["timestamp"] = int(time.time())
     stored["cached"] = True
+    if corpus_id is not None and query_vector is not None:
+        stored["corpus_id"] = corpus_id
+        stored["query_embedding"] = encode_vector(query_vector)
+        SEMANTIC_CACHE.add(corpus_id, key, query_vector)
     
-    # Limpiar cache expirado
-    clean_expired_cache()
-    
-    # Si el cache está lleno, eliminar entradas más antiguas
-    if len(QA_CACHE) >= MAX_CACHE_SIZE:
-        oldest_key = min(QA_CACHE.keys(), 
-                       key=lambda k: QA_CACHE[k].get('timestamp', 0))
-        QA_CACHE.pop(oldest_key, None)
-        print(f"🗑️ Eliminada entrada antigua del cache")
-    
-    QA_CACHE[key] = stored
-    save_cache(QA_CACHE)
+    # El store desaloja por TTL/LRU al escribir: solo añade registros al log
+    CACHE_MAINTENANCE.get()
+    evicted = QA_CACHE.put(key, stored)
+    if evicted:
+        print(f"🗑️ Eliminadas {evicted} entradas antiguas del cache")
     
     # Remover timestamp antes de enviar al frontend
-    response_payload = {k: v for k, v in stored.items() if k not in ['timestamp']}
-    return jsonify(response_payload)
+    response_payload = {k: v for k, v in stored.items() if k not in CACHE_INTERNAL_FIELDS}
+    return response_payload
 
 def get_cached_response(key: str):
     """Obtiene respuesta del cache si no ha expirado."""
@@ -204,63 +285,96 @@ def get_cached_response(key: str):
         cached = MEMORY_CACHE[key]
         now = int(time.time())
         if now - cached.get('timestamp', now) <= MEMORY_CACHE_TTL:
-            response = {k: v for k, v in cached.items() if k not in ['timestamp']}
+            response = {k: v for k, v in cached.items() if k not in CACHE_INTERNAL_FIELDS}
             response['cached'] = True
             response['cache_type'] = 'memory'
             return response
     
-    # Luego revisar cache en disco
-    if key in QA_CACHE:
-        cached = QA_CACHE[key]
+    # Luego revisar cache en disco (las entradas expiradas devuelven None)
+    CACHE_MAINTENANCE.get()
+    cached = QA_CACHE.get(key)
+    if cached is not None:
         now = int(time.time())
-        if now - cached.get('timestamp', now) <= CACHE_TTL:
-            response = {k: v for k, v in cached.items() if k not in ['timestamp']}
-            # Copiar a cache en memoria para próxima consulta
-            if len(MEMORY_CACHE) < MEMORY_CACHE_SIZE:
-                memory_entry = cached.copy()
-                memory_entry['timestamp'] = now
-                MEMORY_CACHE[key] = memory_entry
-            response['cached'] = True
-            response['cache_type'] = 'disk'
-            return response
-        else:
-            QA_CACHE.pop(key, None)
-            save_cache(QA_CACHE)
+        response = {k: v for k, v in cached.items() if k not in CACHE_INTERNAL_FIELDS}
+        # Copiar a cache en memoria para próxima consulta
+        if len(MEMORY_CACHE) < MEMORY_CACHE_SIZE:
+            memory_entry = cached.copy()
+            memory_entry['timestamp'] = now
+            MEMORY_CACHE[key] = memory_entry
+        response['cached'] = True
+        response['cache_type'] = 'disk'
+        return response
     return None
 
+def get_semantic_cached_response(corpus_id: str, query_vector):
+    """Busca una respuesta cacheada de una pregunta semánticamente equivalente."""
+    if query_vector is None:
+        return None
+
+    def _resolve(key):
+        cached = QA_CACHE.get(key)
+        if cached is None:
+            return None
+        return {k: v for k, v in cached.items() if k not in CACHE_INTERNAL_FIELDS}
+
+    # incorporar entradas que otros workers hayan escrito en el cache compartido (incremental)
+    SEMANTIC_CACHE.refresh(corpus_id, QA_CACHE)
+    response, similarity = SEMANTIC_CACHE.lookup(corpus_id, query_vector, _resolve)
+    if response is None:
+        return None
+    response['cached'] = True
+    response['cache_type'] = 'semantic'
+    response['similarity'] = round(similarity, 4)
+    return response
+
+
+def query_embeddings():
+    """Embeddings de las preguntas: pool del gateway y su parte del plazo de la petición."""
+    from langchain_openai import OpenAIEmbeddings
+
+    return OpenAIEmbeddings(api_key=OPENAI_KEY, http_client=LLM.http_client,
+                            request_timeout=RETRIEVAL_TIMEOUT, max_retries=OPENAI_RETRIES)
+
+
+def open_vector_store(path=VECTOR_PATH):
+    """Abre la vector DB por segmentos y arranca en segundo plano su fusión y la recarga de snapshots."""
+    from chatbot.segments import SegmentedVectorStore
+
+    store = SegmentedVectorStore(
+        path,
+        query_embeddings(),
+        max_segments=VECTOR_MAX_SEGMENTS,
+        merge_interval=VECTOR_MERGE_INTERVAL,
+        index_type=VECTOR_INDEX_TYPE,
+        nprobe=VECTOR_NPROBE,
+        ef_search=VECTOR_EF_SEARCH,
+        hybrid=HYBRID_SEARCH,
+        refresh_interval=VECTOR_RELOAD_INTERVAL,
+        mmr_lambda=VECTOR_MMR_LAMBDA if VECTOR_MMR_LAMBDA < 1 else None
+    )
+    store.start_merger()
+    store.start_watcher()
+    return store
 
-def get_corpus_id():
-    """Generate a small fingerprint for the current vector DB so cache keys include the corpus state."""
-    try:
-        p = Path(VECTOR_PATH)
-        if not p.exists():
-            return "no_vector"
-        items = []
-        for f in sorted(p.glob("**/*")):
-            if f.is_file():
-                items.append(f.name + str(int(f.stat().st_mtime)))
-        if not items:
-            return "no_vector"
-        s = "|".join(items)
-        return hashlib.sha256(s.encode("utf-8")).hexdigest()
-    except Exception:
-        return "no_vector"
 
+def searchable(db):
+    """`db` si tiene algún vector; con el manifiesto vacío el chat responde sin RAG, como sin vector DB."""
+    return db if db is not None and len(db) > 0 else None
 
-def load_vector_db_if_needed():
+
+def load_vector_db_if_needed(tenant=None):
     """Ensure the FAISS vector DB is loaded. If not loaded, start a background loader and return
-    the current VECTOR_DB (or None if not loaded yet).
+    the current VECTOR_DB (or None if not loaded yet, or if it has no segments).
     Call with background=True to trigger background load without blocking.
+    Con `tenant`, la vector DB de ese tenant (abierta bajo demanda), o None si no tiene documentos.
     """
-    global VECTOR_DB, VECTOR_DB_LOADING, VECTOR_DB_LOCK
-    # lazy initialize lock
-    if VECTOR_DB_LOCK is None:
-        import threading
-        VECTOR_DB_LOCK = threading.Lock()
+    global VECTOR_DB, VECTOR_DB_LOADING
+    if tenant:
+        return searchable(TENANTS.get(tenant))
 
-    # if already loaded, return immediately
+    # if already loaded, return immediately (el watcher del store incorpora los segmentos nuevos)
     if VECTOR_DB is not None:
-        return VECTOR_DB
+        return searchable(VECTOR_DB)
 
     # if loading already in progress, return None
     if VECTOR_DB_LOADING:
@@ -272,183 +386,244 @@ def load_vector_db_if_needed():
         try:
             VECTOR_DB_LOADING = True
             if os.path.exists(VECTOR_PATH):
-                embeddings = OpenAIEmbeddings(api_key=OPENAI_KEY)
-                db = FAISS.load_local(VECTOR_PATH, embeddings, allow_dangerous_deserialization=True)
-                with VECTOR_DB_LOCK:
-                    VECTOR_DB = db
-                print("📂 Vector DB cargado en memoria (background).")
+                # mismo lock que ingest_vector_store: nunca se abren dos stores (con sus hilos)
+                with VECTOR_DB_WRITE_LOCK:
+                    if VECTOR_DB is None:
+                        VECTOR_DB = open_vector_store()
+                    db = VECTOR_DB
+                print(f"📂 Vector DB cargado en memoria (background): {db.stats()}")
             else:
                 print("⚠ Vector DB no encontrada en disco.")
         except Exception as e:
             print("⚠ Error cargando Vector DB en memoria (background):", e)
-            with VECTOR_DB_LOCK:
-                VECTOR_DB = None
         finally:
             VECTOR_DB_LOADING = False
 
-    import threading
+    # marcar la carga antes de arrancar el hilo: wait_for_vector_db no debe ver un hueco
+    VECTOR_DB_LOADING = True
     th = threading.Thread(target=_bg_load, daemon=True)
     th.start()
     return None
 
 
+TENANTS = TenantStores(TENANTS_PATH, open_vector_store, max_resident=TENANT_MAX_RESIDENT,
+                       max_bytes=int(TENANT_MEMORY_MB * 1024 * 1024))
+
+
+def ingest_vector_store(tenant=None):
+    """Vector DB en la que escribe la ingesta (la global o la del tenant), creada si hace falta."""
+    global VECTOR_DB
+    if tenant:
+        return TENANTS.get(tenant, create=True)
+    with VECTOR_DB_WRITE_LOCK:
+        if VECTOR_DB is None:
+            VECTOR_DB = open_vector_store()
+            print("🏗️ Vector DB abierto")
+        return VECTOR_DB
+
+
 # ==========================================================
 # 🗄 FUNCIONES SUPABASE
+# Las escrituras pasan por una cola write-behind: la petición solo
+# encola la fila y un hilo la inserta en lote. Si Supabase no responde,
+# las filas esperan en un journal local y se reenvían al recuperarse.
 # ==========================================================
-def save_document_to_db(filename: str, file_path: str, corpus_id: str):
-    """Guarda información del documento en Supabase."""
-    if not supabase:
-        return False
-    try:
-        data = {
-            "id": str(uuid.uuid4()),
-            "filename": filename,
-            "file_path": file_path,
-            "corpus_id": corpus_id,
-            "created_at": datetime.now().isoformat(),
-            "status": "processed"
-        }
-        result = supabase.table("documents").insert(data).execute()
-        print(f"✅ Documento guardado en DB: {filename}")
-        return True
-    except Exception as e:
-        print(f"⚠ Error guardando documento: {e}")
-        return False
+PERSIST_JOURNAL_DIR = "supabase_journal"
+PERSIST_BATCH_SIZE = int(os.getenv("PERSIST_BATCH_SIZE", "50"))              # filas por inserción
+PERSIST_FLUSH_INTERVAL = float(os.getenv("PERSIST_FLUSH_INTERVAL", "2"))     # segundos máximos en cola
+PERSIST_RETRY_INTERVAL = float(os.getenv("PERSIST_RETRY_INTERVAL", "30"))    # espera tras un fallo de Supabase
+
 
+HISTORY_CACHE_TTL = float(os.getenv("HISTORY_CACHE_TTL", "10"))  # segundos que se reutiliza una página
+HISTORY_PAGE_SIZE = 20
+HISTORY_MAX_PAGE_SIZE = 100
 
-def save_conversation_to_db(user_question: str, bot_response: str, sources: list, confidence: str, evidence: list, cross_references: list):
-    """Guarda la conversación en Supabase."""
+HISTORY = HistoryService(SUPABASE.get, ttl=HISTORY_CACHE_TTL,
+                         tenants_in_use=lambda: MULTI_TENANT or TENANTS.any_on_disk())
+
+
+def supabase_sink(table: str, rows: list):
+    """Inserta un lote en Supabase (upsert por id: reenviar el journal no duplica filas)."""
+    supabase = SUPABASE.get()
     if not supabase:
         return False
-    try:
-        data = {
-            "id": str(uuid.uuid4()),
-            "user_question": user_question,
-            "bot_response": bot_response,
-            "sources": json.dumps(sources) if sources else "[]",
-            "confidence": confidence,
-            "evidence": json.dumps(evidence) if evidence else "[]",
-            "cross_references": json.dumps(cross_references) if cross_references else "[]",
-            "created_at": datetime.now().isoformat(),
-            "corpus_id": get_corpus_id()
-        }
-        result = supabase.table("conversations").insert(data).execute()
-        return True
-    except Exception as e:
-        print(f"⚠ Error guardando conversación: {e}")
-        return False
+    # PostgREST exige las mismas columnas en todas las filas del lote (session_id/tenant_id son opcionales)
+    columns = list(dict.fromkeys(column for row in rows for column in row))
+    rows = [{column: row.get(column) for column in columns} for row in rows]
+    supabase.table(table).upsert(rows, ignore_duplicates=True, returning="minimal").execute()
+    if table == "conversations":
+        HISTORY.invalidate()  # las filas ya son visibles: el historial cacheado quedó viejo
+    return True
 
 
-def get_conversation_history(limit: int = 10):
-    """Obtiene el historial de conversaciones desde Supabase."""
-    if not supabase:
-        return []
+PERSISTENCE = WriteBehindQueue(supabase_sink, PERSIST_JOURNAL_DIR, max_batch=PERSIST_BATCH_SIZE,
+                               flush_interval=PERSIST_FLUSH_INTERVAL, retry_interval=PERSIST_RETRY_INTERVAL)
+
+
+def save_document_to_db(filename: str, file_path: str, corpus_id: str, tenant: str = None):
+    """Encola el registro del documento para Supabase."""
+    if not SUPABASE.get():
+        return False
+    row = {
+        "id": str(uuid.uuid4()),
+        "filename": filename,
+        "file_path": file_path,
+        "corpus_id": corpus_id,
+        "created_at": datetime.now().isoformat(),
+        "status": "processed"
+    }
+    if tenant:
+        row["tenant_id"] = tenant
+    PERSISTENCE.enqueue("documents", row)
+    print(f"✅ Documento encolado para DB: {filename}")
+    return True
+
+
+def save_conversation_to_db(user_question: str, bot_response: str, sources: list, confidence: str, evidence: list,
+                            cross_references: list, corpus_id: str = None, session_id: str = None,
+                            tenant: str = None):
+    """Encola la conversación para Supabase."""
+    if not SUPABASE.get():
+        return False
+    row = {
+        "id": str(uuid.uuid4()),
+        "user_question": user_question,
+        "bot_response": bot_response,
+        "sources": json.dumps(sources) if sources else "[]",
+        "confidence": confidence,
+        "evidence": json.dumps(evidence) if evidence else "[]",
+        "cross_references": json.dumps(cross_references) if cross_references else "[]",
+        "created_at": datetime.now().isoformat(),
+        "corpus_id": corpus_id or get_corpus_id(tenant)
+    }
+    # solo si se conocen: así no hace falta la columna tenant_id para usar la app sin tenants
+    if session_id:
+        row["session_id"] = session_id
+    if tenant:
+        row["tenant_id"] = tenant
+    PERSISTENCE.enqueue("conversations", row)
+    return True
+
+
+def log_analytics_event(event_type: str, metadata: dict = None):
+    """Encola un evento de analytics ('question', 'upload', 'error')."""
+    if not SUPABASE.get():
+        return False
+    PERSISTENCE.enqueue("analytics", {
+        "id": str(uuid.uuid4()),
+        "event_type": event_type,
+        "metadata": metadata or {},
+        "created_at": datetime.now().isoformat()
+    })
+    return True
+
+
+def get_conversation_history(limit: int = HISTORY_PAGE_SIZE, cursor: str = None, session_id: str = None,
+                             corpus_id: str = None, tenant: str = None):
+    """Una página del historial: {"items", "next_cursor"} (más recientes primero)."""
     try:
-        result = supabase.table("conversations").select("*").order("created_at", desc=True).limit(limit).execute()
-        return result.data
+        return HISTORY.page(limit, cursor, session_id, corpus_id, tenant)
+    except InvalidCursor:
+        raise
     except Exception as e:
         print(f"⚠ Error obteniendo historial: {e}")
-        return []
+        return {"items": [], "next_cursor": None}
 
 
 # ==========================================================
-# 🔧 PRUEBA AUTOMÁTICA DE API
+# 📄 CARGAR Y VECTORIZAR DOCUMENTOS
 # ==========================================================
-try:
-    test = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[{"role": "user", "content": "Hola, ¿funcionas?"}]
-    )
-    print("OpenAI funcionando →", test.choices[0].message.content)
-except Exception as e:
-    print("❌ Error al probar OpenAI:", e)
+def procesar_documento(file_path, filename="", progress=None, tenant=None):
+    """Procesa un documento optimizado para velocidad y eficiencia.
+    `progress(estado)` recibe las etapas parsing/embedding/indexing si se pasa.
+    Con `tenant` el documento va a la vector DB de ese tenant."""
 
+    def _report(status):
+        if progress is not None:
+            progress(status)
+
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
 
-# ==========================================================
-# 📄 CARGAR Y VECTORIZAR DOCUMENTOS
-# ==========================================================
-def procesar_documento(file_path, filename=""):
-    """Procesa un documento optimizado para velocidad y eficiencia."""
     try:
         ext = file_path.split(".")[-1].lower()
-        
-        # Cargar documento con configuraciones optimizadas
-        if ext == "pdf":
-            loader = PyPDFLoader(file_path)
-        elif ext == "txt":
-            loader = TextLoader(file_path, encoding='utf-8', autodetect_encoding=True)
-        elif ext == "docx":
-            loader = Docx2txtLoader(file_path)
-        else:
+        if ext not in ALLOWED_EXTENSIONS:
             return False, f"❌ Tipo de archivo no soportado: {ext}"
 
+        _report("parsing")
         print(f"📄 Cargando {filename or file_path}...")
-        docs = loader.load()
-        
-        # Verificar que se cargó contenido
-        if not docs or not any(doc.page_content.strip() for doc in docs):
-            return False, "❌ El documento no contiene texto legible"
-        
-        total_chars = sum(len(doc.page_content) for doc in docs)
-        print(f"📊 Documento cargado: {total_chars:,} caracteres")
-        
-        # Chunking ultra-optimizado para velocidad
-        if total_chars < 5000:  # Documento muy pequeño
-            chunk_size = 400
-            chunk_overlap = 30
-        elif total_chars < 20000:  # Documento pequeño
-            chunk_size = 600 
-            chunk_overlap = 50
-        elif total_chars < 50000:  # Documento mediano
-            chunk_size = 900
-            chunk_overlap = 80
-        else:  # Documento grande
-            chunk_size = 1200  # Chunks más grandes para menos procesamiento
-            chunk_overlap = 100
-            
-        splitter = RecursiveCharacterTextSplitter(
-            chunk_size=chunk_size, 
-            chunk_overlap=chunk_overlap,
-            separators=["\n\n", "\n", ".", "!", "?", ",", " ", ""]
-        )
-        chunks = splitter.split_documents(docs)
-        print(f"✂️ Creados {len(chunks)} chunks (tamaño: {chunk_size})")
-        
-        # Añadir metadatos mejorados a los chunks
-        for i, chunk in enumerate(chunks):
-            chunk.metadata.update({
-                "source": filename or os.path.basename(file_path),
-                "chunk_id": i,
-                "chunk_size": len(chunk.page_content),
-                "file_type": ext,
-                "processed_at": datetime.now().isoformat()
-            })
-        
-        print("🔢 Generando embeddings optimizados...")
-        embeddings = OpenAIEmbeddings(
-            api_key=OPENAI_KEY,
-            chunk_size=1000,  # Aumentar para menos llamadas API
-            max_retries=1,    # Solo un reintento para mayor velocidad
-            request_timeout=8,  # Timeout más agresivo
-            show_progress_bar=False,  # Sin progreso para mayor velocidad
-            skip_empty=True   # Saltar chunks vacíos
-        )
-        
-        # Crear o actualizar vector DB
-        global VECTOR_DB
-        if VECTOR_DB is None:
-            VECTOR_DB = FAISS.from_documents(chunks, embeddings)
-            print("🏗️ Vector DB creado")
+        # El tamaño de chunk se elige con una estimación (páginas, tamaño del XML o
+        # del archivo): el texto ya no está entero en memoria para contarlo
+        estimated_chars = estimate_total_chars(file_path, ext)
+        if LEGAL_CHUNKING:
+            # Un chunk por artículo/cláusula/parágrafo (partido si es largo), con su disposición como padre
+            splitter = LegalStructureSplitter(child_size=LEGAL_CHILD_CHARS, parent_max_chars=LEGAL_PARENT_CHARS)
+            print(f"📊 Tamaño estimado: {estimated_chars:,} caracteres (chunks por estructura jurídica)")
         else:
-            # Añadir chunks a DB existente
-            new_vectors = FAISS.from_documents(chunks, embeddings)
-            VECTOR_DB.merge_from(new_vectors)
-            print("➕ Chunks añadidos a Vector DB existente")
-        
-        VECTOR_DB.save_local(VECTOR_PATH)
-        print(f"💾 Vector DB guardado en {VECTOR_PATH}")
+            chunk_size, chunk_overlap = chunk_params(estimated_chars)
+            print(f"📊 Tamaño estimado: {estimated_chars:,} caracteres (chunks de {chunk_size})")
+            splitter = RecursiveCharacterTextSplitter(
+                chunk_size=chunk_size, 
+                chunk_overlap=chunk_overlap,
+                separators=["\n\n", "\n", ".", "!", "?", ",", " ", ""]
+            )
+        source = filename or os.path.basename(file_path)
+        processed_at = datetime.now().isoformat()
+
+        def _with_metadata(chunks):
+            # Añadir metadatos mejorados a los chunks a medida que salen del splitter
+            for i, chunk in enumerate(chunks):
+                chunk.metadata.update({
+                    "source": source,
+                    "chunk_id": i,
+                    "chunk_size": len(chunk.page_content),
+                    "file_type": ext,
+                    "processed_at": processed_at
+                })
+                yield chunk
+
+        pages = iter_pages(file_path, ext, workers=PDF_PARSE_WORKERS)
+        chunks = _with_metadata(iter_chunks(pages, splitter))
+
+        # Casi duplicados (del propio documento o del corpus) no se embeben: quedan como
+        # referencias del chunk canónico
+        dedup = None
+        if NEAR_DUPLICATE_THRESHOLD > 0:
+            store = ingest_vector_store(tenant)
+            dedup = ChunkDeduplicator(NEAR_DUPLICATE_THRESHOLD, existing=store.existing_signatures())
+            chunks = dedup.filter(chunks)
+
+        # Páginas → chunks → embeddings por lotes: se embebe un lote mientras se parsea el siguiente
+        print("🔢 Generando embeddings optimizados...")
+        embeddings = EMBEDDINGS.get()
+        hits_before, api_before = embeddings.cache_hits, embeddings.api_texts
+        new_vectors, n_chunks, total_chars = embed_chunks(chunks, embeddings, batch_size=EMBED_BATCH_SIZE,
+                                                          on_first_batch=lambda: _report("embedding"))
+        collapsed = dedup.collapsed if dedup is not None else 0
+        if new_vectors is None and not collapsed:
+            return False, "❌ El documento no contiene texto legible"
+        print(f"✂️ Creados {n_chunks} chunks ({total_chars:,} caracteres), {collapsed} casi duplicados colapsados")
+        print(f"🔢 Embeddings: {embeddings.api_texts - api_before} nuevos, "
+              f"{embeddings.cache_hits - hits_before} reutilizados del cache")
+
+        parents = getattr(splitter, "parents", None)
+        for parent in parents or ():
+            parent.metadata.update({"source": source, "file_type": ext, "processed_at": processed_at})
+
+        # Guardar el documento como segmento nuevo (un solo job de ingesta escribe a la vez)
+        _report("indexing")
+        store = ingest_vector_store(tenant)
+        with VECTOR_DB_WRITE_LOCK:
+            segment = store.add_segment(
+                new_vectors, source=source,
+                signatures=dedup.signatures if dedup is not None else None,
+                references=dedup.references if dedup is not None else None,
+                parents=parents)
+            if not tenant:
+                CORPUS.update(store.corpus())
+            print(f"💾 Segmento {segment['name']} guardado ({segment['vectors']} vectores), corpus {get_corpus_id(tenant)}")
         
-        return True, f"✅ {filename or 'Documento'} procesado: {len(chunks)} chunks creados"
+        duplicates = f" ({collapsed} casi duplicados enlazados a chunks existentes)" if collapsed else ""
+        return True, f"✅ {filename or 'Documento'} procesado: {n_chunks} chunks creados{duplicates}"
         
     except Exception as e:
         print(f"❌ Error procesando {filename or file_path}: {e}")
@@ -458,39 +633,39 @@ def procesar_documento(file_path, filename=""):
 # ==========================================================
 # 🤖 MODELO DE CLÚSTERS
 # ==========================================================
-app = Flask(__name__)
+# Las rutas viven en un Blueprint; create_app() (al final) arma la app Flask
+# cli_group=None: los comandos del Blueprint quedan en la raíz (`flask --app main batch ...`)
+bp = Blueprint("chatbot", __name__, cli_group=None)
 
 # Configuración para carga de archivos
-app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB máximo total
-app.config['UPLOAD_FOLDER'] = 'uploads'
+MAX_CONTENT_LENGTH = 50 * 1024 * 1024  # 50MB máximo total
+UPLOAD_FOLDER = 'uploads'
 MAX_FILE_SIZE = 16 * 1024 * 1024  # 16MB por archivo
 MAX_FILES = 3  # máximo 3 archivos
 ALLOWED_EXTENSIONS = {'pdf', 'txt', 'docx'}
 
+# Cola de ingesta en segundo plano para /upload
+JOBS_DIR = "jobs"
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+INGEST_JOBS = IngestionJobs(JOBS_DIR, max_workers=INGEST_WORKERS)
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def get_corpus_id():
-    """Genera o retorna un ID único para el corpus actual"""
-    corpus_file = os.path.join("vector_db", "corpus_id.txt")
-    try:
-        if os.path.exists(corpus_file):
-            with open(corpus_file, 'r') as f:
-                return f.read().strip()
-        else:
-            # Crear nuevo ID basado en timestamp
-            new_id = f"corpus_{int(time.time())}"
-            os.makedirs("vector_db", exist_ok=True)
-            with open(corpus_file, 'w') as f:
-                f.write(new_id)
-            return new_id
-    except Exception as e:
-        print(f"⚠ Error con corpus_id: {e}")
-        return f"corpus_{int(time.time())}"
-
-# Cargar modelo de clústers de forma tolerante a fallos para pruebas.
-model, vectorizer = None, None
-try:
+def get_corpus_id(tenant=None):
+    """Versión vigente del corpus (generación + hash de contenido) para keys del cache y Supabase.
+    Con la vector DB cargada es la del snapshot con el que se responde, no la del disco.
+    Cada tenant tiene la suya (la de un corpus vacío si aún no subió documentos)."""
+    if tenant:
+        store = TENANTS.get(tenant)
+        return format_corpus_id(store.corpus() if store is not None else EMPTY_CORPUS)
+    db = VECTOR_DB
+    if db is not None and hasattr(db, "corpus"):
+        return format_corpus_id(db.corpus())
+    return CORPUS.id()
+
+def load_cluster_model():
+    """Carga el modelo de clústers de disco y solo si no existe lo entrena."""
     try:
         model, vectorizer = load_model()
     except Exception as e:
@@ -498,14 +673,18 @@ try:
         model, vectorizer = None, None
 
     if model is None:
-        try:
-            model, vectorizer = build_and_train_model(training_data, n_clusters=6)
-        except Exception as e:
-            print(f"⚠ Error entrenando/creando modelo: {e}")
-            model, vectorizer = None, None
-except Exception as e:
-    print(f"⚠ Error inesperado en inicialización del modelo: {e}")
-    model, vectorizer = None, None
+        from chatbot.data import training_data
+        model, vectorizer = build_and_train_model(training_data, n_clusters=6)
+    return model, vectorizer
+
+
+# Modelo de clústers: se carga en el primer uso (o en /readyz), tolerante a fallos
+CLUSTER_MODEL = Lazy("cluster_model", load_cluster_model)
+
+
+def get_cluster_model():
+    """(model, vectorizer), o (None, None) si no se pudo cargar ni entrenar."""
+    return CLUSTER_MODEL.get() or (None, None)
 
 # Sistema de respuestas profesionales mejorado
 # Las respuestas ahora se manejan desde chatbot/responses.py
@@ -522,14 +701,18 @@ CLUSTER_TO_RESPONSE_TYPE = {
 # ==========================================================
 # 🌐 RUTAS FLASK
 # ==========================================================
-@app.route("/")
+@bp.route("/")
 def home():
     return render_template("index.html")
 
 
 # --- SUBIR DOCUMENTO ---
-@app.route("/upload", methods=["POST"])
+@bp.route("/upload", methods=["POST"])
 def upload():
+    try:
+        tenant = parse_tenant(request.form, request.headers)
+    except ValueError as e:
+        return jsonify({"success": False, "message": f"❌ {e}"}), 400
     try:
         # Verificar que se enviaron archivos
         if 'files' not in request.files:
@@ -572,37 +755,35 @@ def upload():
         if not valid_files:
             return jsonify({"success": False, "message": "❌ No hay archivos válidos"})
         
-        # Procesar archivos
-        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+        # Guardar archivos y encolar su procesamiento (la respuesta no espera la ingesta)
+        os.makedirs(current_app.config['UPLOAD_FOLDER'], exist_ok=True)
         results = []
-        processed_files = []
+        jobs = []
         
         for file, file_size in valid_files:
             # Generar nombre único para evitar conflictos
             timestamp = int(time.time())
             safe_filename = f"{timestamp}_{file.filename}"
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], safe_filename)
+            file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], safe_filename)
+            size_mb = file_size / (1024 * 1024)
             
             try:
                 file.save(file_path)
-                size_mb = file_size / (1024 * 1024)
                 print(f"💾 Guardado: {file.filename} ({size_mb:.1f}MB)")
                 
-                # Procesar documento
-                success, message = procesar_documento(file_path, file.filename)
-                
-                if success:
-                    processed_files.append(file.filename)
-                    # Guardar info en Supabase
-                    try:
-                        save_document_to_db(file.filename, file_path, get_corpus_id())
-                    except Exception as e:
-                        print(f"⚠ Error guardando en Supabase: {e}")
-                
+                job = INGEST_JOBS.submit(
+                    lambda progress, fp=file_path, fn=file.filename: run_ingestion_job(fp, fn, progress, tenant),
+                    filename=file.filename,
+                    size_mb=round(size_mb, 1),
+                    tenant=tenant
+                )
+                jobs.append(job["id"])
                 results.append({
                     "filename": file.filename,
-                    "success": success,
-                    "message": message,
+                    "success": True,
+                    "job_id": job["id"],
+                    "status": job["status"],
+                    "message": "⏳ En cola de procesamiento",
                     "size_mb": round(size_mb, 1)
                 })
                 
@@ -611,36 +792,30 @@ def upload():
                     "filename": file.filename,
                     "success": False,
                     "message": f"❌ Error: {str(e)[:50]}",
-                    "size_mb": round(file_size / (1024 * 1024), 1)
+                    "size_mb": round(size_mb, 1)
                 })
         
-        # Recargar vector DB en memoria
-        try:
-            # trigger background load (non-blocking)
-            load_vector_db_if_needed()
-        except Exception as e:
-            print(f"⚠ Error iniciando carga de Vector DB en background: {e}")
-        
         # Preparar respuesta
-        successful = len(processed_files)
+        queued = len(jobs)
         total = len(results)
         
-        if successful == total:
-            message = f"✅ {successful} archivo(s) procesado(s) correctamente"
+        if queued == total:
+            message = f"⏳ {queued} archivo(s) en cola de procesamiento"
             success = True
-        elif successful > 0:
-            message = f"⚠ {successful}/{total} archivos procesados. Ver detalles."
+        elif queued > 0:
+            message = f"⚠ {queued}/{total} archivos en cola. Ver detalles."
             success = True
         else:
-            message = "❌ No se pudo procesar ningún archivo"
+            message = "❌ No se pudo guardar ningún archivo"
             success = False
         
         return jsonify({
             "success": success,
             "message": message,
-            "processed_files": processed_files,
+            "jobs": jobs,
+            "processed_files": [],
             "details": results,
-            "total_processed": successful,
+            "total_queued": queued,
             "total_files": total
         })
         
@@ -649,111 +824,49 @@ def upload():
         return jsonify({"success": False, "message": f"❌ Error del servidor: {str(e)[:100]}"})
 
 
-# --- CHAT ---
-@app.route("/chat", methods=["POST"])
-def chat():
-    start_time = time.time()
-    user_text = request.form.get("message", "").strip()
-
-    if not user_text:
-        return jsonify({"response": "Por favor escribe algo 😅"})
-    
-    print(f"🔍 Consulta recibida: {user_text[:100]}...")
-
-    # Detectar peticiones triviales (saludos, agradecimientos) y manejar localmente
-    lower = user_text.lower().strip()
-    tokens = re.findall(r"\w+", lower)
-    greeting_keywords = {"hola", "buenos", "buenas", "hey", "saludos", "gracias", "adios", "adiós", "chao", "hasta", "luego", "nos", "nos vemos"}
-    if any(tok in greeting_keywords for tok in tokens) or lower in ("hola", "gracias", "buenas", "buenos días", "buenas tardes", "buenas noches", "adiós", "adios", "chao"):
-        # usar el modelo de clústers o respuestas predefinidas para respuestas cortas
+def run_ingestion_job(file_path: str, filename: str, progress, tenant: str = None):
+    """Trabajo de ingesta: procesa el documento y, al terminar, lo registra en Supabase."""
+    success, message = procesar_documento(file_path, filename, progress=progress, tenant=tenant)
+    if success:
+        # Guardar info en Supabase
+        try:
+            corpus_id = get_corpus_id(tenant)
+            save_document_to_db(filename, file_path, corpus_id, tenant)
+            log_analytics_event("upload", {"filename": filename, "corpus_id": corpus_id, "tenant": tenant})
+        except Exception as e:
+            print(f"⚠ Error guardando en Supabase: {e}")
+        if tenant:
+            return success, message  # la vector DB del tenant ya está abierta en el LRU
+        # Recargar vector DB en memoria
         try:
-            cluster = predict_cluster(model, vectorizer, user_text)
-            # Usar el nuevo sistema de respuestas profesionales
-            response_type = CLUSTER_TO_RESPONSE_TYPE.get(cluster, "no_entiendo")
-            response = get_respuesta_by_tipo(response_type)
-            return jsonify({"response": response})
-        except Exception:
-            return jsonify({"response": "Hola — ¿en qué puedo ayudarte?"})
+            # trigger background load (non-blocking)
+            load_vector_db_if_needed()
+        except Exception as e:
+            print(f"⚠ Error iniciando carga de Vector DB en background: {e}")
+    return success, message
 
-    # Detectar si es una petición de aclaración / simplificación
-    clarify_keywords = ["explica", "explicame", "sin tecnicismos", "en otras palabras", "no entiendo", "simplifica", "resumen", "resume", "parafrasea", "más simple", "nivel sencillo"]
-    is_clarify = any(kw in lower for kw in clarify_keywords)
 
-    # ==========================================================
-    # 1️⃣ RAG (si existe base vectorial)
-    # ==========================================================
-    vector_db = load_vector_db_if_needed()
-    if vector_db is not None:
-        try:
-            # antes de llamar a la API, chequear cache por pregunta+corpus
-            corpus_id = get_corpus_id()
-            cache_key = make_key(user_text + "|" + corpus_id)
-            
-            # Verificar cache inteligente
-            cached_response = get_cached_response(cache_key)
-            if cached_response:
-                print(f"🚀 Respuesta desde cache para: {user_text[:50]}...")
-                return jsonify(cached_response)
+# --- ESTADO DE INGESTA ---
+@bp.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    """Estado de un trabajo de ingesta (queued/parsing/embedding/indexing/done/failed)."""
+    job = INGEST_JOBS.get(job_id)
+    if job is None:
+        return jsonify({"error": "Trabajo no encontrado"}), 404
+    return jsonify(job)
 
-            # obtener documentos relevantes con score optimizado para velocidad
-            search_start = time.time()
-            k = 6 if is_clarify else 3  # Reducir k para mayor velocidad
-            # results devuelve una lista de tuplas (Document, score)
-            results = vector_db.similarity_search_with_score(user_text, k=k)
-            search_time = time.time() - search_start
-            print(f"🔍 Búsqueda vectorial completada en {search_time:.3f}s")
-            
-            # Filtrar resultados por score de relevancia más estricto (menor score = más relevante)
-            filtered_results = [(d, s) for d, s in results if s < 0.8]  # Umbral más estricto
-            if not filtered_results:
-                filtered_results = results[:1]  # Solo el mejor resultado como fallback
-            
-            # Comprimir contexto eliminando redundancias
-            seen_content = set()
-            unique_docs = []
-            for d, s in filtered_results:
-                # Crear hash del contenido para detectar duplicados
-                content_hash = hashlib.md5(d.page_content.encode()).hexdigest()
-                if content_hash not in seen_content:
-                    seen_content.add(content_hash)
-                    unique_docs.append((d, s))
-            
-            contexto = "\n\n--- SECCIÓN ---\n".join([d.page_content for d, s in unique_docs])
-            print(f"📋 Contexto optimizado: {len(unique_docs)} secciones únicas")
-
-            # construir lista de fuentes con metadatos para devolver al frontend
-            sources = []
-            for d, s in results:
-                metadata = d.metadata if hasattr(d, 'metadata') else {}
-                sources.append({
-                    "text_snippet": d.page_content[:500],
-                    "source": metadata.get("source", metadata.get("source_id", "unknown")),
-                    "page": metadata.get("page", None),
-                    "score": float(s)
-                })
 
-            # Heurística simple para calcular 'confidence' a partir de las puntuaciones de FAISS
-            # Asumimos que FAISS devuelve distancias (valores más bajos => más cercanos/relevantes).
-            derived_confidence = None
-            try:
-                scores = [abs(item.get("score", 0)) for item in sources if item.get("score") is not None]
-                if len(scores) > 0:
-                    min_score = min(scores)
-                    conf_value = 1.0 / (1.0 + min_score)
-                    if conf_value > 0.7:
-                        derived_confidence = "alta"
-                    elif conf_value > 0.4:
-                        derived_confidence = "media"
-                    else:
-                        derived_confidence = "baja"
-                else:
-                    derived_confidence = "baja"
-            except Exception:
-                derived_confidence = "baja"
+# --- CHAT ---
+GREETING_KEYWORDS = {"hola", "buenos", "buenas", "hey", "saludos", "gracias", "adios", "adiós", "chao", "hasta", "luego", "nos", "nos vemos"}
+GREETING_PHRASES = ("hola", "gracias", "buenas", "buenos días", "buenas tardes", "buenas noches", "adiós", "adios", "chao")
+CLARIFY_KEYWORDS = ["explica", "explicame", "sin tecnicismos", "en otras palabras", "no entiendo", "simplifica", "resumen", "resume", "parafrasea", "más simple", "nivel sencillo"]
+
+NOT_FOUND_MESSAGE = "La respuesta específica a esta pregunta no se encuentra en los documentos legales cargados"
 
-            # Prompt optimizado para respuestas estrictas basadas únicamente en el contexto
-            prompt_template = """
-Eres Alana Legal Sense, asistente legal especializada. REGLAS ESTRICTAS DE RESPUESTA:
+# Prompt optimizado para respuestas estrictas basadas únicamente en el contexto
+# Reglas fijas en el mensaje de sistema: el prefijo del prompt es idéntico en todas
+# las llamadas y el proveedor puede reutilizarlo (prompt caching)
+RAG_SYSTEM_PROMPT = """Eres Alana Legal Sense, asistente legal especializada. REGLAS ESTRICTAS DE RESPUESTA:
 
 🚫 PROHIBIDO ABSOLUTO:
 - Inventar, asumir o extrapolar información no presente en el contexto
@@ -778,7 +891,7 @@ FORMATO DE RESPUESTA REQUERIDO:
 ✅ CONSERVADOR: Mejor decir "no está" que asumir
 
 Devuelve ÚNICAMENTE un objeto JSON válido:
-{{
+{
   "answer": "Respuesta directa y específica con números de artículo/sección",
   "key_points": ["Punto clave 1 con referencia específica", "Punto clave 2", "Punto clave 3"],
   "specific_articles": ["Art. X", "Sección Y", "Párrafo Z"],
@@ -786,165 +899,770 @@ Devuelve ÚNICAMENTE un objeto JSON válido:
   "confidence": "alta|media|baja",
   "missing_info": "Qué información específica falta (si aplica)",
   "cross_references": ["Conexión específica entre secciones"]
-}}
-
---- CONTEXTO ---
+}
+"""
+# Solo la parte variable va en el mensaje del usuario
+RAG_PROMPT_TEMPLATE = """--- CONTEXTO ---
 {contexto}
 --- PREGUNTA ---
 {user_text}
 """
+CLARIFY_INSTRUCTION = "\n\nIMPORTANTE: Si la petición es una aclaración o simplificación, responde en lenguaje sencillo, sin tecnicismos, manteniendo la precisión y basándote en el CONTEXTO."
 
-            # si es clarificación, añadir instrucción para simplificar el lenguaje
-            prompt = prompt_template.format(contexto=contexto, user_text=user_text)
-            if is_clarify:
-                prompt += "\n\nIMPORTANTE: Si la petición es una aclaración o simplificación, responde en lenguaje sencillo, sin tecnicismos, manteniendo la precisión y basándote en el CONTEXTO."
+# Campos de lista del JSON estructurado que se envían parcialmente en /chat/stream
+STREAMED_LIST_FIELDS = ("key_points", "specific_articles", "exact_quotes", "cross_references")
 
-            try:
-                ai_response = client.chat.completions.create(
-                    model="gpt-4o-mini",
-                    messages=[
-                        {"role": "system", "content": "Eres un asistente útil y preciso. Responde en JSON según lo solicitado."},
-                        {"role": "user", "content": prompt}
-                    ]
-                )
-            except Exception as e:
-                # si falla la conexión con OpenAI, intentar devolver cache si existe
-                print("⚠ Error en RAG:", e)
-                if cache_key in QA_CACHE:
-                    return jsonify(QA_CACHE[cache_key])
-                return jsonify({"response": "Error: no se pudo conectar al servicio de IA. Intenta de nuevo más tarde.", "error": str(e)})
 
-            respuesta_gpt = ai_response.choices[0].message.content
+def is_trivial_message(user_text: str) -> bool:
+    """Detecta peticiones triviales (saludos, agradecimientos) que se responden localmente."""
+    lower = user_text.lower().strip()
+    tokens = re.findall(r"\w+", lower)
+    return any(tok in GREETING_KEYWORDS for tok in tokens) or lower in GREETING_PHRASES
+
 
-            # Intentar parsear la respuesta como JSON estructurado.
-            # Si no es JSON puro, intentar extraer el primer objeto JSON dentro del texto.
-            parsed = None
+def is_clarify_request(user_text: str) -> bool:
+    """Detecta si es una petición de aclaración / simplificación."""
+    lower = user_text.lower().strip()
+    return any(kw in lower for kw in CLARIFY_KEYWORDS)
+
+
+def cluster_response(user_text: str) -> dict:
+    """Respaldo sin LLM: respuesta predefinida según el clúster de la pregunta."""
+    model, vectorizer = get_cluster_model()
+    cluster = safe_predict_cluster(user_text, model, vectorizer)
+    return {"response": get_respuesta_by_tipo(CLUSTER_TO_RESPONSE_TYPE.get(cluster, "no_entiendo"))}
+
+
+def trivial_response(user_text: str) -> dict:
+    """Respuesta corta con el modelo de clústers o respuestas predefinidas."""
+    try:
+        model, vectorizer = get_cluster_model()
+        cluster = predict_cluster(model, vectorizer, user_text)
+        # Usar el nuevo sistema de respuestas profesionales
+        response_type = CLUSTER_TO_RESPONSE_TYPE.get(cluster, "no_entiendo")
+        return {"response": get_respuesta_by_tipo(response_type)}
+    except Exception:
+        return {"response": "Hola — ¿en qué puedo ayudarte?"}
+
+
+def embed_query(vector_db, user_text: str):
+    """Calcula el embedding de la pregunta (una sola vez por petición, LRU entre peticiones) o None si falla."""
+    try:
+        embedder = getattr(vector_db, "embeddings", None) or query_embeddings()
+        return QUERY_EMBEDDINGS.embed(embedder, user_text)
+    except Exception as e:
+        print(f"⚠ Error generando embedding de la consulta: {e}")
+        return None
+
+
+def ann_search_kwargs(form):
+    """Parámetros ANN opcionales de la petición (nprobe para IVF, ef_search para HNSW)."""
+    kwargs = {}
+    for name in ("nprobe", "ef_search"):
+        try:
+            value = int(form.get(name, 0))
+        except (TypeError, ValueError):
+            continue
+        if value > 0:
+            kwargs[name] = min(value, 4096)
+    return kwargs
+
+
+def parse_search_filter(form, vector_db=None):
+    """
+    Filtro de metadatos de la petición: `document` (repetible), `corpus` (un
+    corpus_id) y `since`/`until` (fechas ISO de ingesta), como campos sueltos o
+    en un objeto `filter` del JSON. Devuelve el filtro normalizado o None.
+    ValueError si una fecha no es ISO o, con `vector_db`, si el corpus no existe.
+    """
+    spec = form.get("filter") if isinstance(form.get("filter"), dict) else form
+    fields = {name: spec.get(name) for name in FILTER_FIELDS}
+    if hasattr(spec, "getlist"):
+        fields["document"] = spec.getlist("document")
+    search_filter = normalize_filter(fields)
+    if search_filter and vector_db is not None and hasattr(vector_db, "check_filter"):
+        vector_db.check_filter(search_filter)
+    return search_filter
+
+
+def parse_tenant(form, headers):
+    """Tenant de la petición (cabecera X-Tenant-ID o campo `tenant`), o None para el corpus global.
+    ValueError si el identificador no es válido."""
+    tenant = (headers.get("X-Tenant-ID") or form.get("tenant") or "").strip()
+    return check_tenant(tenant) if tenant else None
+
+
+def parse_session_id(form, headers):
+    """session_id de la petición (campo `session_id` o cabecera X-Session-ID) si es un UUID válido."""
+    session_id = form.get("session_id") or headers.get("X-Session-ID")
+    if not session_id:
+        return None
+    try:
+        return str(uuid.UUID(str(session_id)))
+    except ValueError:
+        return None
+
+
+def cache_namespace(corpus_id: str, search_filter=None, tenant=None) -> str:
+    """Espacio de los caches: el corpus (del tenant, si hay) y el filtro si la búsqueda no es sobre todo el corpus."""
+    namespace = corpus_id if not tenant else f"{tenant}:{corpus_id}"
+    if not search_filter:
+        return namespace
+    return namespace + "|" + filter_key(search_filter)
+
+
+def invalid_filter_response(error):
+    return jsonify({"response": f"Filtro inválido: {error}", "error": str(error)}), 400
+
+
+def invalid_tenant_response(error):
+    return jsonify({"response": str(error), "error": str(error)}), 400
+
+
+def rag_k(is_clarify: bool) -> int:
+    return 6 if is_clarify else 3  # Reducir k para mayor velocidad
+
+
+def retrieve_rag_context(vector_db, user_text: str, is_clarify: bool, query_vector=None, search_kwargs=None,
+                         deadline=None):
+    """Busca los chunks relevantes y devuelve (contexto, fuentes, confianza derivada).
+    `deadline` es el plazo de la petición, del que se descuenta la compresión del contexto."""
+    # obtener documentos relevantes con score optimizado para velocidad
+    search_start = time.time()
+    k = rag_k(is_clarify)
+    search_kwargs = search_kwargs or {}
+    # results devuelve una lista de tuplas (Document, score)
+    if query_vector is not None:
+        # con el texto, la vector DB fusiona el ranking vectorial con BM25
+        results = vector_db.similarity_search_with_score_by_vector(
+            query_vector, k=k, query_text=user_text, **search_kwargs)
+    else:
+        results = vector_db.similarity_search_with_score(user_text, k=k, **search_kwargs)
+    search_time = time.time() - search_start
+    print(f"🔍 Búsqueda híbrida completada en {search_time:.3f}s")
+    return build_rag_context(results, user_text, query_vector, deadline)
+
+
+def build_rag_context(results: list, user_text: str, query_vector=None, deadline=None):
+    """(contexto, fuentes, confianza derivada) a partir de los resultados [(Document, score)]."""
+    # Filtrar resultados por score de relevancia más estricto (menor score = más relevante).
+    # Las coincidencias léxicas (números de matrícula, artículos...) se conservan aunque
+    # su distancia vectorial sea alta.
+    filtered_results = [
+        (d, s) for d, s in results
+        if s < 0.8 or d.metadata.get("retrieval") in ("lexical", "both")
+    ]
+    if not filtered_results:
+        filtered_results = results[:1]  # Solo el mejor resultado como fallback
+
+    # Ajustar el contexto al presupuesto de tokens: sin casi duplicados y, si no cabe,
+    # solo las oraciones más cercanas a la pregunta
+    from chatbot.context import assemble_context
+
+    # con chunking jurídico el contexto es la disposición completa de cada hijo encontrado (una vez)
+    texts = list(dict.fromkeys(d.metadata.get("parent_content") or d.page_content for d, s in filtered_results))
+    contexto, info = assemble_context(
+        texts, user_text, CONTEXT_TOKEN_BUDGET,
+        query_vector=query_vector,
+        embed=sentence_embedder(deadline))
+    compressed = f" (comprimido de {info['original_tokens']})" if info["compressed"] else ""
+    print(f"📋 Contexto optimizado: {info['sections']} secciones, {info['tokens']} tokens{compressed}")
+
+    # construir lista de fuentes con metadatos para devolver al frontend
+    sources = []
+    for d, s in results:
+        metadata = d.metadata if hasattr(d, 'metadata') else {}
+        sources.append({
+            "text_snippet": d.page_content[:500],
+            "source": metadata.get("source", metadata.get("source_id", "unknown")),
+            "page": metadata.get("page", None),
+            "section": metadata.get("section_path") or None,
+            "score": float(s),
+            # otras apariciones del mismo texto, colapsadas en la ingesta
+            "references": metadata.get("references", [])
+        })
+
+    # Heurística simple para calcular 'confidence' a partir de las puntuaciones de FAISS
+    # Asumimos que FAISS devuelve distancias (valores más bajos => más cercanos/relevantes).
+    derived_confidence = None
+    try:
+        scores = [abs(item.get("score", 0)) for item in sources if item.get("score") is not None]
+        if len(scores) > 0:
+            min_score = min(scores)
+            conf_value = 1.0 / (1.0 + min_score)
+            if conf_value > 0.7:
+                derived_confidence = "alta"
+            elif conf_value > 0.4:
+                derived_confidence = "media"
+            else:
+                derived_confidence = "baja"
+        else:
+            derived_confidence = "baja"
+    except Exception:
+        derived_confidence = "baja"
+
+    return contexto, sources, derived_confidence
+
+
+def build_rag_messages(contexto: str, user_text: str, is_clarify: bool) -> list:
+    """Arma los mensajes para el LLM a partir del contexto recuperado."""
+    prompt = RAG_PROMPT_TEMPLATE.format(contexto=contexto, user_text=user_text)
+    # si es clarificación, añadir instrucción para simplificar el lenguaje
+    if is_clarify:
+        prompt += CLARIFY_INSTRUCTION
+    return [
+        {"role": "system", "content": RAG_SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
+
+
+def parse_llm_json(respuesta_gpt: str):
+    """Intenta parsear la respuesta como JSON estructurado.
+    Si no es JSON puro, intenta extraer el primer objeto JSON dentro del texto."""
+    try:
+        return json.loads(respuesta_gpt)
+    except Exception:
+        # limpiar fences y buscar primer { ... }
+        clean = respuesta_gpt.strip()
+        # remover fences ```json ... ``` y ``` ... ```
+        clean = re.sub(r"```\w*", "", clean)
+        # localizar la primera { y la última }
+        start = clean.find('{')
+        end = clean.rfind('}')
+        if start != -1 and end != -1 and end > start:
             try:
-                parsed = json.loads(respuesta_gpt)
+                return json.loads(clean[start:end+1])
             except Exception:
-                # limpiar fences y buscar primer { ... }
-                clean = respuesta_gpt.strip()
-                # remover fences ```json ... ``` y ``` ... ```
-                clean = re.sub(r"```\w*", "", clean)
-                # localizar la primera { y la última }
-                start = clean.find('{')
-                end = clean.rfind('}')
-                if start != -1 and end != -1 and end > start:
-                    try:
-                        candidate = clean[start:end+1]
-                        parsed = json.loads(candidate)
-                    except Exception:
-                        parsed = None
-
-            if parsed:
-                answer = parsed.get("answer", parsed.get("response", None))
-                
-                # Si el LLM devolvió NO_ENCONTRADO, usar el mensaje específico requerido
-                if answer and (answer.strip().upper() == "NO_ENCONTRADO" or "no encuentro" in answer.lower() or "no se encuentra" in answer.lower()):
-                    missing_info = parsed.get("missing_info", "")
-                    base_message = "La respuesta específica a esta pregunta no se encuentra en los documentos legales cargados"
-                    if missing_info:
-                        answer = f"{base_message}. Para responder necesitaría información sobre: {missing_info}"
-                    else:
-                        answer = base_message
-                
-                # Extraer nueva estructura de respuesta
-                key_points = parsed.get("key_points", [])
-                specific_articles = parsed.get("specific_articles", [])
-                exact_quotes = parsed.get("exact_quotes", [])
-                missing_info = parsed.get("missing_info", "")
-                
-                parsed_sources = parsed.get("sources", sources)
-                confidence = parsed.get("confidence", None) or derived_confidence
-                cross_references = parsed.get("cross_references", [])
-                
-                # Payload mejorado con nueva estructura
-                payload = {
-                    "response": answer,
-                    "key_points": key_points,
-                    "specific_articles": specific_articles,
-                    "exact_quotes": exact_quotes,
-                    "sources": parsed_sources, 
-                    "confidence": confidence, 
-                    "cross_references": cross_references,
-                    "missing_info": missing_info,
-                    "response_time": f"{time.time() - start_time:.2f}s" if 'start_time' in locals() else "N/A"
-                }
-                
-                # guardar en cache y Supabase
-                try:
-                    save_conversation_to_db(user_text, answer, parsed_sources, confidence, exact_quotes, cross_references)
-                except Exception as e:
-                    print(f"⚠ Error guardando en Supabase: {e}")
-                
-                print(f"✅ Respuesta generada: {len(answer)} chars, {len(key_points)} puntos clave")
-                return respond_and_cache(cache_key, payload)
+                return None
+    return None
+
+
+def persist_rag_answer(user_text: str, payload: dict, corpus_id: str = None, session_id: str = None,
+                       tenant: str = None):
+    """Encola para Supabase una respuesta RAG ya estructurada y su evento de analytics."""
+    try:
+        # la respuesta de texto plano (el LLM no devolvió JSON) no trae citas ni referencias cruzadas
+        save_conversation_to_db(user_text, payload["response"], payload.get("sources", []), payload.get("confidence"),
+                                payload.get("exact_quotes", []), payload.get("cross_references", []), corpus_id,
+                                session_id=session_id, tenant=tenant)
+        log_analytics_event("question", {"confidence": payload.get("confidence"), "sources": len(payload.get("sources", [])),
+                                         "response_time": payload.get("response_time"), "corpus_id": corpus_id,
+                                         "tenant": tenant})
+    except Exception as e:
+        print(f"⚠ Error guardando en Supabase: {e}")
+
+
+def finalize_rag_answer(respuesta_gpt: str, sources: list, derived_confidence, user_text: str, start_time: float,
+                        persist: bool = True, corpus_id: str = None, session_id: str = None,
+                        tenant: str = None) -> dict:
+    """Convierte el texto del LLM en el payload que consume el frontend.
+    Con `persist=False` el llamador se encarga de guardar en Supabase (persist_rag_answer)."""
+    parsed = parse_llm_json(respuesta_gpt)
+
+    if parsed:
+        answer = parsed.get("answer", parsed.get("response", None))
+
+        # Si el LLM devolvió NO_ENCONTRADO, usar el mensaje específico requerido
+        if answer and (answer.strip().upper() == "NO_ENCONTRADO" or "no encuentro" in answer.lower() or "no se encuentra" in answer.lower()):
+            missing_info = parsed.get("missing_info", "")
+            if missing_info:
+                answer = f"{NOT_FOUND_MESSAGE}. Para responder necesitaría información sobre: {missing_info}"
             else:
-                # fallback: LLM no devolvió JSON; intentar extraer texto plano legible
-                text_ans = respuesta_gpt.strip()
-                # si el texto es un JSON textual mostrado, intentar extraer answer con regex
-                m = re.search(r'"answer"\s*:\s*"([^"]+)"', text_ans)
-                if m:
-                    text_only = m.group(1)
-                    # Usar mensaje específico requerido para NO_ENCONTRADO
-                    if text_only.strip().upper() == "NO_ENCONTRADO":
-                        text_only = "La respuesta específica a esta pregunta no se encuentra en los documentos legales cargados"
-                else:
-                    # quitar saltos y limitar longitud
-                    text_only = text_ans[:2000]
-                    # Si contiene NO_ENCONTRADO, usar mensaje específico
-                    if "NO_ENCONTRADO" in text_only.upper() or "no encuentro" in text_only.lower():
-                        text_only = "La respuesta específica a esta pregunta no se encuentra en los documentos legales cargados"
+                answer = NOT_FOUND_MESSAGE
+
+        # Extraer nueva estructura de respuesta
+        key_points = parsed.get("key_points", [])
+        specific_articles = parsed.get("specific_articles", [])
+        exact_quotes = parsed.get("exact_quotes", [])
+        missing_info = parsed.get("missing_info", "")
+
+        parsed_sources = parsed.get("sources", sources)
+        confidence = parsed.get("confidence", None) or derived_confidence
+        cross_references = parsed.get("cross_references", [])
+
+        # Payload mejorado con nueva estructura
+        payload = {
+            "response": answer,
+            "key_points": key_points,
+            "specific_articles": specific_articles,
+            "exact_quotes": exact_quotes,
+            "sources": parsed_sources,
+            "confidence": confidence,
+            "cross_references": cross_references,
+            "missing_info": missing_info,
+            "response_time": f"{time.time() - start_time:.2f}s"
+        }
+
+        # guardar en Supabase
+        if persist:
+            persist_rag_answer(user_text, payload, corpus_id, session_id, tenant)
+
+        print(f"✅ Respuesta generada: {len(answer or '')} chars, {len(key_points)} puntos clave")
+        return payload
+
+    # fallback: LLM no devolvió JSON; intentar extraer texto plano legible
+    text_ans = respuesta_gpt.strip()
+    # si el texto es un JSON textual mostrado, intentar extraer answer con regex
+    m = re.search(r'"answer"\s*:\s*"([^"]+)"', text_ans)
+    if m:
+        text_only = m.group(1)
+        # Usar mensaje específico requerido para NO_ENCONTRADO
+        if text_only.strip().upper() == "NO_ENCONTRADO":
+            text_only = NOT_FOUND_MESSAGE
+    else:
+        # quitar saltos y limitar longitud
+        text_only = text_ans[:2000]
+        # Si contiene NO_ENCONTRADO, usar mensaje específico
+        if "NO_ENCONTRADO" in text_only.upper() or "no encuentro" in text_only.lower():
+            text_only = NOT_FOUND_MESSAGE
+
+    payload = {"response": text_only, "sources": sources, "confidence": derived_confidence}
+    if persist:
+        persist_rag_answer(user_text, payload, corpus_id, session_id, tenant)
+    return payload
 
-                payload = {"response": text_only, "sources": sources, "confidence": derived_confidence}
-                return respond_and_cache(cache_key, payload)
+
+@bp.route("/chat", methods=["POST"])
+def chat():
+    start_time = time.time()
+    user_text = request.form.get("message", "").strip()
+    search_kwargs = ann_search_kwargs(request.form)
+
+    if not user_text:
+        return jsonify({"response": "Por favor escribe algo 😅"})
+    
+    print(f"🔍 Consulta recibida: {user_text[:100]}...")
+
+    # Detectar peticiones triviales (saludos, agradecimientos) y manejar localmente
+    if is_trivial_message(user_text):
+        return jsonify(trivial_response(user_text))
+
+    # Detectar si es una petición de aclaración / simplificación
+    is_clarify = is_clarify_request(user_text)
+
+    # ==========================================================
+    # 1️⃣ RAG (si existe base vectorial)
+    # ==========================================================
+    try:
+        tenant = parse_tenant(request.form, request.headers)
+    except ValueError as e:
+        return invalid_tenant_response(e)
+    session_id = parse_session_id(request.form, request.headers)
+
+    vector_db = load_vector_db_if_needed(tenant)
+    if vector_db is not None:
+        try:
+            search_filter = parse_search_filter(request.form, vector_db)
+        except ValueError as e:
+            return invalid_filter_response(e)
+        if search_filter:
+            search_kwargs["filter"] = search_filter
+        # el embedding de la pregunta gasta su parte; la generación recibe lo que quede
+        deadline = Deadline(RAG_TIMEOUT)
+        try:
+            # antes de llamar a la API, chequear cache por pregunta+corpus(+tenant, filtro)
+            corpus_id = get_corpus_id(tenant)
+            namespace = cache_namespace(corpus_id, search_filter, tenant)
+            cache_key = make_key(user_text + "|" + namespace)
+            
+            # Verificar cache inteligente
+            cached_response = get_cached_response(cache_key)
+            if cached_response:
+                print(f"🚀 Respuesta desde cache para: {user_text[:50]}...")
+                return jsonify(cached_response)
+
+            # Cache semántico antes de la búsqueda: un acierto evita búsqueda y LLM
+            query_vector = embed_query(vector_db, user_text)
+            if not is_clarify:
+                semantic_response = get_semantic_cached_response(namespace, query_vector)
+                if semantic_response:
+                    print(f"🧠 Respuesta desde cache semántico ({semantic_response['similarity']}): {user_text[:50]}...")
+                    return jsonify(semantic_response)
+
+            # Peticiones idénticas simultáneas (en este u otros workers) esperan a una sola llamada
+            with INFLIGHT.claim(cache_key) as waited:
+                if waited:
+                    cached_response = get_cached_response(cache_key)
+                    if cached_response:
+                        print(f"🛬 Respuesta compartida de petición en vuelo: {user_text[:50]}...")
+                        return jsonify(cached_response)
+
+                contexto, sources, derived_confidence = retrieve_rag_context(
+                    vector_db, user_text, is_clarify, query_vector, search_kwargs, deadline)
+
+                try:
+                    ai_response = LLM.chat(build_rag_messages(contexto, user_text, is_clarify), deadline=deadline)
+                except Exception as e:
+                    # si falla la conexión con OpenAI, intentar devolver cache si existe
+                    print("⚠ Error en RAG:", e)
+                    fallback = get_cached_response(cache_key)
+                    if fallback is not None:
+                        return jsonify(fallback)
+                    if isinstance(e, LLMUnavailable):
+                        # sin tiempo o con el circuito abierto: directo a los clústers
+                        return jsonify(cluster_response(user_text))
+                    return jsonify({"response": "Error: no se pudo conectar al servicio de IA. Intenta de nuevo más tarde.", "error": str(e)})
+
+                respuesta_gpt = ai_response.choices[0].message.content
+                payload = finalize_rag_answer(respuesta_gpt, sources, derived_confidence, user_text, start_time,
+                                              corpus_id=corpus_id, session_id=session_id, tenant=tenant)
+                return respond_and_cache(cache_key, payload, namespace, None if is_clarify else query_vector)
 
         except Exception as e:
             print("⚠ Error en RAG:", e)
+            log_analytics_event("error", {"stage": "rag", "error": str(e)[:200]})
 
     # ==========================================================
     # 2️⃣ GPT normal si no hay vector DB
     # ==========================================================
     try:
-        ai_response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "Eres un asistente amable y útil."},
-                {"role": "user", "content": user_text}
-            ]
-        )
+        ai_response = LLM.chat([
+            {"role": "system", "content": "Eres un asistente amable y útil."},
+            {"role": "user", "content": user_text}
+        ], timeout=GPT_TIMEOUT)
         respuesta_gpt = ai_response.choices[0].message.content
         return jsonify({"response": respuesta_gpt})
-    except TimeoutError as e:
-        print("⚠ OpenAI timeout (GPT):", e)
-        # fallback rápido a respuestas por clusters o estático
-        try:
-            cluster = predict_cluster(model, vectorizer, user_text) if model is not None else None
-            response = get_respuesta_by_tipo(CLUSTER_TO_RESPONSE_TYPE.get(cluster, "no_entiendo")) if cluster is not None else "Lo siento, estoy tardando mucho. ¿Puedes intentarlo en unos segundos?"
-            return jsonify({"response": response})
-        except Exception:
-            return jsonify({"response": "Lo siento, estoy tardando mucho. Intenta más tarde."})
+    except LLMUnavailable as e:
+        print("⚠ OpenAI no disponible (GPT):", e)
     except Exception as e:
         print("⚠ Error con OpenAI:", e)
 
     # ==========================================================
     # 3️⃣ Backup con clústers
     # ==========================================================
-    cluster = safe_predict_cluster(user_text, model, vectorizer)
-    response_type = CLUSTER_TO_RESPONSE_TYPE.get(cluster, "no_entiendo")
-    response = get_respuesta_by_tipo(response_type)
-    return jsonify({"response": response})
+    return jsonify(cluster_response(user_text))
+
+
+# --- CHAT EN STREAMING (SSE) ---
+@bp.route("/chat/stream", methods=["POST"])
+def chat_stream():
+    """Variante de /chat que envía Server-Sent Events:
+    `sources` apenas termina la búsqueda, `token`/`partial` mientras el LLM genera
+    y `done` con el mismo payload que devolvería /chat (ya guardado en cache)."""
+    start_time = time.time()
+    user_text = request.form.get("message", "").strip()
+    search_kwargs = ann_search_kwargs(request.form)
+    sse_headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+    try:
+        tenant = parse_tenant(request.form, request.headers)
+    except ValueError as e:
+        return invalid_tenant_response(e)
+    session_id = parse_session_id(request.form, request.headers)
+
+    vector_db = None
+    if user_text and not is_trivial_message(user_text):
+        vector_db = load_vector_db_if_needed(tenant)
+    if vector_db is None:
+        # Sin RAG no hay nada que transmitir: reutilizar la respuesta de /chat
+        return Response(format_sse("done", chat().get_json()), mimetype="text/event-stream", headers=sse_headers)
+
+    try:
+        search_filter = parse_search_filter(request.form, vector_db)
+    except ValueError as e:
+        return invalid_filter_response(e)
+    if search_filter:
+        search_kwargs["filter"] = search_filter
+
+    print(f"🔍 Consulta recibida (stream): {user_text[:100]}...")
+    deadline = Deadline(RAG_TIMEOUT)
+    is_clarify = is_clarify_request(user_text)
+    corpus_id = get_corpus_id(tenant)
+    namespace = cache_namespace(corpus_id, search_filter, tenant)
+    cache_key = make_key(user_text + "|" + namespace)
+
+    def generate():
+        cached_response = get_cached_response(cache_key)
+        if cached_response:
+            print(f"🚀 Respuesta desde cache para: {user_text[:50]}...")
+            yield format_sse("done", cached_response)
+            return
+
+        query_vector = embed_query(vector_db, user_text)
+        if not is_clarify:
+            semantic_response = get_semantic_cached_response(namespace, query_vector)
+            if semantic_response:
+                yield format_sse("done", semantic_response)
+                return
+
+        with INFLIGHT.claim(cache_key) as waited:
+            if waited:
+                cached_response = get_cached_response(cache_key)
+                if cached_response:
+                    yield format_sse("done", cached_response)
+                    return
+
+            try:
+                contexto, sources, derived_confidence = retrieve_rag_context(
+                    vector_db, user_text, is_clarify, query_vector, search_kwargs, deadline)
+            except Exception as e:
+                print("⚠ Error en RAG (stream):", e)
+                yield format_sse("error", {"response": get_respuesta_by_tipo("error_procesamiento"), "error": str(e)})
+                return
+
+            # Las fuentes se envían antes de que el LLM empiece a generar
+            yield format_sse("sources", {"sources": sources, "confidence": derived_confidence})
+
+            respuesta_gpt = ""
+            sent_answer = ""
+            sent_lists = {}
+            try:
+                stream = LLM.chat(build_rag_messages(contexto, user_text, is_clarify),
+                                  deadline=deadline, stream=True)
+                for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content or ""
+                    if not delta:
+                        continue
+                    respuesta_gpt += delta
+
+                    partial = parse_partial_json(respuesta_gpt)
+                    answer = partial.get("answer")
+                    if isinstance(answer, str) and len(answer) > len(sent_answer) and answer.startswith(sent_answer):
+                        yield format_sse("token", {"delta": answer[len(sent_answer):]})
+                        sent_answer = answer
+                    for field in STREAMED_LIST_FIELDS:
+                        items = partial.get(field)
+                        if isinstance(items, list) and len(items) > len(sent_lists.get(field, [])):
+                            sent_lists[field] = items
+                            yield format_sse("partial", {field: items})
+            except Exception as e:
+                print("⚠ Error en RAG (stream):", e)
+                fallback = get_cached_response(cache_key)
+                if fallback is not None:
+                    yield format_sse("done", fallback)
+                elif isinstance(e, LLMUnavailable) and not respuesta_gpt:
+                    yield format_sse("done", cluster_response(user_text))
+                else:
+                    yield format_sse("error", {"response": "Error: no se pudo conectar al servicio de IA. Intenta de nuevo más tarde.", "error": str(e)})
+                return
+
+            payload = finalize_rag_answer(respuesta_gpt, sources, derived_confidence, user_text, start_time,
+                                          corpus_id=corpus_id, session_id=session_id, tenant=tenant)
+            yield format_sse("done", cache_payload(cache_key, payload, namespace,
+                                                  None if is_clarify else query_vector))
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream", headers=sse_headers)
+
+
+# --- PREGUNTAS EN LOTE (CHECKLISTS DE DUE DILIGENCE) ---
+BATCH_MAX_QUESTIONS = 200
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))  # generaciones simultáneas por lote
+
+
+def embed_questions(vector_db, questions: list):
+    """Embeddings de todas las preguntas (las que no estén en el LRU, en una sola petición), o None si falla."""
+    try:
+        embedder = getattr(vector_db, "embeddings", None) or query_embeddings()
+        return QUERY_EMBEDDINGS.embed_many(embedder, questions)
+    except Exception as e:
+        print(f"⚠ Error generando embeddings del lote: {e}")
+        return None
+
+
+def answer_batch_question(vector_db, question: str, cache_key: str, corpus_id: str,
+                          query_vector=None, results=None, search_kwargs=None, namespace=None, tenant=None):
+    """Responde una pregunta del lote (en un hilo del pool). Devuelve (payload, estado)."""
+    start_time = time.time()
+    is_clarify = is_clarify_request(question)
+    with INFLIGHT.claim(cache_key) as waited:
+        if waited:
+            cached_response = get_cached_response(cache_key)
+            if cached_response:
+                return cached_response, "cached"
+        deadline = Deadline(RAG_TIMEOUT)
+        if results is None:
+            contexto, sources, derived_confidence = retrieve_rag_context(
+                vector_db, question, is_clarify, query_vector, search_kwargs, deadline)
+        else:
+            contexto, sources, derived_confidence = build_rag_context(results, question, query_vector, deadline)
+        ai_response = LLM.chat(build_rag_messages(contexto, question, is_clarify), deadline=deadline)
+        payload = finalize_rag_answer(ai_response.choices[0].message.content, sources, derived_confidence,
+                                      question, start_time, corpus_id=corpus_id, tenant=tenant)
+        return cache_payload(cache_key, payload, namespace or corpus_id,
+                             None if is_clarify else query_vector), "generated"
+
+
+def answer_batch(questions: list, search_kwargs=None, tenant=None):
+    """
+    Responde una lista de preguntas contra el corpus actual. Genera un dict por
+    pregunta ({"index", "question", "status", ...payload}) a medida que terminan
+    y al final un resumen {"done": true, ...}.
+    Las preguntas repetidas se responden una vez; los caches se consultan antes
+    de embeber; las que faltan se embeben en una sola petición y se buscan con
+    una consulta matricial; la generación corre con BATCH_CONCURRENCY hilos.
+    """
+    started = time.time()
+    counts = {"cached": 0, "semantic": 0, "generated": 0, "error": 0}
+
+    def line(index, status, payload):
+        counts[status] += 1
+        return {"index": index, "question": questions[index], "status": status, **payload}
+
+    vector_db = wait_for_vector_db(READY_TIMEOUT, tenant)
+    if vector_db is None:
+        for index in range(len(questions)):
+            yield line(index, "error", {"response": "No hay documentos cargados para responder el lote."})
+        yield {"done": True, "total": len(questions), **counts, "elapsed": f"{time.time() - started:.2f}s"}
+        return
+
+    corpus_id = get_corpus_id(tenant)
+    search_kwargs = search_kwargs or {}
+    namespace = cache_namespace(corpus_id, search_kwargs.get("filter"), tenant)
+    groups = {}  # cache_key -> índices de las preguntas idénticas
+    for index, question in enumerate(questions):
+        groups.setdefault(make_key(question + "|" + namespace), []).append(index)
+
+    # 1️⃣ cache exacto compartido por todo el lote
+    pending = []
+    for cache_key, indexes in groups.items():
+        cached_response = get_cached_response(cache_key)
+        if cached_response:
+            for index in indexes:
+                yield line(index, "cached", cached_response)
+        else:
+            pending.append(cache_key)
+
+    # 2️⃣ una sola petición de embeddings para las que faltan + cache semántico
+    texts = [questions[groups[key][0]] for key in pending]
+    vectors = embed_questions(vector_db, texts) if texts else []
+    to_generate = []
+    for position, cache_key in enumerate(pending):
+        query_vector = vectors[position] if vectors else None
+        text = texts[position]
+        semantic_response = None
+        if query_vector is not None and not is_clarify_request(text):
+            semantic_response = get_semantic_cached_response(namespace, query_vector)
+        if semantic_response:
+            for index in groups[cache_key]:
+                yield line(index, "semantic", semantic_response)
+        else:
+            to_generate.append((cache_key, text, query_vector))
+
+    # 3️⃣ búsqueda FAISS como una sola consulta matricial
+    results = [None] * len(to_generate)
+    if vectors and to_generate and hasattr(vector_db, "similarity_search_with_score_by_vectors"):
+        k = max(rag_k(is_clarify_request(text)) for _, text, _ in to_generate)
+        try:
+            found = vector_db.similarity_search_with_score_by_vectors(
+                [v for _, _, v in to_generate], k=k, query_texts=[t for _, t, _ in to_generate], **search_kwargs)
+            results = [hits[:rag_k(is_clarify_request(text))] for hits, (_, text, _) in zip(found, to_generate)]
+        except Exception as e:
+            print(f"⚠ Error en la búsqueda del lote (se buscará pregunta por pregunta): {e}")
+    print(f"📦 Lote: {len(questions)} preguntas, {len(to_generate)} a generar")
+
+    # 4️⃣ generación con concurrencia limitada, resultados en orden de llegada
+    if to_generate:
+        with ThreadPoolExecutor(max_workers=max(1, min(BATCH_CONCURRENCY, len(to_generate)))) as pool:
+            futures = {
+                pool.submit(answer_batch_question, vector_db, text, cache_key, corpus_id,
+                            query_vector, hits, search_kwargs, namespace, tenant): cache_key
+                for (cache_key, text, query_vector), hits in zip(to_generate, results)
+            }
+            for future in as_completed(futures):
+                try:
+                    payload, status = future.result()
+                except Exception as e:
+                    print(f"⚠ Error respondiendo pregunta del lote: {e}")
+                    payload, status = {"response": get_respuesta_by_tipo("error_procesamiento"), "error": str(e)}, "error"
+                for index in groups[futures[future]]:
+                    yield line(index, status, payload)
+
+    yield {"done": True, "total": len(questions), **counts, "elapsed": f"{time.time() - started:.2f}s"}
+
+
+def parse_batch_questions(data, form) -> list:
+    """Preguntas del cuerpo JSON ({"questions": [...]}) o del campo de formulario (una por línea)."""
+    questions = data.get("questions") if data else None
+    if questions is None:
+        questions = form.get("questions", "").splitlines()
+    return [q.strip() for q in questions if isinstance(q, str) and q.strip()]
+
+
+@bp.route("/chat/batch", methods=["POST"])
+def chat_batch():
+    """Responde un checklist de preguntas y devuelve JSON Lines en streaming (una línea por pregunta)."""
+    data = request.get_json(silent=True) or {}
+    questions = parse_batch_questions(data, request.form)
+    if not questions:
+        return jsonify({"error": "Envía al menos una pregunta en `questions`"}), 400
+    if len(questions) > BATCH_MAX_QUESTIONS:
+        return jsonify({"error": f"Máximo {BATCH_MAX_QUESTIONS} preguntas por lote"}), 400
+    search_kwargs = ann_search_kwargs(data or request.form)
+    try:
+        tenant = parse_tenant(data or request.form, request.headers)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        search_filter = parse_search_filter(data or request.form, TENANTS.get(tenant) if tenant else VECTOR_DB)
+    except ValueError as e:
+        return jsonify({"error": f"Filtro inválido: {e}"}), 400
+    if search_filter:
+        search_kwargs["filter"] = search_filter
+
+    def generate():
+        for item in answer_batch(questions, search_kwargs, tenant):
+            yield json.dumps(item, ensure_ascii=False) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@bp.cli.command("batch")
+@click.argument("questions_file", type=click.File("r", encoding="utf-8"))
+@click.option("--output", "-o", type=click.File("w", encoding="utf-8"), default="-",
+              help="Archivo JSON Lines de salida (por defecto, la salida estándar).")
+@click.option("--nprobe", type=int, default=0, help="Listas IVF visitadas por búsqueda.")
+@click.option("--ef-search", type=int, default=0, help="Amplitud de búsqueda HNSW.")
+@click.option("--document", multiple=True, help="Buscar solo en este documento (repetible).")
+@click.option("--corpus", default="", help="Buscar solo en los documentos de esta versión del corpus.")
+@click.option("--tenant", default="", help="Responder contra la vector DB de este tenant.")
+def batch_command(questions_file, output, nprobe, ef_search, document, corpus, tenant):
+    """Responde QUESTIONS_FILE (una pregunta por línea) contra el corpus cargado."""
+    try:
+        tenant = check_tenant(tenant) if tenant else None
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--tenant")
+    questions = parse_batch_questions(None, {"questions": questions_file.read()})
+    search_kwargs = ann_search_kwargs({"nprobe": nprobe, "ef_search": ef_search})
+    search_filter = parse_search_filter({"document": list(document), "corpus": corpus})
+    if search_filter:
+        search_kwargs["filter"] = search_filter
+    # los mensajes de progreso van a stderr para no mezclarse con el JSON Lines
+    with contextlib.redirect_stdout(sys.stderr):
+        for item in answer_batch(questions, search_kwargs, tenant):
+            output.write(json.dumps(item, ensure_ascii=False) + "\n")
+            output.flush()
 
 
 # --- HISTORIAL ---
-@app.route("/history", methods=["GET"])
+@bp.route("/history", methods=["GET"])
 def history():
-    """Devuelve el historial de conversaciones."""
+    """Historial paginado: ?limit=20&cursor=...&session_id=...&corpus_id=..."""
+    try:
+        limit = min(max(int(request.args.get("limit", HISTORY_PAGE_SIZE)), 1), HISTORY_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({"history": [], "error": "limit debe ser un número"}), 400
+    session_id = request.args.get("session_id") or None
+    if session_id:
+        try:
+            session_id = str(uuid.UUID(session_id))
+        except ValueError:
+            return jsonify({"history": [], "error": "session_id inválido"}), 400
+    try:
+        tenant = parse_tenant(request.args, request.headers)
+    except ValueError as e:
+        return jsonify({"history": [], "error": str(e)}), 400
+    try:
+        page = get_conversation_history(limit, request.args.get("cursor") or None, session_id,
+                                        request.args.get("corpus_id") or None, tenant)
+    except InvalidCursor:
+        return jsonify({"history": [], "error": "cursor inválido"}), 400
     try:
-        conversations = get_conversation_history(20)  # últimas 20 conversaciones
         # Limpiar y formatear datos para el frontend
         formatted_history = []
-        for conv in conversations:
+        for conv in page["items"]:
             formatted_history.append({
                 "id": conv.get("id"),
                 "question": conv.get("user_question"),
@@ -953,15 +1671,24 @@ def history():
                 "timestamp": conv.get("created_at"),
                 "has_cross_refs": bool(conv.get("cross_references") and conv.get("cross_references") != "[]")
             })
-        return jsonify({"history": formatted_history})
+        return jsonify({"history": formatted_history, "next_cursor": page["next_cursor"]})
     except Exception as e:
         print(f"⚠ Error obteniendo historial: {e}")
         return jsonify({"history": [], "error": "No se pudo obtener el historial"})
 
 
-@app.route('/vector_status', methods=['GET'])
+@bp.route('/vector_status', methods=['GET'])
 def vector_status():
-    """Devuelve el estado de la vector DB (cargada / cargando / ausente)."""
+    """Devuelve el estado de la vector DB (cargada / cargando / ausente), o la del tenant indicado."""
+    try:
+        tenant = parse_tenant(request.args, request.headers)
+    except ValueError as e:
+        return jsonify({"status": "error", "error": str(e)}), 400
+    if tenant:
+        db = TENANTS.get(tenant)
+        if db is None:
+            return jsonify({"status": "absent", "tenant": tenant, "corpus_id": get_corpus_id(tenant)})
+        return jsonify({"status": "loaded", "tenant": tenant, "corpus_id": get_corpus_id(tenant), **db.stats()})
     status = 'not_found'
     if VECTOR_DB is not None:
         status = 'loaded'
@@ -969,42 +1696,145 @@ def vector_status():
         status = 'loading'
     else:
         status = 'absent'
-    return jsonify({"status": status})
+    if VECTOR_DB is not None:
+        from chatbot.segments import SegmentedVectorStore
+        if isinstance(VECTOR_DB, SegmentedVectorStore):
+            return jsonify({"status": status, "corpus_id": get_corpus_id(), **VECTOR_DB.stats()})
+    return jsonify({"status": status, "corpus_id": get_corpus_id()})
+
+
+@bp.route('/partitions', methods=['GET'])
+def list_partitions():
+    """Particiones (documentos) de la vector DB (o la del tenant): segmento, rango, corpus_id y si están en memoria."""
+    try:
+        tenant = parse_tenant(request.args, request.headers)
+    except ValueError as e:
+        return jsonify({"partitions": [], "error": str(e)}), 400
+    db = TENANTS.get(tenant) if tenant else VECTOR_DB
+    if db is None or not hasattr(db, "partitions"):
+        return jsonify({"partitions": [], "corpus_id": get_corpus_id(tenant)})
+    return jsonify({"partitions": db.partitions(), "corpus_id": get_corpus_id(tenant)})
+
+
+@bp.route('/partitions/evict', methods=['POST'])
+def evict_partitions():
+    """Libera de la memoria los segmentos de `document` (o todos); se reabren en la siguiente búsqueda.
+    Con un tenant y sin `document` se cierra la vector DB entera del tenant."""
+    data = request.get_json(silent=True) or request.form
+    try:
+        tenant = parse_tenant(data, request.headers)
+    except ValueError as e:
+        return jsonify({"evicted": [], "error": str(e)}), 400
+    document = (data.get("document") or "").strip() or None
+    if tenant and document is None:
+        return jsonify({"evicted": [], "tenants": TENANTS.evict(tenant)})
+    db = TENANTS.get(tenant) if tenant else VECTOR_DB
+    if db is None or not hasattr(db, "evict"):
+        return jsonify({"evicted": []})
+    return jsonify({"evicted": db.evict(document)})
+
+
+@bp.route('/tenants', methods=['GET'])
+def tenants_status():
+    """Tenants con la vector DB abierta (más recientes al final), memoria que ocupan y desalojos del LRU."""
+    return jsonify(TENANTS.stats())
+
+
+@bp.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    """Contadores de los caches (respuestas exactas, semánticas, coalescencia y embeddings)."""
+    # el servicio de embeddings solo existe tras la primera ingesta de este worker
+    embeddings = EMBEDDINGS.get() if EMBEDDINGS.loaded else None
+    return jsonify({
+        "entries": len(QA_CACHE),
+        "semantic": SEMANTIC_CACHE.stats(),
+        "inflight_coalesced": INFLIGHT.coalesced,
+        "query_embeddings": QUERY_EMBEDDINGS.stats(),
+        "sentence_embeddings": SENTENCE_EMBEDDINGS.stats(),
+        "embeddings": embeddings.stats() if embeddings is not None else None
+    })
+
+
+@bp.route('/persistence_stats', methods=['GET'])
+def persistence_stats():
+    """Cola write-behind de Supabase: filas en cola, escritas, en el journal y fallos."""
+    return jsonify(PERSISTENCE.stats())
+
+
+@bp.route('/llm_stats', methods=['GET'])
+def llm_stats():
+    """Estado del circuit breaker y métricas de las llamadas al LLM (latencia, tokens, errores)."""
+    return jsonify(LLM.stats())
 
 
 # ==========================================================
-# 🏎️ OPTIMIZACIONES DE INICIALIZACIÓN
+# 🏎️ WARM-UP Y FÁBRICA DE LA APP
+# Importar main no hace llamadas de red ni entrena modelos: la vector DB,
+# el modelo de clústers y Supabase se cargan en el primer uso o al
+# llamar a /readyz (pensado como health check del despliegue).
 # ==========================================================
-def optimize_system_startup():
-    """Optimiza el sistema al iniciar para respuestas más rápidas."""
-    try:
-        print("🏎️ Optimizando sistema para máxima velocidad...")
-        
-        # Pre-cargar vector DB si existe
-        global VECTOR_DB
-        if VECTOR_DB is None:
-            load_vector_db_if_needed()
-        
-        # Test de conectividad OpenAI rápido
-        if OPENAI_KEY:
-            try:
-                test_response = client.chat.completions.create(
-                    model="gpt-4o",
-                    messages=[{"role": "user", "content": "Hi"}],
-                    max_tokens=5,
-                    timeout=5
-                )
-                print("✅ OpenAI optimizado para baja latencia")
-            except Exception as e:
-                print(f"⚠️ Advertencia OpenAI: {e}")
-        
-        # Limpiar cache viejo al inicio
-        clean_expired_cache()
-        
-        print("🚀 Sistema optimizado - listo para respuestas rápidas")
-        
-    except Exception as e:
-        print(f"⚠️ Error en optimización: {e}")
+READY_TIMEOUT = float(os.getenv("READY_TIMEOUT", "60"))  # espera máxima de /readyz por la vector DB
+
+
+def wait_for_vector_db(timeout: float, tenant=None):
+    """Arranca la carga de la vector DB (si hace falta) y espera a que termine.
+    La de un tenant se abre en el momento (None si no tiene documentos)."""
+    if tenant:
+        return searchable(TENANTS.get(tenant))
+    load_vector_db_if_needed()
+    limit = time.monotonic() + timeout
+    while VECTOR_DB is None and VECTOR_DB_LOADING and time.monotonic() < limit:
+        time.sleep(0.05)
+    return searchable(VECTOR_DB)
+
+
+def warm_up(timeout: float = READY_TIMEOUT) -> dict:
+    """Carga los recursos perezosos y devuelve el estado de cada uno."""
+    started = time.perf_counter()
+    vector_db = wait_for_vector_db(timeout)
+    if vector_db is not None:
+        vector_state = "loaded"
+    elif VECTOR_DB is not None:
+        vector_state = "empty"  # manifiesto sin segmentos: el chat funciona sin RAG
+    elif VECTOR_DB_LOADING:
+        vector_state = "loading"
+    elif os.path.exists(VECTOR_PATH):
+        vector_state = "error"
+    else:
+        vector_state = "absent"  # sin documentos todavía: el chat funciona sin RAG
+    vector_seconds = round(time.perf_counter() - started, 3)
+
+    CLUSTER_MODEL.get()
+    SUPABASE.get()
+    CACHE_MAINTENANCE.get()
+    return {
+        "vector_db": {"status": vector_state, "ok": vector_state in ("loaded", "empty", "absent"), "seconds": vector_seconds},
+        "cluster_model": CLUSTER_MODEL.status(),
+        "supabase": SUPABASE.status(),
+    }
+
+
+@bp.route('/readyz', methods=['GET'])
+def readyz():
+    """Warm-up explícito: 200 cuando la vector DB está lista, 503 mientras carga o si falló.
+    El modelo de clústers y Supabase se informan pero no bloquean (tienen respaldo)."""
+    components = warm_up()
+    ready = components["vector_db"]["ok"]
+    return jsonify({"ready": ready, "components": components}), (200 if ready else 503)
+
+
+def create_app(config: dict = None) -> Flask:
+    """Fábrica de la app Flask: solo configuración y rutas, sin red ni modelos."""
+    app = Flask(__name__)
+    app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
+    app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+    if config:
+        app.config.update(config)
+    app.register_blueprint(bp)
+    return app
+
+
+app = create_app()
 
 # ==========================================================
 # 🚀 EJECUTAR SERVIDOR
@@ -1017,7 +1847,8 @@ if __name__ == "__main__":
     print(f"🚀 Iniciando Alana Legal Sense en puerto {port}")
     print(f"🔧 Modo debug: {debug_mode}")
     
-    # Optimizar sistema al inicio
-    optimize_system_startup()
+    # Cargar vector DB y modelos antes de aceptar peticiones
+    print(f"🏎️ Warm-up: {warm_up()}")
+    clean_expired_cache()
     
     app.run(host="0.0.0.0", port=port, debug=debug_mode)
@@ -57,27 +57,55 @@ form.addEventListener("submit", async (e) => {
 
   // Animación de carga mejorada con puntos animados
   const loadingId = Date.now();
-  appendMessage("Bot", "<span class='loading-dots'>Procesando<span class='dots'></span></span>", "bot loading", "", loadingId);
+  appendMessage("Bot", "Procesando", "bot loading", "", loadingId);
   
   // Iniciar animación de puntos
   startLoadingAnimation();
   
   const startTime = Date.now();
-  const response = await fetch("/chat", {
-    method: "POST",
-    headers: { "Content-Type": "application/x-www-form-urlencoded" },
-    body: `message=${encodeURIComponent(text)}`
-  });
+  let botMessage = null;
+  let answerText = "";
+  let partialData = {};
+
+  // Crea la burbuja del bot la primera vez que llega contenido
+  const ensureBotMessage = () => {
+    if (!botMessage) {
+      clearInterval(loadingInterval);
+      removeLoadingMessages();
+      botMessage = appendMessage("Bot", "", "bot streaming");
+    }
+    return botMessage;
+  };
+
+  let data = null;
+  try {
+    data = await streamChat(text, (event, payload) => {
+      if (event === "sources") {
+        partialData = { ...partialData, ...payload };
+        renderDetails(partialData);
+      } else if (event === "token") {
+        answerText += payload.delta || "";
+        ensureBotMessage().querySelector(".content").textContent = answerText;
+        messages.scrollTop = messages.scrollHeight;
+      } else if (event === "partial") {
+        partialData = { ...partialData, ...payload };
+        renderDetails(partialData);
+      }
+    });
+  } catch (err) {
+    // Navegadores sin streaming: volver al endpoint JSON clásico
+    console.warn("Streaming no disponible, usando /chat:", err);
+    const response = await fetch("/chat", {
+      method: "POST",
+      headers: { "Content-Type": "application/x-www-form-urlencoded" },
+      body: `message=${encodeURIComponent(text)}`
+    });
+    data = await response.json();
+  }
+  data = data || { response: answerText || "(sin respuesta)", sources: partialData.sources };
 
-  const data = await response.json();
   const responseTime = Date.now() - startTime;
   
-  // Detener animación de carga
-  clearInterval(loadingInterval);
-  
-  // quitar el mensaje de loading anterior
-  removeLoadingMessages();
-  
   // Detectar si la respuesta viene del cache
   const isCached = data.cached === true;
   const cacheType = data.cache_type || 'new';
@@ -90,17 +118,12 @@ form.addEventListener("submit", async (e) => {
     speedIcon = " ⚡";
   }
   
-  appendMessage("Bot", data.response || "(sin respuesta)", "bot", speedIcon);
+  const el = ensureBotMessage();
+  el.classList.remove("streaming");
+  el.querySelector("strong").textContent = `Bot${speedIcon}:`;
+  el.querySelector(".content").textContent = data.response || "(sin respuesta)";
 
-<<<<<<< HEAD
-  // Mostrar tiempo de respuesta con indicador de velocidad
-  if (data.response_time || responseTime) {
-=======
-  // Mostrar respuesta principal con indicador de cache si aplica
-  const cacheIcon = isCached ? " 🚀" : "";
-  appendMessage("Bot", data.response || "(sin respuesta)", "bot", cacheIcon);
-
-  // Reproducir respuesta en audio (SpeechSynthesis)
+  // Reproducir respuesta en audio (SpeechSynthesis) una vez completa, no por token
   if (data.response && 'speechSynthesis' in window) {
     try {
       const utter = new SpeechSynthesisUtterance(data.response);
@@ -119,9 +142,8 @@ form.addEventListener("submit", async (e) => {
     }
   }
 
-  // Mostrar tiempo de respuesta si está disponible
-  if (data.response_time) {
->>>>>>> c977646f961012b164a7218e46a97a23f2aac637
+  // Mostrar tiempo de respuesta con indicador de velocidad
+  if (data.response_time || responseTime) {
     const timeDiv = document.createElement("div");
     timeDiv.className = "response-time";
     const displayTime = data.response_time || `${(responseTime/1000).toFixed(2)}s`;
@@ -133,6 +155,54 @@ form.addEventListener("submit", async (e) => {
     messages.appendChild(timeDiv);
   }
 
+  renderDetails(data);
+  messages.scrollTop = messages.scrollHeight;
+});
+
+// Consume /chat/stream (Server-Sent Events sobre POST) y devuelve el payload final
+async function streamChat(text, onEvent) {
+  const response = await fetch("/chat/stream", {
+    method: "POST",
+    headers: { "Content-Type": "application/x-www-form-urlencoded" },
+    body: `message=${encodeURIComponent(text)}`
+  });
+  if (!response.ok || !response.body) {
+    throw new Error(`stream no disponible (${response.status})`);
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+  let finalData = null;
+
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    let sep;
+    while ((sep = buffer.indexOf("\n\n")) !== -1) {
+      const raw = buffer.slice(0, sep);
+      buffer = buffer.slice(sep + 2);
+
+      let event = "message";
+      let dataLines = [];
+      raw.split("\n").forEach(line => {
+        if (line.startsWith("event:")) event = line.slice(6).trim();
+        else if (line.startsWith("data:")) dataLines.push(line.slice(5).trim());
+      });
+      if (!dataLines.length) continue;
+
+      const payload = JSON.parse(dataLines.join("\n"));
+      if (event === "done" || event === "error") finalData = payload;
+      onEvent(event, payload);
+    }
+  }
+  return finalData;
+}
+
+// Pinta confianza, puntos clave, citas y fuentes (sirve para datos parciales y finales)
+function renderDetails(data) {
   // mostrar confianza
   if (data.confidence) {
     confidenceBadge.textContent = `Confianza: ${data.confidence}`;
@@ -206,10 +276,18 @@ form.addEventListener("submit", async (e) => {
       div.className = "source-item";
       const src = s.source || s.source_id || "unknown";
       const page = s.page !== undefined && s.page !== null ? ` (p. ${s.page})` : "";
+      const section = s.section ? ` — ${escapeHtml(s.section)}` : "";
       const score = s.score !== undefined ? ` — relevancia: ${(1/(1+s.score)*100).toFixed(0)}%` : "";
+      // el mismo texto en otros documentos/páginas (casi duplicados colapsados en la ingesta)
+      const refs = Array.isArray(s.references) && s.references.length > 0
+        ? `<div class="source-references">También en: ${s.references.map(r =>
+            escapeHtml(r.source || "unknown") + (r.page !== undefined && r.page !== null ? ` (p. ${r.page})` : "")
+          ).join(", ")}</div>`
+        : "";
       div.innerHTML = `
-        <div class="source-header">Fuente ${idx+1}: <strong>${escapeHtml(src)}</strong>${page}${score}</div>
+        <div class="source-header">Fuente ${idx+1}: <strong>${escapeHtml(src)}</strong>${page}${section}${score}</div>
         <div class="source-snippet">${escapeHtml(s.text_snippet || '')}</div>
+        ${refs}
       `;
       sourcesDiv.appendChild(div);
     });
@@ -230,9 +308,7 @@ form.addEventListener("submit", async (e) => {
   } else {
     sourcesList.innerHTML = `<div class="no-sources">No se encontraron fuentes relevantes.</div>`;
   }
-
-  messages.scrollTop = messages.scrollHeight;
-});
+}
 
 // Variables para animación de carga
 let loadingInterval;
@@ -285,39 +361,19 @@ function typeWriterEffect(element, text, speed = 30) {
 function appendMessage(who, text, cls, isCached = false, messageId = null) {
   const el = document.createElement("div");
   el.className = `msg ${cls}`;
-<<<<<<< HEAD
   if (messageId) el.dataset.messageId = messageId;
-  
-  // Crear contenido con indicador de cache si aplica
-  const cacheIndicator = isCached ? ' 🚀' : '';
-  
-  if (cls.includes('loading')) {
-    el.innerHTML = `${who}: <span class='loading-dots'>${text}<span class='dots'></span></span>`;
-  } else {
-    el.textContent = `${who}${cacheIndicator}: ${text}`;
-  }
-  
-=======
 
   const cacheIndicator = isCached ? ' 🚀' : '';
 
-  // If this is a loading message, build structured content with typing animation
   if (cls && cls.indexOf('loading') !== -1) {
-    el.innerHTML = `
-      <strong>${escapeHtml(who)}${cacheIndicator}:</strong>
-      <div class="content">
-        <div class="typing-dots">
-          <span></span><span></span><span></span>
-        </div>
-      </div>
-    `;
+    el.innerHTML = `<strong>${escapeHtml(who)}:</strong> <div class="content"><span class='loading-dots'>${escapeHtml(text)}<span class='dots'></span></span></div>`;
   } else {
     el.innerHTML = `<strong>${escapeHtml(who)}${cacheIndicator}:</strong> <div class="content">${escapeHtml(text)}</div>`;
   }
 
->>>>>>> c977646f961012b164a7218e46a97a23f2aac637
   messages.appendChild(el);
   messages.scrollTop = messages.scrollHeight;
+  return el;
 }
 
 function removeLoadingMessages() {
@@ -463,76 +519,66 @@ uploadForm.addEventListener("submit", async (e) => {
   progressText.textContent = 'Iniciando...';
   
   try {
-    // Animación de progreso más fluida y realista
-    let progress = 0;
-    let step = 0;
-    const progressSteps = [
-      'Subiendo archivos...',
-      'Extrayendo texto...',
-      'Procesando contenido...',
-      'Generando embeddings...',
-      'Creando índices...'
-    ];
-    
-    const progressInterval = setInterval(() => {
-      if (progress < 85) {
-        progress += Math.random() * 12 + 3; // Progreso más variable y realista
-        if (progress > 85) progress = 85;
-        progressFill.style.width = progress + '%';
-        
-        // Cambiar mensaje según progreso
-        const newStep = Math.floor(progress / 20);
-        if (newStep !== step && newStep < progressSteps.length) {
-          step = newStep;
-        }
-        
-        progressText.textContent = `${progressSteps[step]} ${Math.round(progress)}%`;
-      }
-    }, 250);
+    progressText.textContent = 'Subiendo archivos...';
     
     const response = await fetch("/upload", {
       method: "POST",
       body: formData
     });
+    const data = await response.json();
     
-    clearInterval(progressInterval);
+    if (!data.success) {
+      uploadProgress.style.display = 'none';
+      uploadStatus.innerHTML = `❌ ${data.message}`;
+      uploadStatus.className = 'status error';
+      uploadBtn.disabled = false;
+      return;
+    }
+    
+    // Limpiar archivos seleccionados: el servidor ya los tiene en cola
+    selectedFiles = [];
+    updateFilesList();
+    uploadBtn.disabled = true;
+    
+    const finalJobs = await pollJobs(data.jobs || []);
     progressFill.style.width = '100%';
     progressText.textContent = 'Completado';
     
-    const data = await response.json();
-    
     // Mostrar resultados
     setTimeout(() => {
       uploadProgress.style.display = 'none';
       
-      if (data.success) {
-        uploadStatus.innerHTML = `✅ ${data.message}`;
+      const details = (data.details || []).map(detail => {
+        const job = detail.job_id ? finalJobs[detail.job_id] : null;
+        return job ? { ...detail, success: job.status === 'done', message: job.message } : detail;
+      });
+      const ok = details.filter(d => d.success).length;
+      
+      if (ok > 0) {
+        uploadStatus.innerHTML = ok === details.length
+          ? `✅ ${ok} archivo(s) procesado(s) exitosamente`
+          : `⚠ ${ok}/${details.length} archivos procesados. Ver detalles.`;
         uploadStatus.className = 'status success';
-        
-        // Mostrar detalles si hay múltiples archivos
-        if (data.details && data.details.length > 1) {
-          let detailsHtml = '<br><small>';
-          data.details.forEach(detail => {
-            const icon = detail.success ? '✅' : '❌';
-            detailsHtml += `${icon} ${detail.filename} (${detail.size_mb}MB)<br>`;
-          });
-          detailsHtml += '</small>';
-          uploadStatus.innerHTML += detailsHtml;
-        }
-        
-        // Limpiar archivos seleccionados
-        selectedFiles = [];
-        updateFilesList();
       } else {
-        uploadStatus.innerHTML = `❌ ${data.message}`;
+        uploadStatus.innerHTML = "❌ No se pudo procesar ningún archivo";
         uploadStatus.className = 'status error';
       }
       
+      // Mostrar detalles si hay múltiples archivos o algún fallo
+      if (details.length > 1 || ok < details.length) {
+        let detailsHtml = '<br><small>';
+        details.forEach(detail => {
+          const icon = detail.success ? '✅' : '❌';
+          detailsHtml += `${icon} ${detail.filename} (${detail.size_mb}MB)<br>`;
+        });
+        detailsHtml += '</small>';
+        uploadStatus.innerHTML += detailsHtml;
+      }
+      
       uploadBtn.disabled = false;
     }, 500);
     
   } catch (err) {
-    clearInterval(progressInterval);
     uploadProgress.style.display = 'none';
     uploadStatus.innerHTML = "❌ Error de conexión al subir archivos";
     uploadStatus.className = 'status error';
@@ -540,35 +586,97 @@ uploadForm.addEventListener("submit", async (e) => {
   }
 });
 
+// Consulta /jobs/<id> hasta que todos los trabajos de ingesta terminen
+const JOB_STEPS = {
+  queued: 'En cola...',
+  parsing: 'Extrayendo texto...',
+  embedding: 'Generando embeddings...',
+  indexing: 'Creando índices...',
+  done: 'Completado',
+  failed: 'Error'
+};
+
+async function pollJobs(jobIds) {
+  const jobs = {};
+  let pending = [...jobIds];
+  
+  while (pending.length > 0) {
+    const states = await Promise.all(pending.map(id =>
+      fetch(`/jobs/${id}`)
+        .then(r => r.ok ? r.json() : { id, status: 'failed', progress: 100, message: '❌ Trabajo no encontrado' })
+        .catch(() => null)
+    ));
+    states.forEach(job => { if (job) jobs[job.id] = job; });
+    
+    const current = jobIds.map(id => jobs[id]).filter(Boolean);
+    if (current.length > 0) {
+      const progress = current.reduce((sum, job) => sum + (job.progress || 0), 0) / jobIds.length;
+      const active = current.find(job => job.status !== 'done' && job.status !== 'failed') || current[0];
+      progressFill.style.width = progress + '%';
+      progressText.textContent = `${JOB_STEPS[active.status] || active.status} ${Math.round(progress)}%`;
+    }
+    
+    pending = jobIds.filter(id => !jobs[id] || (jobs[id].status !== 'done' && jobs[id].status !== 'failed'));
+    if (pending.length > 0) {
+      await new Promise(resolve => setTimeout(resolve, 1000));
+    }
+  }
+  return jobs;
+}
+
 // Funcionalidad de historial
 const historyBtn = document.getElementById("historyBtn");
 const historyModal = document.getElementById("historyModal");
 const closeModal = document.querySelector(".close");
 const historyList = document.getElementById("historyList");
 
+let historyCursor = null;
+
+function renderHistoryItem(conv) {
+  const div = document.createElement("div");
+  div.className = "history-item";
+  const date = new Date(conv.timestamp).toLocaleString();
+  const crossRefIndicator = conv.has_cross_refs ? " 🔗" : "";
+  div.innerHTML = `
+    <div class="history-question">${escapeHtml(conv.question)}${crossRefIndicator}</div>
+    <div class="history-response">${escapeHtml(conv.response)}</div>
+    <div class="history-meta">${date} - Confianza: ${conv.confidence || 'N/A'}</div>
+  `;
+  return div;
+}
+
+async function loadHistoryPage(append) {
+  const url = append && historyCursor ? `/history?cursor=${encodeURIComponent(historyCursor)}` : "/history";
+  const response = await fetch(url);
+  const data = await response.json();
+
+  if (!append) historyList.innerHTML = "";
+  const moreBtn = document.getElementById("historyMoreBtn");
+  if (moreBtn) moreBtn.remove();
+
+  if (data.history && data.history.length > 0) {
+    data.history.forEach(conv => historyList.appendChild(renderHistoryItem(conv)));
+  } else if (!append) {
+    historyList.innerHTML = "<p>No hay conversaciones previas.</p>";
+  }
+
+  // paginación por cursor: el servidor indica si hay más conversaciones
+  historyCursor = data.next_cursor || null;
+  if (historyCursor) {
+    const button = document.createElement("button");
+    button.id = "historyMoreBtn";
+    button.className = "nav-item";
+    button.textContent = "Cargar más";
+    button.addEventListener("click", () => loadHistoryPage(true).catch(err => {
+      console.error("Error cargando historial:", err);
+    }));
+    historyList.appendChild(button);
+  }
+}
+
 historyBtn.addEventListener("click", async () => {
   try {
-    const response = await fetch("/history");
-    const data = await response.json();
-    
-    historyList.innerHTML = "";
-    if (data.history && data.history.length > 0) {
-      data.history.forEach(conv => {
-        const div = document.createElement("div");
-        div.className = "history-item";
-        const date = new Date(conv.timestamp).toLocaleString();
-        const crossRefIndicator = conv.has_cross_refs ? " 🔗" : "";
-        div.innerHTML = `
-          <div class="history-question">${escapeHtml(conv.question)}${crossRefIndicator}</div>
-          <div class="history-response">${escapeHtml(conv.response)}</div>
-          <div class="history-meta">${date} - Confianza: ${conv.confidence || 'N/A'}</div>
-        `;
-        historyList.appendChild(div);
-      });
-    } else {
-      historyList.innerHTML = "<p>No hay conversaciones previas.</p>";
-    }
-    
+    await loadHistoryPage(false);
     historyModal.style.display = "block";
   } catch (err) {
     console.error("Error cargando historial:", err);
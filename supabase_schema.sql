@@ -37,12 +37,18 @@ CREATE TABLE IF NOT EXISTS analytics (
   created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
 );
 
+-- Tenant (despacho/cliente) dueño del documento o la conversación; NULL = corpus global
+ALTER TABLE documents ADD COLUMN IF NOT EXISTS tenant_id VARCHAR(64);
+ALTER TABLE conversations ADD COLUMN IF NOT EXISTS tenant_id VARCHAR(64);
+
 -- Índices para mejor rendimiento
 CREATE INDEX IF NOT EXISTS idx_documents_corpus_id ON documents(corpus_id);
 CREATE INDEX IF NOT EXISTS idx_documents_created_at ON documents(created_at);
 CREATE INDEX IF NOT EXISTS idx_conversations_corpus_id ON conversations(corpus_id);
 CREATE INDEX IF NOT EXISTS idx_conversations_created_at ON conversations(created_at);
 CREATE INDEX IF NOT EXISTS idx_conversations_session_id ON conversations(session_id);
+CREATE INDEX IF NOT EXISTS idx_documents_tenant_id ON documents(tenant_id);
+CREATE INDEX IF NOT EXISTS idx_conversations_tenant_created_at ON conversations(tenant_id, created_at);
 CREATE INDEX IF NOT EXISTS idx_analytics_event_type ON analytics(event_type);
 CREATE INDEX IF NOT EXISTS idx_analytics_created_at ON analytics(created_at);
 
@@ -0,0 +1,213 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from types import SimpleNamespace
+
+from chatbot.cache_store import CacheStore
+from chatbot.embeddings import CachedEmbeddings, make_batches
+from chatbot.semantic_cache import SemanticCache, decode_vector, encode_vector
+from chatbot.singleflight import SingleFlight
+
+
+class CacheStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def make_store(self, **kwargs):
+        options = {"ttl": 3600, "max_entries": 100, "shards": 2}
+        options.update(kwargs)
+        return CacheStore(self.tmp.name, **options)
+
+    def test_put_get_visible_to_other_instance(self):
+        """A second store on the same directory (another worker) sees new writes."""
+        writer, reader = self.make_store(), self.make_store()
+        self.assertIsNone(reader.get("k1"))
+        writer.put("k1", {"response": "uno", "timestamp": int(time.time())})
+        self.assertEqual(reader.get("k1")["response"], "uno")
+        writer.pop("k1")
+        self.assertNotIn("k1", reader)
+
+    def test_expired_entries_are_misses_and_evicted(self):
+        """Expired entries are ignored on read and removed on the next eviction pass."""
+        self.make_store().put("old", {"response": "x", "timestamp": int(time.time()) - 60})
+        store = self.make_store(ttl=10)
+        self.assertIsNone(store.get("old"))
+        self.assertEqual(store.evict_expired(), 1)
+        self.assertEqual(len(self.make_store()), 0)
+
+    def test_lru_eviction_keeps_recent_entries(self):
+        """Once a shard is full, the least recently used key is evicted."""
+        store = self.make_store(max_entries=2, shards=1)
+        now = int(time.time())
+        store.put("a", {"timestamp": now})
+        store.put("b", {"timestamp": now})
+        store.get("a")
+        store.put("c", {"timestamp": now})
+        self.assertIn("a", store)
+        self.assertNotIn("b", store)
+        self.assertIn("c", store)
+
+    def test_compaction_keeps_live_entries(self):
+        """Compaction rewrites the log with live entries only."""
+        store = self.make_store(shards=1)
+        now = int(time.time())
+        for i in range(200):
+            store.put("k", {"n": i, "timestamp": now})
+        self.assertEqual(store.compact_if_needed(), 1)
+        other = self.make_store(shards=1)
+        self.assertEqual(other.get("k")["n"], 199)
+        self.assertEqual(len(other), 1)
+
+
+class SingleFlightTestCase(unittest.TestCase):
+
+    def _run_concurrently(self, flight, workers=5):
+        cache, calls = {}, []
+
+        def handle():
+            with flight.claim("same-key") as waited:
+                if waited and "same-key" in cache:
+                    return
+                calls.append(1)
+                time.sleep(0.1)  # simula la llamada al LLM
+                cache["same-key"] = "respuesta"
+
+        threads = [threading.Thread(target=handle) for _ in range(workers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return calls
+
+    def test_in_process_coalescing(self):
+        """Concurrent identical keys trigger a single computation (in-process stand-in)."""
+        flight = SingleFlight()
+        self.assertEqual(len(self._run_concurrently(flight)), 1)
+        self.assertEqual(flight.coalesced, 4)
+
+    def test_file_lock_coalescing(self):
+        """The cross-worker mode (file locks) coalesces as well."""
+        with tempfile.TemporaryDirectory() as tmp:
+            self.assertEqual(len(self._run_concurrently(SingleFlight(tmp))), 1)
+            self.assertEqual(os.listdir(tmp), [])  # los archivos de bloqueo se borran al liberar
+
+    def test_distinct_keys_do_not_wait_on_each_other(self):
+        """Each key locks its own file: unrelated questions neither block nor count as coalesced."""
+        with tempfile.TemporaryDirectory() as tmp:
+            flight = SingleFlight(tmp, wait_timeout=5)
+            other = SingleFlight(tmp, wait_timeout=5)  # otro worker
+            with flight.claim("pregunta-a") as waited_a:
+                started = time.monotonic()
+                with other.claim("pregunta-b") as waited_b:
+                    pass
+            self.assertFalse(waited_a)
+            self.assertFalse(waited_b)
+            self.assertLess(time.monotonic() - started, 1)
+            self.assertEqual(flight.coalesced + other.coalesced, 0)
+
+
+class SemanticCacheTestCase(unittest.TestCase):
+
+    def test_hit_near_miss_and_miss_counters(self):
+        """Similar queries hit, borderline ones count as near misses, others miss."""
+        cache = SemanticCache(threshold=0.95, near_miss_margin=0.05)
+        cache.add("corpus", "k1", [1.0, 0.0, 0.0])
+        payloads = {"k1": {"response": "uno"}}
+
+        payload, sim = cache.lookup("corpus", [1.0, 0.1, 0.0], payloads.get)
+        self.assertEqual(payload, {"response": "uno"})
+        payload, _ = cache.lookup("corpus", [1.0, 0.38, 0.0], payloads.get)
+        self.assertIsNone(payload)
+        payload, _ = cache.lookup("corpus", [0.0, 1.0, 0.0], payloads.get)
+        self.assertIsNone(payload)
+        payload, _ = cache.lookup("otro-corpus", [1.0, 0.0, 0.0], payloads.get)
+        self.assertIsNone(payload)
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["near_misses"], stats["misses"]), (1, 1, 2))
+
+    def test_sync_from_cache_entries(self):
+        """Entries written by other workers are indexed from their stored embedding."""
+        vector = [0.0, 3.0, 4.0]
+        self.assertEqual(list(decode_vector(encode_vector(vector))), vector)
+        cache = SemanticCache()
+        cache.sync("c", [("k", {"corpus_id": "c", "query_embedding": encode_vector(vector)})])
+        payload, _ = cache.lookup("c", vector, lambda key: {"key": key})
+        self.assertEqual(payload, {"key": "k"})
+
+    def test_refresh_reads_only_new_log_records_on_interval(self):
+        """Other workers' entries are picked up from the log tail, at most once per sync interval."""
+        with tempfile.TemporaryDirectory() as tmp:
+            store = CacheStore(tmp, ttl=3600, max_entries=100, shards=2)
+            now = int(time.time())
+            store.put("k1", {"corpus_id": "c", "query_embedding": encode_vector([1.0, 0.0]), "timestamp": now})
+            records, cursors = store.records_since()
+            self.assertEqual([key for key, _ in records], ["k1"])
+            self.assertEqual(store.records_since(cursors)[0], [])
+
+            cache = SemanticCache(sync_interval=3600)
+            cache.refresh("c", store)
+            self.assertEqual(cache.stats()["entries"], {"c": 1})
+            store.put("k2", {"corpus_id": "c", "query_embedding": encode_vector([0.0, 1.0]), "timestamp": now})
+            cache.refresh("c", store)  # dentro del intervalo: no se lee el log
+            self.assertEqual(cache.stats()["entries"], {"c": 1})
+            cache.sync_interval = 0
+            cache.refresh("c", store)
+            self.assertEqual(cache.stats()["entries"], {"c": 2})
+
+
+    def test_old_corpus_namespaces_are_evicted(self):
+        """Each ingest starts a new corpus_id; only the most recently used namespaces keep an index."""
+        cache = SemanticCache(max_namespaces=2)
+        for generation in range(1, 5):
+            cache.add(f"g{generation}-abc", "k", [1.0, 0.0])
+            cache.lookup("g1-abc", [1.0, 0.0], lambda key: None)  # el corpus en uso sigue vivo
+        self.assertEqual(set(cache.stats()["entries"]), {"g1-abc", "g4-abc"})
+        self.assertEqual(cache.stats()["evicted_namespaces"], 2)
+
+
+class FakeEmbeddingsClient:
+    """Cliente mínimo con la forma de client.embeddings.create de OpenAI."""
+
+    def __init__(self):
+        self.inputs = []
+        self.embeddings = self
+
+    def create(self, model, input):
+        self.inputs.append(list(input))
+        data = [SimpleNamespace(index=i, embedding=[float(len(t)), 1.0, 0.5])
+                for i, t in enumerate(input)]
+        return SimpleNamespace(data=data)
+
+
+class CachedEmbeddingsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def test_batches_respect_token_budget(self):
+        batches = make_batches(["a" * 30] * 10, token_budget=25)
+        self.assertEqual([len(b) for b in batches], [2, 2, 2, 2, 2])
+
+    def test_duplicate_chunks_embedded_once_across_instances(self):
+        client = FakeEmbeddingsClient()
+        first = CachedEmbeddings(client, self.tmp.name)
+        vectors = first.embed_documents(["clausula", "otra", "clausula"])
+        self.assertEqual(vectors[0], vectors[2])
+        self.assertEqual(sum(len(i) for i in client.inputs), 2)
+
+        # otro proceso/instancia reutiliza el cache en disco
+        second = CachedEmbeddings(client, self.tmp.name)
+        again = second.embed_documents(["otra", "nueva", "clausula"])
+        self.assertEqual(client.inputs[-1], ["nueva"])
+        self.assertEqual(again[0], vectors[1])
+        self.assertEqual(second.stats()["cached_vectors"], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+import tempfile
+import unittest
+
+import numpy as np
+from langchain_community.embeddings import DeterministicFakeEmbedding
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+from chatbot.dedup import ChunkDeduplicator, MinHasher, mmr, similarity
+from chatbot.segments import SegmentedVectorStore
+
+HEADER = ("En la ciudad de Bogotá, ante mí, notario primero del círculo, compareció el señor "
+          "identificado con cédula de ciudadanía número 79.123.456, mayor de edad y vecino de esta "
+          "ciudad, quien obrando en nombre propio manifestó que otorga la presente escritura pública")
+
+
+def chunk(text, source, page=0):
+    return Document(page_content=text, metadata={"source": source, "page": page, "chunk_id": page})
+
+
+class DedupTestCase(unittest.TestCase):
+
+    def test_signatures_estimate_similarity(self):
+        hasher = MinHasher()
+        base = hasher.signature(HEADER)
+        near = hasher.signature(HEADER.replace("primero", "segundo"))
+        other = hasher.signature("El arrendatario pagará un canon mensual de dos millones de pesos")
+        self.assertGreater(similarity(base, near), 0.7)
+        self.assertLess(similarity(base, other), 0.2)
+        # mismas permutaciones en cualquier proceso
+        np.testing.assert_array_equal(base, MinHasher().signature(HEADER))
+
+    def test_near_duplicates_collapse_into_references(self):
+        dedup = ChunkDeduplicator(threshold=0.8)
+        chunks = [chunk(HEADER, "a.pdf", 0), chunk("El precio de la venta es de diez millones", "a.pdf", 1),
+                  chunk(HEADER + " ante testigos", "a.pdf", 7)]
+        kept = list(dedup.filter(iter(chunks)))
+        self.assertEqual([c.metadata["page"] for c in kept], [0, 1])
+        self.assertEqual(dedup.collapsed, 1)
+        self.assertEqual(dedup.references, {kept[0].metadata["dedup_key"]: [
+            {"source": "a.pdf", "page": 7, "chunk_id": 7}]})
+
+        # un documento posterior se compara con las firmas ya guardadas en el corpus
+        later = ChunkDeduplicator(threshold=0.8, existing=[(list(dedup.signatures), list(dedup.signatures.values()))])
+        self.assertEqual(list(later.filter(iter([chunk(HEADER, "b.pdf", 3)]))), [])
+        self.assertIn(kept[0].metadata["dedup_key"], later.references)
+
+    def test_clauses_differing_only_by_a_number_are_kept(self):
+        """Variants of a boilerplate clause with different facts are both indexed, at any threshold."""
+        clause = ("El inmueble objeto de la presente compraventa se identifica con la matrícula inmobiliaria "
+                  "número {} de la Oficina de Registro de Instrumentos Públicos del círculo respectivo, y el "
+                  "vendedor garantiza que se encuentra libre de gravámenes, embargos, pleitos pendientes, "
+                  "condiciones resolutorias, censos, anticresis y limitaciones al dominio, y que saldrá al "
+                  "saneamiento en los casos de ley, obligándose a entregarlo a paz y salvo por concepto de "
+                  "impuestos, tasas y contribuciones causados hasta la fecha de la entrega material")
+        first, second = clause.format("1234567"), clause.format("7654321")
+        hasher = MinHasher()
+        self.assertGreater(similarity(hasher.signature(first), hasher.signature(second)), 0.7)
+        for threshold in (1.0, 0.7):
+            dedup = ChunkDeduplicator(threshold=threshold)
+            kept = list(dedup.filter(iter([chunk(first, "a.pdf", 0), chunk(second, "b.pdf", 0)])))
+            self.assertEqual([c.metadata["source"] for c in kept], ["a.pdf", "b.pdf"])
+            self.assertEqual(dedup.collapsed, 0)
+
+    def test_default_collapses_only_normalized_copies(self):
+        """By default only copies that differ in case, punctuation or spacing are collapsed."""
+        dedup = ChunkDeduplicator()
+        chunks = [chunk(HEADER, "a.pdf", 0), chunk(HEADER.upper().replace(",", " ,  "), "b.pdf", 2),
+                  chunk(HEADER + " ante testigos", "b.pdf", 3)]
+        kept = list(dedup.filter(iter(chunks)))
+        self.assertEqual([c.metadata["page"] for c in kept], [0, 3])
+        self.assertEqual(dedup.references, {kept[0].metadata["dedup_key"]: [
+            {"source": "b.pdf", "page": 2, "chunk_id": 2}]})
+
+    def test_mmr_skips_redundant_candidates(self):
+        vectors = [np.array([1.0, 0.0]), np.array([0.99, 0.01]), np.array([0.0, 1.0])]
+        self.assertEqual(mmr([1.0, 0.9, 0.8], vectors, 2, lambda_mult=0.5), [0, 2])
+        self.assertEqual(mmr([1.0, 0.9, 0.8], vectors, 2, lambda_mult=1.0), [0, 1])
+
+
+class DedupStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.embeddings = DeterministicFakeEmbedding(size=8)
+
+    def ingest(self, store, chunks, source):
+        dedup = ChunkDeduplicator(threshold=0.8, existing=store.existing_signatures())
+        kept = list(dedup.filter(iter(chunks)))
+        vectors = None
+        if kept:
+            vectors = FAISS.from_documents(kept, self.embeddings)
+        return store.add_segment(vectors, source=source, signatures=dedup.signatures, references=dedup.references)
+
+    def test_references_survive_search_and_merge(self):
+        store = SegmentedVectorStore(self.tmp.name, self.embeddings, refresh_interval=0, max_segments=1)
+        self.ingest(store, [chunk(HEADER, "a.pdf", 0), chunk("Cláusula penal de cinco millones", "a.pdf", 1)],
+                    "a.pdf")
+        # todo el documento b es un duplicado: solo deja su referencia
+        entry = self.ingest(store, [chunk(HEADER, "b.pdf", 4)], "b.pdf")
+        self.assertEqual(entry["vectors"], 0)
+        self.assertEqual(len(store), 2)
+
+        doc, _ = store.similarity_search_with_score(HEADER, k=1)[0]
+        self.assertEqual(doc.metadata["source"], "a.pdf")
+        self.assertEqual(doc.metadata["references"], [{"source": "b.pdf", "page": 4, "chunk_id": 4}])
+
+        store.merge_small_segments()
+        self.assertEqual(store.stats()["segments"], 1)
+        doc, _ = store.similarity_search_with_score(HEADER, k=1)[0]
+        self.assertEqual(doc.metadata["references"], [{"source": "b.pdf", "page": 4, "chunk_id": 4}])
+        keys, _ = store.existing_signatures()[0]
+        self.assertEqual(len(keys), 2)
+
+        diverse = SegmentedVectorStore(self.tmp.name, self.embeddings, refresh_interval=0, mmr_lambda=0.5)
+        results = diverse.similarity_search_with_score(HEADER, k=2)
+        self.assertEqual(len({doc.metadata["dedup_key"] for doc, _ in results}), 2)
+
+    def test_document_filter_finds_chunks_collapsed_into_other_documents(self):
+        """Filtering on b.pdf also searches a.pdf's canonical chunk that stands for b.pdf's copy."""
+        store = SegmentedVectorStore(self.tmp.name, self.embeddings, refresh_interval=0, max_segments=8)
+        self.ingest(store, [chunk(HEADER, "a.pdf", 0), chunk("Cláusula penal de cinco millones", "a.pdf", 1)],
+                    "a.pdf")
+        self.ingest(store, [chunk(HEADER, "b.pdf", 4), chunk("El canon mensual es de dos millones", "b.pdf", 5)],
+                    "b.pdf")
+        self.ingest(store, [chunk("Poder especial amplio y suficiente", "c.pdf", 0)], "c.pdf")
+
+        for merged in (False, True):
+            if merged:
+                store.max_segments = 1
+                store.merge_small_segments()
+            results = store.similarity_search_with_score(HEADER, k=4, filter={"document": ["b.pdf"]})
+            self.assertEqual({doc.page_content for doc, _ in results},
+                             {HEADER, "El canon mensual es de dos millones"})
+            header = next(doc for doc, _ in results if doc.page_content == HEADER)
+            self.assertEqual(header.metadata["references"], [{"source": "b.pdf", "page": 4, "chunk_id": 4}])
+            results = store.similarity_search_with_score(HEADER, k=4, filter={"document": ["c.pdf"]})
+            self.assertEqual([doc.page_content for doc, _ in results], ["Poder especial amplio y suficiente"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+import os
+import tempfile
+import time
+import unittest
+
+from langchain_community.embeddings import DeterministicFakeEmbedding
+from langchain_core.documents import Document
+
+from chatbot import ingest
+from chatbot.jobs import IngestionJobs
+from chatbot.legal_splitter import LegalStructureSplitter, match_heading
+
+
+class CountingEmbedding(DeterministicFakeEmbedding):
+    """Fake embeddings that record the size of every embed_documents call."""
+    calls: list = []
+
+    def embed_documents(self, texts):
+        self.calls.append(len(texts))
+        return super().embed_documents(texts)
+
+
+class IngestTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def test_docx_is_streamed_in_paragraph_blocks(self):
+        import docx
+
+        document = docx.Document()
+        for i in range(300):
+            document.add_paragraph(f"Artículo {i}. El contratista deberá cumplir la cláusula {i}.")
+        table = document.add_table(rows=1, cols=1)
+        table.cell(0, 0).text = "Texto dentro de una tabla"
+        path = os.path.join(self.tmp.name, "contrato.docx")
+        document.save(path)
+
+        pages = list(ingest.iter_pages(path, "docx"))
+        self.assertGreater(len(pages), 1)
+        self.assertTrue(all(len(page.page_content) < ingest.BLOCK_CHARS + 200 for page in pages))
+        text = "\n".join(page.page_content for page in pages)
+        self.assertIn("Artículo 0.", text)
+        self.assertIn("cláusula 299.", text)
+        self.assertIn("Texto dentro de una tabla", text)
+        self.assertGreater(ingest.estimate_total_chars(path, "docx"), 0)
+
+    def test_txt_falls_back_to_latin1(self):
+        path = os.path.join(self.tmp.name, "notas.txt")
+        with open(path, "wb") as fh:
+            fh.write("Cláusula única\n".encode("latin-1") * 10)
+        pages = list(ingest.iter_pages(path, "txt"))
+        self.assertEqual(len(pages), 1)
+        self.assertTrue(pages[0].page_content.startswith("Cláusula única"))
+
+    def test_unsupported_extension_raises(self):
+        with self.assertRaises(ValueError):
+            list(ingest.iter_pages("archivo.xls", "xls"))
+
+    def test_chunks_are_embedded_in_batches(self):
+        from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+        pages = [Document(page_content=f"Página {i}. " + "texto " * 40, metadata={"page": i}) for i in range(10)]
+        pages.insert(3, Document(page_content="   ", metadata={"page": 99}))
+        splitter = RecursiveCharacterTextSplitter(chunk_size=100, chunk_overlap=0)
+        expected = list(ingest.iter_chunks(iter(pages), splitter))
+
+        embeddings = CountingEmbedding(size=8, calls=[])
+        store, count, chars = ingest.embed_chunks(ingest.iter_chunks(iter(pages), splitter), embeddings,
+                                                  batch_size=7)
+        self.assertEqual(count, len(expected))
+        self.assertEqual(chars, sum(len(chunk.page_content) for chunk in expected))
+        self.assertEqual(sum(embeddings.calls), count)
+        self.assertTrue(all(size <= 7 for size in embeddings.calls))
+        self.assertGreater(len(embeddings.calls), 1)
+        self.assertEqual(store.index.ntotal, count)
+        stored = [store.docstore.search(doc_id) for doc_id in store.index_to_docstore_id.values()]
+        self.assertEqual([doc.page_content for doc in stored], [chunk.page_content for chunk in expected])
+        self.assertNotIn(99, {doc.metadata["page"] for doc in stored})
+
+    def test_empty_document_yields_no_store(self):
+        store, count, _ = ingest.embed_chunks(iter([]), DeterministicFakeEmbedding(size=8))
+        self.assertIsNone(store)
+        self.assertEqual(count, 0)
+
+    def test_chunk_params_follow_document_size(self):
+        self.assertEqual(ingest.chunk_params(1000), (400, 30))
+        self.assertEqual(ingest.chunk_params(10 ** 6), (1200, 100))
+
+
+class LegalStructureSplitterTestCase(unittest.TestCase):
+
+    def test_detects_headings_but_not_citations(self):
+        self.assertEqual(match_heading("ARTÍCULO 5. El arrendatario pagará"), ("articulo", 4, "ARTÍCULO 5"))
+        self.assertEqual(match_heading("CLÁUSULA DÉCIMA PRIMERA: PENAL")[2], "CLÁUSULA DÉCIMA PRIMERA")
+        self.assertEqual(match_heading("PARÁGRAFO 1. Salvo pacto"), ("paragrafo", 5, "PARÁGRAFO 1"))
+        self.assertEqual(match_heading("COMPARECIÓ el señor")[0], "notarial")
+        self.assertIsNone(match_heading("artículo 1602 del Código Civil, según el cual"))
+        self.assertIsNone(match_heading("Capítulo II del Título III de esta ley"))
+
+    def test_children_point_to_their_provision(self):
+        page0 = ("CAPÍTULO I\nARTÍCULO 1. Objeto. El presente contrato regula el arrendamiento.\n"
+                 "PARÁGRAFO. Las mejoras quedan a favor del arrendador.\nARTÍCULO 2. Precio. El canon ")
+        page1 = "mensual es de dos millones de pesos.\nCAPÍTULO II\nARTÍCULO 3. Plazo. Doce meses.\n"
+        splitter = LegalStructureSplitter(child_size=200, child_overlap=0)
+        pages = [Document(page_content=page0, metadata={"source": "c.pdf", "page": 0}),
+                 Document(page_content=page1, metadata={"source": "c.pdf", "page": 1})]
+        chunks = list(ingest.iter_chunks(iter(pages), splitter))
+
+        self.assertEqual([p.metadata["section_path"] for p in splitter.parents],
+                         ["CAPÍTULO I > ARTÍCULO 1", "CAPÍTULO I > ARTÍCULO 2", "CAPÍTULO II > ARTÍCULO 3"])
+        # el artículo 2 cruza de página y sigue siendo una sola disposición
+        self.assertIn("dos millones", splitter.parents[1].page_content)
+        self.assertEqual([c.metadata["section"] for c in chunks],
+                         ["ARTÍCULO 1", "ARTÍCULO 1 > PARÁGRAFO", "ARTÍCULO 2", "ARTÍCULO 3"])
+        self.assertTrue(chunks[1].page_content.startswith("ARTÍCULO 1 > PARÁGRAFO\nPARÁGRAFO."))
+        self.assertEqual([c.metadata["parent_id"] for c in chunks], [0, 0, 1, 2])
+
+        # los offsets son posiciones en el texto del documento (páginas unidas por salto de línea)
+        text = page0 + "\n" + page1
+        for parent in splitter.parents:
+            self.assertEqual(text[parent.metadata["start_offset"]:parent.metadata["end_offset"]],
+                             parent.page_content)
+        paragraph = chunks[1]
+        self.assertTrue(text[paragraph.metadata["start_offset"]:].startswith("PARÁGRAFO."))
+
+
+
+class IngestionJobsTestCase(unittest.TestCase):
+
+    def test_prune_keeps_unfinished_jobs_and_marks_stale_ones_failed(self):
+        """Old finished jobs are deleted; old unfinished ones are kept and reported as failed."""
+        with tempfile.TemporaryDirectory() as tmp:
+            jobs = IngestionJobs(tmp, retention=60)
+            old = time.time() - 3600
+            for job_id, status in (("aa", "done"), ("bb", "embedding"), ("cc", "parsing")):
+                jobs.update(job_id, status=status)
+                if job_id != "cc":
+                    os.utime(jobs._path(job_id), (old, old))
+            jobs.prune()
+            self.assertIsNone(jobs.get("aa"))
+            self.assertEqual(jobs.get("bb")["status"], "failed")
+            self.assertEqual(jobs.get("cc")["status"], "parsing")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+from unittest.mock import MagicMock
+
+import httpx
+from openai import APIConnectionError
+
+from chatbot.llm_gateway import CircuitOpenError, Deadline, DeadlineExceeded, LLMGateway, LLMUnavailable
+
+
+def connection_error():
+    return APIConnectionError(request=httpx.Request("POST", "https://api.openai.com/v1/chat/completions"))
+
+
+def completion(prompt_tokens=10, completion_tokens=5):
+    response = MagicMock()
+    response.usage.prompt_tokens = prompt_tokens
+    response.usage.completion_tokens = completion_tokens
+    return response
+
+
+class LLMGatewayTestCase(unittest.TestCase):
+
+    def make_gateway(self, **kwargs):
+        kwargs.setdefault("backoff_base", 0.0)
+        gateway = LLMGateway("sk-test", **kwargs)
+        gateway.client = MagicMock()
+        return gateway
+
+    def test_retry_then_success_records_metrics(self):
+        """A transient error is retried and the successful call is measured."""
+        gateway = self.make_gateway(retries=1)
+        gateway.client.chat.completions.create.side_effect = [connection_error(), completion()]
+
+        gateway.chat([{"role": "user", "content": "hola"}])
+
+        stats = gateway.stats()
+        self.assertEqual((stats["calls"], stats["errors"], stats["retries"]), (1, 1, 1))
+        self.assertEqual(stats["tokens"], {"prompt": 10, "completion": 5})
+        self.assertEqual(stats["circuit"], "closed")
+        self.assertIsNotNone(stats["latency_ms"]["p95"])
+
+    def test_circuit_opens_and_short_circuits(self):
+        """After `breaker_threshold` failures no more calls reach OpenAI."""
+        gateway = self.make_gateway(retries=0, breaker_threshold=2, breaker_cooldown=60)
+        gateway.client.chat.completions.create.side_effect = connection_error()
+
+        for _ in range(2):
+            with self.assertRaises(LLMUnavailable):
+                gateway.chat([{"role": "user", "content": "hola"}])
+        with self.assertRaises(CircuitOpenError):
+            gateway.chat([{"role": "user", "content": "hola"}])
+
+        self.assertEqual(gateway.client.chat.completions.create.call_count, 2)
+        self.assertEqual(gateway.stats()["circuit"], "open")
+        self.assertEqual(gateway.stats()["short_circuited"], 1)
+
+    def test_deadline_bounds_the_attempt_timeout(self):
+        """Generation gets only what is left of the request deadline."""
+        gateway = self.make_gateway(timeout=60)
+        gateway.client.chat.completions.create.return_value = completion()
+
+        gateway.chat([{"role": "user", "content": "hola"}], deadline=Deadline(5))
+        self.assertLessEqual(gateway.client.chat.completions.create.call_args.kwargs["timeout"], 5)
+
+        with self.assertRaises(DeadlineExceeded):
+            gateway.chat([{"role": "user", "content": "hola"}], deadline=Deadline(0))
+        self.assertEqual(gateway.client.chat.completions.create.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
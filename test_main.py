@@ -1,9 +1,35 @@
 import io
 import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
 from unittest.mock import patch, MagicMock
 
+import main
 from main import app
+from chatbot.cache_store import CacheStore
+from chatbot.history import HISTORY_FIELDS, HistoryService
+from chatbot.lazy import Lazy
+from chatbot.query_cache import QueryEmbeddingCache
+from chatbot.semantic_cache import SemanticCache
+from chatbot.streaming import parse_partial_json
+
+
+class ImportSideEffectsTestCase(unittest.TestCase):
+
+    def test_import_needs_no_api_key_and_starts_no_threads(self):
+        """Importing main creates no OpenAI client, migrates nothing and starts no compactor."""
+        env = {k: v for k, v in os.environ.items() if k != 'OPENAI_API_KEY'}
+        code = ("import threading, main; "
+                "print(main.LLM._client is None, main.QA_CACHE._compactor is None, "
+                "main.CACHE_MAINTENANCE.loaded, threading.active_count())")
+        result = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                env=env, capture_output=True, text=True, timeout=120)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip().splitlines()[-1], 'True True False 1')
 
 
 class MainAppTestCase(unittest.TestCase):
@@ -61,6 +87,64 @@ class MainAppTestCase(unittest.TestCase):
         self.assertIn('success', res)
         # Since procesar_documento returns success True, upload should report success True
         self.assertTrue(res['success'])
+        self.assertEqual(len(res['jobs']), 1)
+
+        # La ingesta corre en segundo plano: esperar al job mientras los mocks siguen activos
+        main.INGEST_JOBS.wait(res['jobs'][0], timeout=10)
+        job = json.loads(self.app.get(f"/jobs/{res['jobs'][0]}").data)
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(job['progress'], 100)
+        mock_save_db.assert_called_once()
+
+    @patch('main.procesar_documento')
+    @patch('main.save_document_to_db')
+    def test_upload_job_failure(self, mock_save_db, mock_procesar):
+        """A failed ingestion is reported through /jobs/<id>, not the upload response."""
+        mock_procesar.return_value = (False, '❌ Error procesando archivo')
+
+        data = {
+            'files': (io.BytesIO(b'contenido de prueba'), 'prueba.txt')
+        }
+        res = json.loads(self.app.post('/upload', data=data, content_type='multipart/form-data').data)
+        self.assertTrue(res['success'])
+        self.assertEqual(res['details'][0]['status'], 'queued')
+
+        job = main.INGEST_JOBS.wait(res['jobs'][0], timeout=10)
+        self.assertEqual(job['status'], 'failed')
+        self.assertFalse(job['success'])
+        mock_save_db.assert_not_called()
+
+    def test_job_status_not_found(self):
+        response = self.app.get('/jobs/0123abcd')
+        self.assertEqual(response.status_code, 404)
+        response = self.app.get('/jobs/..%2Fmain')
+        self.assertEqual(response.status_code, 404)
+
+    def test_readyz_warms_up_lazy_resources(self):
+        """/readyz loads the vector DB and cluster model on demand and reports each one."""
+        response = self.app.get('/readyz')
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200 if data['ready'] else 503)
+        self.assertEqual(set(data['components']), {'vector_db', 'cluster_model', 'supabase'})
+        self.assertTrue(data['components']['cluster_model']['loaded'])
+        self.assertTrue(main.CLUSTER_MODEL.loaded)
+
+    def test_empty_vector_db_falls_back_to_plain_chat(self):
+        """A vector DB whose manifest has no segments is not used for RAG."""
+        empty, loaded = MagicMock(), MagicMock()
+        loaded.__len__.return_value = 3
+        with patch('main.VECTOR_DB', empty):
+            self.assertIsNone(main.load_vector_db_if_needed())
+            self.assertIsNone(main.wait_for_vector_db(0))
+        with patch('main.VECTOR_DB', loaded):
+            self.assertIs(main.load_vector_db_if_needed(), loaded)
+
+    def test_create_app_is_independent(self):
+        """The factory builds fresh apps with the same routes and overridable config."""
+        other = main.create_app({'UPLOAD_FOLDER': 'otra_carpeta'})
+        self.assertIsNot(other, app)
+        self.assertEqual(other.config['UPLOAD_FOLDER'], 'otra_carpeta')
+        self.assertEqual(other.test_client().post('/chat', data={'message': ''}).status_code, 200)
 
     def test_upload_invalid_extension(self):
         """Upload a file with a disallowed extension and expect failure."""
@@ -74,6 +158,312 @@ class MainAppTestCase(unittest.TestCase):
         self.assertFalse(res['success'])
         self.assertTrue('Tipo no permitido' in res['message'] or 'Tipo no permitido' in res.get('message', ''))
 
+    def test_chat_stream_empty_message(self):
+        """Streaming endpoint with an empty message sends a single done event."""
+        response = self.app.post('/chat/stream', data={'message': ''})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        body = response.get_data(as_text=True)
+        self.assertIn('event: done', body)
+        self.assertIn('Por favor escribe algo', json.loads(body.split('data: ', 1)[1]).get('response'))
+
+    @patch('main.get_cached_response', return_value=None)
+    @patch('main.load_vector_db_if_needed')
+    @patch.object(main.LLM, '_client')
+    def test_chat_stream_rag_events(self, mock_client, mock_load_db, mock_cached):
+        """Streaming RAG sends sources first, then answer tokens, then the final payload."""
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        for name, value in (('main.QA_CACHE', CacheStore(cache_dir.name, ttl=3600, max_entries=10)),
+                            ('main.SEMANTIC_CACHE', SemanticCache()),
+                            ('main.QUERY_EMBEDDINGS', QueryEmbeddingCache())):
+            store_patch = patch(name, value)
+            store_patch.start()
+            self.addCleanup(store_patch.stop)
+        doc = MagicMock(page_content='Art. 15: los contratos deben estar firmados.', metadata={'source': 'c.pdf', 'page': 1})
+        mock_load_db.return_value.embeddings.embed_query.return_value = [0.1] * 8
+        mock_load_db.return_value.similarity_search_with_score_by_vector.return_value = [(doc, 0.2)]
+        pieces = ['{"answer": "Los contratos ', 'deben firmarse", "key_points": ["Art. 15"], ', '"confidence": "alta"}']
+        chunks = []
+        for piece in pieces:
+            chunk = MagicMock()
+            chunk.choices[0].delta.content = piece
+            chunk.usage = None
+            chunks.append(chunk)
+        mock_client.chat.completions.create.return_value = iter(chunks)
+
+        response = self.app.post('/chat/stream', data={'message': '¿Qué dice el artículo 15?'})
+        body = response.get_data(as_text=True)
+        events = [block.split('\n')[0][len('event: '):] for block in body.strip().split('\n\n')]
+        self.assertEqual(events[0], 'sources')
+        self.assertIn('token', events)
+        self.assertEqual(events[-1], 'done')
+        final = json.loads(body.strip().split('\n\n')[-1].split('data: ', 1)[1])
+        self.assertEqual(final['response'], 'Los contratos deben firmarse')
+        self.assertEqual(final['key_points'], ['Art. 15'])
+
+        # Una paráfrasis con el mismo embedding se sirve desde el cache semántico
+        response = self.app.post('/chat', data={'message': '¿Qué establece el artículo 15?'})
+        data = json.loads(response.data)
+        self.assertEqual(data['cache_type'], 'semantic')
+        self.assertEqual(data['response'], 'Los contratos deben firmarse')
+        self.assertNotIn('query_embedding', data)
+        self.assertEqual(mock_client.chat.completions.create.call_count, 1)
+
+
+class ChatBatchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = app.test_client()
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        for name, value in (('main.QA_CACHE', CacheStore(cache_dir.name, ttl=3600, max_entries=50)),
+                            ('main.SEMANTIC_CACHE', SemanticCache()),
+                            ('main.QUERY_EMBEDDINGS', QueryEmbeddingCache()),
+                            ('main.wait_for_vector_db', MagicMock())):
+            store_patch = patch(name, value)
+            store_patch.start()
+            self.addCleanup(store_patch.stop)
+        self.vector_db = main.wait_for_vector_db.return_value
+        doc = MagicMock(page_content='Matrícula inmobiliaria 028-0016030.', metadata={'source': 'e.pdf', 'page': 2})
+        self.vector_db.embeddings.embed_documents.side_effect = lambda texts: [[float(i + 1)] + [0.0] * 7 for i in range(len(texts))]
+        self.vector_db.similarity_search_with_score_by_vectors.side_effect = lambda vectors, **kw: [[(doc, 0.1)] for _ in vectors]
+
+    @patch.object(main.LLM, '_client')
+    def test_batch_streams_json_lines_with_one_embedding_and_search_call(self, mock_client):
+        """Duplicates are answered once; embeddings and FAISS search run once for the whole batch."""
+        completion = MagicMock()
+        completion.choices[0].message.content = '{"answer": "028-0016030", "confidence": "alta"}'
+        mock_client.chat.completions.create.return_value = completion
+        questions = ['¿Cuál es la matrícula?', '¿Quiénes son las partes?', '¿Cuál es la matrícula?']
+
+        response = self.app.post('/chat/batch', json={'questions': questions})
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+        answers = sorted(lines[:-1], key=lambda item: item['index'])
+        self.assertEqual([a['question'] for a in answers], questions)
+        self.assertTrue(all(a['response'] == '028-0016030' for a in answers))
+        self.assertEqual(lines[-1]['done'], True)
+        self.assertEqual(lines[-1]['generated'], 3)
+        self.assertEqual(self.vector_db.embeddings.embed_documents.call_count, 1)
+        self.assertEqual(self.vector_db.similarity_search_with_score_by_vectors.call_count, 1)
+        self.assertEqual(mock_client.chat.completions.create.call_count, 2)
+
+        # la segunda vez todo sale del cache compartido
+        response = self.app.post('/chat/batch', data={'questions': '\n'.join(questions)})
+        summary = json.loads(response.get_data(as_text=True).splitlines()[-1])
+        self.assertEqual(summary['cached'], 3)
+        self.assertEqual(mock_client.chat.completions.create.call_count, 2)
+
+    @patch.object(main.LLM, '_client')
+    def test_batch_filter_reaches_search_and_scopes_cache(self, mock_client):
+        completion = MagicMock()
+        completion.choices[0].message.content = '{"answer": "028-0016030", "confidence": "alta"}'
+        mock_client.chat.completions.create.return_value = completion
+        questions = ['¿Cuál es la matrícula?']
+
+        self.app.post('/chat/batch', json={'questions': questions, 'filter': {'document': 'e.pdf'}})
+        kwargs = self.vector_db.similarity_search_with_score_by_vectors.call_args.kwargs
+        self.assertEqual(kwargs['filter'], {'document': ['e.pdf']})
+
+        # sin filtro la misma pregunta no reutiliza la respuesta filtrada
+        response = self.app.post('/chat/batch', json={'questions': questions})
+        summary = json.loads(response.get_data(as_text=True).splitlines()[-1])
+        self.assertEqual(summary['generated'], 1)
+        self.assertNotIn('filter', self.vector_db.similarity_search_with_score_by_vectors.call_args.kwargs)
+
+        response = self.app.post('/chat/batch', json={'questions': questions, 'filter': {'since': 'ayer'}})
+        self.assertEqual(response.status_code, 400)
+
+    @patch.object(main.LLM, '_client')
+    def test_batch_cache_is_scoped_by_tenant(self, mock_client):
+        completion = MagicMock()
+        completion.choices[0].message.content = '{"answer": "028-0016030", "confidence": "alta"}'
+        mock_client.chat.completions.create.return_value = completion
+        questions = ['¿Cuál es la matrícula?']
+
+        def summary(response):
+            return json.loads(response.get_data(as_text=True).splitlines()[-1])
+
+        response = self.app.post('/chat/batch', json={'questions': questions}, headers={'X-Tenant-ID': 'despacho-a'})
+        self.assertEqual(summary(response)['generated'], 1)
+        self.assertEqual(main.wait_for_vector_db.call_args.args[1], 'despacho-a')
+        # otro tenant no ve la respuesta cacheada del primero
+        response = self.app.post('/chat/batch', json={'questions': questions, 'tenant': 'despacho-b'})
+        self.assertEqual(summary(response)['generated'], 1)
+        response = self.app.post('/chat/batch', json={'questions': questions}, headers={'X-Tenant-ID': 'despacho-a'})
+        self.assertEqual(summary(response)['cached'], 1)
+
+        response = self.app.post('/chat/batch', json={'questions': questions}, headers={'X-Tenant-ID': '../otro'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_batch_requires_questions(self):
+        response = self.app.post('/chat/batch', json={'questions': []})
+        self.assertEqual(response.status_code, 400)
+
+
+class FakeQuery:
+    """Minimal postgrest query builder: records the calls and returns `rows` matching eq/is_ filters."""
+
+    def __init__(self, rows, calls):
+        self.rows, self.calls = rows, calls
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            self.calls.append((name,) + args)
+            return self
+        return call
+
+    def execute(self):
+        rows = self.rows
+        for call in self.calls:
+            if call[0] == 'eq':
+                rows = [row for row in rows if row.get(call[1]) == call[2]]
+            elif call[0] == 'is_' and call[2] == 'null':
+                rows = [row for row in rows if row.get(call[1]) is None]
+        return MagicMock(data=rows)
+
+
+class HistoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = app.test_client()
+        self.rows = [{'id': f'id{i}', 'user_question': f'pregunta {i}', 'bot_response': 'r', 'confidence': 'alta',
+                      'created_at': f'2026-10-18T10:00:0{9 - i}+00:00', 'cross_references': [],
+                      'session_id': '6f1c1f3e-7d5b-4c35-9a68-0d4c4f2ddf10', 'tenant_id': None} for i in range(3)]
+        self.queries = []
+        client = MagicMock()
+        client.table.side_effect = lambda name: self.queries.append([]) or FakeQuery(self.rows, self.queries[-1])
+        history_patch = patch('main.HISTORY', HistoryService(lambda: client, ttl=60))
+        history_patch.start()
+        self.addCleanup(history_patch.stop)
+
+    def test_keyset_pages_projection_and_cache(self):
+        data = json.loads(self.app.get('/history?limit=2&session_id=6f1c1f3e-7d5b-4c35-9a68-0d4c4f2ddf10').data)
+        self.assertEqual([h['question'] for h in data['history']], ['pregunta 0', 'pregunta 1'])
+        self.assertIsNotNone(data['next_cursor'])
+        calls = self.queries[0]
+        self.assertIn(('select', HISTORY_FIELDS), calls)
+        self.assertIn(('eq', 'session_id', '6f1c1f3e-7d5b-4c35-9a68-0d4c4f2ddf10'), calls)
+        self.assertIn(('limit', 3), calls)
+
+        # la misma página sale del cache; la siguiente filtra por (created_at, id) del último elemento
+        self.app.get('/history?limit=2&session_id=6f1c1f3e-7d5b-4c35-9a68-0d4c4f2ddf10')
+        self.assertEqual(len(self.queries), 1)
+        self.app.get(f"/history?limit=2&cursor={data['next_cursor']}")
+        keyset = [c for c in self.queries[1] if c[0] == 'or_'][0][1]
+        self.assertIn('created_at.lt."2026-10-18T10:00:08+00:00"', keyset)
+        self.assertIn('id.lt."id1"', keyset)
+
+        # una escritura de conversaciones invalida las páginas cacheadas
+        main.HISTORY.invalidate()
+        self.app.get('/history?limit=2&session_id=6f1c1f3e-7d5b-4c35-9a68-0d4c4f2ddf10')
+        self.assertEqual(len(self.queries), 3)
+
+    def test_history_is_isolated_by_tenant(self):
+        self.rows.append({'id': 'ta', 'user_question': 'pregunta de a', 'bot_response': 'r', 'confidence': 'alta',
+                          'created_at': '2026-10-18T11:00:00+00:00', 'cross_references': [], 'tenant_id': 'despacho-a'})
+        self.rows.append({'id': 'tb', 'user_question': 'pregunta de b', 'bot_response': 'r', 'confidence': 'alta',
+                          'created_at': '2026-10-18T11:00:01+00:00', 'cross_references': [], 'tenant_id': 'despacho-b'})
+
+        main.HISTORY.tenants_in_use = lambda: True
+        data = json.loads(self.app.get('/history?limit=10').data)
+        self.assertEqual([h['question'] for h in data['history']], ['pregunta 0', 'pregunta 1', 'pregunta 2'])
+        self.assertIn(('is_', 'tenant_id', 'null'), self.queries[0])
+
+        data = json.loads(self.app.get('/history?limit=10', headers={'X-Tenant-ID': 'despacho-a'}).data)
+        self.assertEqual([h['question'] for h in data['history']], ['pregunta de a'])
+        data = json.loads(self.app.get('/history?limit=10&tenant=despacho-b').data)
+        self.assertEqual([h['question'] for h in data['history']], ['pregunta de b'])
+        self.assertEqual(self.app.get('/history?tenant=../x').status_code, 400)
+
+    def test_history_without_tenants_does_not_filter_tenant_column(self):
+        """Without tenants in use the query never touches tenant_id, so databases without the column still work."""
+        data = json.loads(self.app.get('/history?limit=10').data)
+        self.assertEqual(len(data['history']), 3)
+        self.assertFalse([c for c in self.queries[0] if 'tenant_id' in c])
+
+    def test_invalid_parameters(self):
+        self.assertEqual(self.app.get('/history?cursor=@@@').status_code, 400)
+        self.assertEqual(self.app.get('/history?session_id=abc').status_code, 400)
+        self.assertEqual(self.queries, [])
+
+
+class PersistRagAnswerTestCase(unittest.TestCase):
+
+    @patch('main.save_conversation_to_db')
+    def test_plain_text_answer_is_persisted(self, mock_save_db):
+        """When the LLM does not return JSON the answer is still saved, with empty quotes and references."""
+        payload = main.finalize_rag_answer('El canon mensual es de $2.000.000', [{'source': 'a.pdf'}], 'media',
+                                           'canon?', 0.0, corpus_id='g1')
+        self.assertNotIn('exact_quotes', payload)
+        mock_save_db.assert_called_once()
+        self.assertEqual(mock_save_db.call_args.args[1:6],
+                         ('El canon mensual es de $2.000.000', [{'source': 'a.pdf'}], 'media', [], []))
+
+
+class SentenceEmbeddingsTestCase(unittest.TestCase):
+
+    def test_sentence_vectors_use_memory_lru_and_request_deadline(self):
+        """Compression embeds sentences once (in memory) and skips the API call when the deadline is spent."""
+        client = MagicMock()
+        client.with_options.return_value.embeddings.create.side_effect = lambda model, input: MagicMock(
+            data=[MagicMock(index=i, embedding=[1.0, float(len(t))]) for i, t in enumerate(input)])
+        with patch('main.LLM._client', client), \
+                patch('main.SENTENCE_EMBEDDINGS', QueryEmbeddingCache(max_entries=8)):
+            embed = main.sentence_embedder(main.Deadline(8))
+            self.assertEqual(len(embed(['Primera oración del contrato.', 'Segunda oración.'])), 2)
+            embed(['Primera oración del contrato.'])
+            self.assertEqual(client.with_options.return_value.embeddings.create.call_count, 1)
+            self.assertLessEqual(client.with_options.call_args.kwargs['timeout'], 4)
+            self.assertIsNone(main.sentence_embedder(main.Deadline(0.5)))
+
+
+class LazyTestCase(unittest.TestCase):
+
+    def test_failed_factory_is_retried_after_backoff(self):
+        """A transient failure is not cached forever: the next get() after the backoff retries."""
+        factory = MagicMock(side_effect=[RuntimeError('supabase caído'), 'cliente'])
+        resource = Lazy('supabase', factory, retry_after=0.05)
+        self.assertIsNone(resource.get())
+        self.assertIsNone(resource.get())  # dentro de la espera: no se reintenta
+        self.assertEqual(factory.call_count, 1)
+        self.assertFalse(resource.status()['ok'])
+        time.sleep(0.06)
+        self.assertEqual(resource.get(), 'cliente')
+        self.assertIsNone(resource.status()['error'])
+        self.assertTrue(resource.loaded)
+
+
+class QueryEmbeddingCacheTestCase(unittest.TestCase):
+
+    def test_repeated_question_skips_embedding_call(self):
+        """The same question with different case/punctuation is embedded once; old entries are evicted."""
+        cache = QueryEmbeddingCache(max_entries=2)
+        embedder = MagicMock(model='text-embedding-ada-002')
+        embedder.embed_query.side_effect = lambda text: [float(len(text))]
+        first = cache.embed(embedder, '¿Cuál es el canon mensual?')
+        self.assertEqual(cache.embed(embedder, 'CUÁL es el  canon mensual'), first)
+        self.assertEqual(embedder.embed_query.call_count, 1)
+
+        embedder.embed_documents.side_effect = lambda texts: [[float(len(t))] for t in texts]
+        vectors = cache.embed_many(embedder, ['Cuál es el canon mensual', 'plazo', 'partes'])
+        self.assertEqual(vectors[0], first)
+        embedder.embed_documents.assert_called_once_with(['plazo', 'partes'])
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.stats()['hits'], 2)
+
+
+class PartialJsonTestCase(unittest.TestCase):
+
+    def test_partial_string_and_closed_list_items(self):
+        """Truncated strings are returned; only closed list items are exposed."""
+        parsed = parse_partial_json('```json\n{"answer": "El plazo es de 3')
+        self.assertEqual(parsed, {'answer': 'El plazo es de 3'})
+        parsed = parse_partial_json('{"answer": "ok", "key_points": ["uno", "do')
+        self.assertEqual(parsed, {'answer': 'ok', 'key_points': ['uno']})
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,413 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+from langchain_community.embeddings import DeterministicFakeEmbedding
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+from chatbot.context import SECTION_SEPARATOR, assemble_context
+from chatbot.corpus import CorpusVersion
+from chatbot.lexical import reciprocal_rank_fusion, tokenize
+from chatbot.ann import build_index, choose_index_type, index_type_of, recall_report, search
+from chatbot.segments import SegmentedVectorStore
+from chatbot.tenants import TenantStores, check_tenant
+
+
+class SegmentedVectorStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.embeddings = DeterministicFakeEmbedding(size=8)
+
+    def make_doc(self, texts, source):
+        return FAISS.from_texts(texts, self.embeddings, metadatas=[{"source": source}] * len(texts))
+
+    def open_store(self, **kwargs):
+        return SegmentedVectorStore(self.tmp.name, self.embeddings, refresh_interval=0, **kwargs)
+
+    def test_legacy_index_registered_as_segment(self):
+        self.make_doc(["clausula primera", "clausula segunda"], "viejo.pdf").save_local(self.tmp.name)
+        store = self.open_store()
+        self.assertEqual(store.stats()["segments"], 1)
+        self.assertEqual(len(store), 2)
+
+        # convertido una sola vez a índice + docstore por offsets, sin pickle
+        segment_dirs = os.listdir(os.path.join(self.tmp.name, "segments"))
+        self.assertEqual(len(segment_dirs), 1)
+        files = set(os.listdir(os.path.join(self.tmp.name, "segments", segment_dirs[0])))
+        self.assertEqual(files, {"index.faiss", "docs.jsonl", "docs.offsets.npy", "bm25.terms.json",
+                                 "bm25.docs.npy", "bm25.tf.npy", "bm25.lens.npy"})
+        doc, _ = store.similarity_search_with_score("clausula segunda", k=1)[0]
+        self.assertEqual(doc.page_content, "clausula segunda")
+        self.assertEqual(doc.metadata["source"], "viejo.pdf")
+
+    def test_new_segments_visible_to_other_worker(self):
+        writer, reader = self.open_store(), self.open_store()
+        writer.add_segment(self.make_doc(["el precio es de diez millones"], "a.pdf"), source="a.pdf")
+        writer.add_segment(self.make_doc(["el plazo es de seis meses"], "b.pdf"), source="b.pdf")
+
+        results = reader.similarity_search_with_score("el plazo es de seis meses", k=2)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[0][0].metadata["source"], "b.pdf")
+        self.assertEqual(reader.stats()["segments"], 2)
+
+    def test_watcher_swaps_snapshot_without_touching_in_flight_one(self):
+        writer = self.open_store()
+        writer.add_segment(self.make_doc(["el precio es de diez millones"], "a.pdf"), source="a.pdf")
+        reader = SegmentedVectorStore(self.tmp.name, self.embeddings, refresh_interval=0.02)
+        reader.start_watcher()
+        in_flight = reader.snapshot()
+
+        writer.add_segment(self.make_doc(["el plazo es de seis meses"], "b.pdf"), source="b.pdf")
+        deadline = time.monotonic() + 5
+        while reader.snapshot() is in_flight and time.monotonic() < deadline:
+            time.sleep(0.02)
+
+        current = reader.snapshot()
+        self.assertEqual(len(in_flight.segments), 1)
+        self.assertEqual(len(current.segments), 2)
+        self.assertEqual(current.generation, writer.stats()["generation"])
+        # el snapshot se publica con el índice léxico ya abierto
+        self.assertTrue(all(seg._bm25 is not None for seg in current.segments.values()))
+        self.assertEqual(reader.corpus(), writer.corpus())
+
+    def test_merge_small_segments(self):
+        store = self.open_store(max_segments=2)
+        for i in range(4):
+            store.add_segment(self.make_doc([f"documento {i}"], f"{i}.pdf"), source=f"{i}.pdf")
+        merged = store.merge_small_segments()
+        self.assertEqual(merged, 4)
+        self.assertEqual(store.stats()["segments"], 1)
+        self.assertEqual(len(store), 4)
+        self.assertEqual(len(os.listdir(os.path.join(self.tmp.name, "segments"))), 1)
+        self.assertEqual(store.similarity_search_with_score("documento 3", k=1)[0][0].page_content, "documento 3")
+
+    def test_segments_merged_by_other_worker_stay_readable(self):
+        writer = self.open_store(max_segments=1)
+        parents = [Document(page_content="ARTÍCULO 1. Texto completo", metadata={"source": "a.pdf"})]
+        children = FAISS.from_texts(["artículo 1 de a"], self.embeddings,
+                                    metadatas=[{"source": "a.pdf", "parent_id": 0}])
+        writer.add_segment(children, source="a.pdf", parents=parents)
+        writer.add_segment(self.make_doc(["el plazo es de seis meses"], "b.pdf"), source="b.pdf")
+        # un worker que todavía no vio la fusión (su vigilante no ha vuelto a mirar el manifest)
+        reader = SegmentedVectorStore(self.tmp.name, self.embeddings, refresh_interval=3600)
+        old = reader.snapshot()
+        reader.evict("b.pdf")
+
+        writer.merge_small_segments()  # borra las carpetas de a y b
+        # el segmento abierto se sigue leyendo, padres incluidos, y no se deja soltar
+        seg_a = next(seg for seg in old.segments.values() if seg.resident)
+        self.assertEqual(seg_a.parent(0).page_content, "ARTÍCULO 1. Texto completo")
+        # el liberado ya no existe: la búsqueda recarga el manifest y usa el segmento fusionado
+        doc, _ = reader.similarity_search_with_score("el plazo es de seis meses", k=1)[0]
+        self.assertEqual(doc.metadata["source"], "b.pdf")
+        self.assertTrue(seg_a.retired)
+        self.assertFalse(seg_a.release())
+        self.assertEqual(seg_a.document(0).page_content, "artículo 1 de a")
+
+    def test_children_return_their_parent_provision_after_merge(self):
+        store = self.open_store(max_segments=1)
+        parents = {}
+        for name in ("a.pdf", "b.pdf"):
+            parents[name] = [Document(page_content=f"ARTÍCULO {i}. Texto completo del artículo {i} de {name}",
+                                      metadata={"source": name}) for i in range(2)]
+            children = FAISS.from_texts([f"artículo {i} de {name}" for i in range(2)], self.embeddings,
+                                        metadatas=[{"source": name, "parent_id": i} for i in range(2)])
+            store.add_segment(children, source=name, parents=parents[name])
+
+        store.merge_small_segments()
+        self.assertEqual(store.stats()["segments"], 1)
+        for name in ("a.pdf", "b.pdf"):
+            doc, _ = store.similarity_search_with_score(f"artículo 1 de {name}", k=1)[0]
+            self.assertEqual(doc.page_content, f"artículo 1 de {name}")
+            self.assertEqual(doc.metadata["parent_content"], parents[name][1].page_content)
+
+    def test_corpus_version_changes_on_ingest_not_on_merge(self):
+        store = self.open_store(max_segments=2)
+        reader = CorpusVersion(os.path.join(self.tmp.name, "manifest.json"), check_interval=0)
+        empty_id = reader.id()
+        for i in range(3):
+            store.add_segment(self.make_doc([f"documento {i}"], f"{i}.pdf"), source=f"{i}.pdf")
+        self.assertEqual(store.corpus()["generation"], 3)
+        ingested_id = reader.id()
+        self.assertNotEqual(ingested_id, empty_id)
+        self.assertTrue(ingested_id.startswith("g3-"))
+
+        store.merge_small_segments()
+        self.assertEqual(reader.id(), ingested_id)
+        store.add_segment(self.make_doc(["documento 3"], "3.pdf"), source="3.pdf")
+        self.assertTrue(reader.id().startswith("g4-"))
+
+    def test_configured_index_type_applied_to_large_segments(self):
+        store = self.open_store(index_type="hnsw")
+        texts = [f"clausula {i}" for i in range(1200)]
+        entry = store.add_segment(self.make_doc(texts, "grande.pdf"), source="grande.pdf")
+        self.assertEqual(entry["index_type"], "hnsw")
+        results = store.similarity_search_with_score("clausula 42", k=1, ef_search=128)
+        self.assertEqual(results[0][0].page_content, "clausula 42")
+
+    def test_ivf_direct_map_built_on_open_and_mmr_keeps_best_hit(self):
+        import faiss
+
+        writer = self.open_store(index_type="ivf")
+        writer.add_segment(self.make_doc([f"clausula {i}" for i in range(1200)], "grande.pdf"), source="grande.pdf")
+        store = self.open_store(mmr_lambda=0.5)
+        seg = store.segments()[0]
+        self.assertEqual(seg.kind, "ivf")
+        # el mapa directo se arma al abrir el segmento, no desde las búsquedas
+        self.assertNotEqual(faiss.extract_index_ivf(seg.index).direct_map.type, faiss.DirectMap.NoMap)
+        results = store.similarity_search_with_score("clausula 42", k=3, nprobe=64)
+        self.assertEqual(results[0][0].page_content, "clausula 42")
+
+    def test_hybrid_search_finds_exact_identifiers(self):
+        store = self.open_store()
+        texts = [f"clausula {i} sobre obligaciones generales del contrato" for i in range(30)]
+        texts.append("Inmueble identificado con matrícula inmobiliaria No. 028-0016030")
+        store.add_segment(self.make_doc(texts, "escritura.pdf"), source="escritura.pdf")
+        store.add_segment(self.make_doc(["Según el Art. 15 la garantía es de un año"], "ley.pdf"), source="ley.pdf")
+
+        query = "¿cuál es el inmueble de la matricula 028-0016030?"
+        # los embeddings de prueba son aleatorios: la coincidencia llega solo por BM25
+        results = store.similarity_search_with_score(query, k=3)
+        matches = [doc for doc, _ in results if "028-0016030" in doc.page_content]
+        self.assertEqual(len(matches), 1)
+        self.assertEqual(matches[0].metadata["retrieval"], "lexical")
+
+        lexical = store.lexical_search("que dice el articulo 15", k=1)
+        self.assertEqual(lexical[0][0].metadata["source"], "ley.pdf")
+
+    def test_batch_search_matches_single_queries(self):
+        """A matrix query returns the same hits as one query at a time."""
+        store = self.open_store()
+        store.add_segment(self.make_doc(["matrícula 028-0016030", "canon mensual", "cláusula penal"], "a.pdf"), source="a.pdf")
+        store.add_segment(self.make_doc(["avalúo comercial", "plazo de entrega"], "b.pdf"), source="b.pdf")
+        queries = ["canon mensual", "plazo de entrega"]
+        vectors = [self.embeddings.embed_query(q) for q in queries]
+        batch = store.similarity_search_with_score_by_vectors(vectors, k=2, query_texts=queries)
+        for vector, query, hits in zip(vectors, queries, batch):
+            single = store.similarity_search_with_score_by_vector(vector, k=2, query_text=query)
+            self.assertEqual([d.page_content for d, _ in hits], [d.page_content for d, _ in single])
+        self.assertEqual(batch[0][0][0].page_content, "canon mensual")
+
+    def test_filter_limits_search_to_partitions_across_merge(self):
+        store = self.open_store(max_segments=1)
+        texts = ["el arrendatario pagará el canon mensual", "la cláusula penal es de diez millones"]
+        for name in ("a.pdf", "b.pdf", "c.pdf"):
+            store.add_segment(self.make_doc([f"{t} ({name})" for t in texts], name), source=name)
+        first_corpus = store.partitions()[0]["corpus_id"]
+        query = "el arrendatario pagará el canon mensual (a.pdf)"
+
+        for merged in (False, True):
+            results = store.similarity_search_with_score(query, k=4, filter={"document": "b.pdf"})
+            self.assertEqual({d.metadata["source"] for d, _ in results}, {"b.pdf"})
+            self.assertEqual(len(results), 2)
+            # el corpus de la primera ingesta solo tenía a.pdf
+            results = store.similarity_search_with_score(query, k=4, filter={"corpus": first_corpus})
+            self.assertEqual({d.metadata["source"] for d, _ in results}, {"a.pdf"})
+            lexical = store.lexical_search("cláusula penal", k=4, filter={"document": ["a.pdf", "c.pdf"]})
+            self.assertEqual({d.metadata["source"] for d, _ in lexical}, {"a.pdf", "c.pdf"})
+            self.assertEqual(store.similarity_search_with_score(query, k=4, filter={"until": "2000-01-01"}), [])
+            store.merge_small_segments()
+        self.assertEqual(store.stats()["segments"], 1)
+        self.assertEqual([(p["source"], p["start"], p["stop"]) for p in store.partitions()],
+                         [("a.pdf", 0, 2), ("b.pdf", 2, 4), ("c.pdf", 4, 6)])
+        with self.assertRaises(ValueError):
+            store.check_filter({"corpus": "g9-desconocido"})
+        with self.assertRaises(ValueError):
+            store.check_filter({"since": "ayer"})
+
+    def test_single_document_filter_on_ivf_segment_returns_k(self):
+        store = self.open_store(max_segments=1, index_type="ivf")
+        store.add_segment(self.make_doc([f"clausula general {i}" for i in range(1500)], "grande.pdf"),
+                          source="grande.pdf")
+        store.add_segment(self.make_doc([f"anexo {i}" for i in range(60)], "anexo.pdf"), source="anexo.pdf")
+        store.merge_small_segments()
+        self.assertEqual(store.segments()[0].kind, "ivf")
+        results = store.similarity_search_with_score("clausula general 3", k=4, nprobe=1,
+                                                     filter={"document": "anexo.pdf"})
+        self.assertEqual(len(results), 4)
+        self.assertEqual({d.metadata["source"] for d, _ in results}, {"anexo.pdf"})
+
+    def test_evicted_segments_reload_on_demand(self):
+        store = self.open_store()
+        store.add_segment(self.make_doc(["el plazo es de seis meses"], "a.pdf"), source="a.pdf")
+        store.add_segment(self.make_doc(["el precio es de diez millones"], "b.pdf"), source="b.pdf")
+        self.assertEqual(len(store.evict("a.pdf")), 1)
+        self.assertEqual({p["source"]: p["resident"] for p in store.partitions()}, {"a.pdf": False, "b.pdf": True})
+        self.assertEqual(len(store), 2)
+
+        # buscar solo en b no reabre a
+        store.similarity_search_with_score("el precio", k=1, filter={"document": "b.pdf"})
+        self.assertEqual(store.stats()["resident_segments"], 1)
+        doc, _ = store.similarity_search_with_score("el plazo es de seis meses", k=1)[0]
+        self.assertEqual(doc.metadata["source"], "a.pdf")
+        self.assertEqual(store.stats()["resident_segments"], 2)
+
+
+class TenantStoresTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.embeddings = DeterministicFakeEmbedding(size=8)
+
+    def open_tenants(self, **kwargs):
+        tenants = TenantStores(self.tmp.name, lambda path: SegmentedVectorStore(
+            path, self.embeddings, refresh_interval=0), **kwargs)
+        self.addCleanup(tenants.evict)
+        return tenants
+
+    def ingest(self, tenants, tenant, text):
+        doc = FAISS.from_texts([text], self.embeddings, metadatas=[{"source": f"{tenant}.pdf"}])
+        tenants.get(tenant, create=True).add_segment(doc, source=f"{tenant}.pdf")
+
+    def test_tenants_are_isolated_and_least_recently_used_is_closed(self):
+        tenants = self.open_tenants(max_resident=2)
+        self.assertIsNone(tenants.get("despacho-a"))
+        for tenant, text in (("despacho-a", "el precio es de diez millones"),
+                             ("despacho-b", "el plazo es de seis meses"),
+                             ("despacho-c", "la multa es del veinte por ciento")):
+            self.ingest(tenants, tenant, text)
+        self.assertEqual(tenants.stats()["resident"], ["despacho-b", "despacho-c"])
+        self.assertEqual(tenants.evictions, 1)
+
+        # el tenant cerrado se reabre desde disco y solo ve sus documentos
+        store = tenants.get("despacho-a")
+        results = store.similarity_search_with_score("el plazo es de seis meses", k=5)
+        self.assertEqual({doc.metadata["source"] for doc, _ in results}, {"despacho-a.pdf"})
+        self.assertEqual(tenants.stats()["resident"], ["despacho-c", "despacho-a"])
+        self.assertNotEqual(store.corpus(), tenants.get("despacho-c").corpus())
+
+    def test_memory_ceiling_closes_other_tenants(self):
+        tenants = self.open_tenants(max_resident=8, max_bytes=1)
+        self.ingest(tenants, "despacho-a", "el precio es de diez millones")
+        self.ingest(tenants, "despacho-b", "el plazo es de seis meses")
+        # el tenant en uso nunca se cierra, aunque él solo pase del techo
+        self.assertEqual(tenants.stats()["resident"], ["despacho-b"])
+        self.assertGreater(tenants.resident_bytes(), 0)
+
+    def test_close_waits_for_threads_and_in_flight_searches(self):
+        tenants = self.open_tenants()
+        self.ingest(tenants, "despacho-a", "el precio es de diez millones")
+        store = tenants.get("despacho-a")
+        store.start_watcher()
+        store.start_merger()
+        seg = store.segments()[0]
+        with store._reading() as (_, segments, _):
+            self.assertEqual(tenants.evict("despacho-a"), ["despacho-a"])
+            self.assertFalse(store._watcher.is_alive() or store._merger.is_alive())
+            # la búsqueda en curso sigue con el segmento abierto
+            self.assertTrue(seg.resident)
+            self.assertEqual(segments[seg.name].document(0).page_content, "el precio es de diez millones")
+        self.assertFalse(seg.resident)
+        self.assertEqual(tenants.stats()["resident"], [])
+
+    def test_tenant_ids_are_safe_folder_names(self):
+        self.assertEqual(check_tenant("despacho_1.co"), "despacho_1.co")
+        for tenant in ("../otro", "a/b", "", "-x", "a" * 65):
+            with self.assertRaises(ValueError):
+                check_tenant(tenant)
+
+
+class LexicalTestCase(unittest.TestCase):
+
+    def test_tokenize_keeps_numbers_and_articles(self):
+        tokens = tokenize("Escritura pública número 2.061, Art. 15 y matrícula No. 028-0016030")
+        for token in ("escritura", "publica", "2.061", "2061", "art_15", "matricula", "028-0016030"):
+            self.assertIn(token, tokens)
+        self.assertNotIn("y", tokens)
+
+    def test_reciprocal_rank_fusion(self):
+        fused = reciprocal_rank_fusion([["a", "b", "c"], ["c", "a"]])
+        self.assertEqual(fused[0], "a")
+        self.assertEqual(set(fused), {"a", "b", "c"})
+
+
+class AnnIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.vectors = np.random.default_rng(0).random((2000, 16), dtype="float32")
+
+    def test_auto_index_type_by_size(self):
+        self.assertEqual(choose_index_type(500, "hnsw"), "flat")
+        self.assertEqual(choose_index_type(5_000), "flat")
+        self.assertEqual(choose_index_type(50_000), "ivf")
+        self.assertEqual(choose_index_type(2_000_000), "ivfpq")
+        self.assertEqual(choose_index_type(5_000, "hnsw"), "hnsw")
+
+    def test_ann_indexes_find_exact_vector(self):
+        for index_type in ("ivf", "ivfpq", "hnsw"):
+            index = build_index(self.vectors, index_type)
+            self.assertEqual(index_type_of(index), index_type)
+            _, ids = search(index, self.vectors[7], 1, nprobe=64, ef_search=64)
+            self.assertEqual(ids[0][0], 7, index_type)
+
+    def test_search_restricted_to_ranges(self):
+        ranges = [(100, 200), (1500, 1510)]
+        for index_type in ("flat", "ivf", "hnsw"):
+            index = build_index(self.vectors, index_type)
+            _, ids = search(index, self.vectors[[150, 1505, 7]], 3, nprobe=64, ef_search=64, ranges=ranges)
+            self.assertEqual(ids[0][0], 150, index_type)
+            self.assertEqual(ids[1][0], 1505, index_type)
+            found = ids[ids >= 0]
+            self.assertTrue(all(100 <= i < 200 or 1500 <= i < 1510 for i in found), index_type)
+
+    def test_large_selection_widens_probes(self):
+        ranges = [(0, 40)]
+        for index_type in ("ivf", "hnsw"):
+            index = build_index(self.vectors, index_type)
+            with patch("chatbot.ann.EXACT_RANGE_MAX", 0):
+                _, ids = search(index, self.vectors[[1500]], 4, nprobe=1, ef_search=4, ranges=ranges)
+            self.assertEqual(len(ids[0][ids[0] >= 0]), 4, index_type)
+            self.assertTrue(all(0 <= i < 40 for i in ids[0]), index_type)
+
+    def test_recall_report_against_flat(self):
+        rows = recall_report(self.vectors, k=4, n_queries=20, index_types=("flat", "ivf"), nprobes=(1, 64))
+        by_setting = {(r["index"], r.get("nprobe")): r["recall"] for r in rows}
+        self.assertEqual(by_setting[("flat", None)], 1.0)
+        self.assertGreaterEqual(by_setting[("ivf", 64)], by_setting[("ivf", 1)])
+
+
+class ContextAssemblyTestCase(unittest.TestCase):
+
+    def count(self, text):
+        return len(text.split())
+
+    def test_fits_budget_and_drops_near_duplicates(self):
+        """Chunks that fit are kept whole; a near-copy of a chunk is dropped."""
+        first = "El arrendatario pagará el canon dentro de los cinco primeros días de cada mes."
+        texts = [first, first.replace("cinco", "5"), "La garantía es una póliza de cumplimiento."]
+        contexto, info = assemble_context(texts, "¿cuándo se paga el canon?", 100, count=self.count)
+        self.assertFalse(info["compressed"])
+        self.assertEqual(contexto, SECTION_SEPARATOR.join([texts[0], texts[2]]))
+
+    def test_compresses_to_the_sentences_closest_to_the_query(self):
+        """Over budget, only the best-scoring sentences are kept, in their original order."""
+        relevant = "La matrícula inmobiliaria No. 028-0016030 corresponde al predio del contrato."
+        filler = ["Las partes declaran conocer el estado general del inmueble entregado.",
+                  "Cualquier modificación deberá constar por escrito y firmada por ambas partes.",
+                  "Los gastos de escrituración se pagarán por partes iguales entre ellas."]
+        texts = [" ".join(filler[:2] + [relevant]), filler[2]]
+
+        def embed(sentences):
+            return [[1.0, 0.0] if "matrícula" in s else [0.0, 1.0] for s in sentences]
+
+        contexto, info = assemble_context(texts, "¿cuál es la matrícula del predio?", 20,
+                                          query_vector=[1.0, 0.0], embed=embed, count=self.count)
+        self.assertTrue(info["compressed"])
+        self.assertLessEqual(info["tokens"], 20)
+        self.assertIn(relevant, contexto)
+        self.assertNotIn(filler[1], contexto)
+
+        # sin embeddings, los números citados en la pregunta siguen guiando la selección
+        contexto, _ = assemble_context(texts, "predio 028-0016030", 20, count=self.count)
+        self.assertIn(relevant, contexto)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import os
+import tempfile
+import unittest
+
+from chatbot.write_behind import WriteBehindQueue
+
+
+class FlakySink:
+    """Records every batch; raises while `down` is True."""
+
+    def __init__(self):
+        self.down = False
+        self.batches = []
+
+    def __call__(self, table, rows):
+        if self.down:
+            raise ConnectionError("supabase unreachable")
+        self.batches.append((table, [row["id"] for row in rows]))
+        return True
+
+
+class WriteBehindQueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.sink = FlakySink()
+        # flush_interval alto: el hilo solo vacía lotes llenos; el resto se vacía con flush()/close()
+        self.queue = WriteBehindQueue(self.sink, self.tmp.name, max_batch=2, flush_interval=60, retry_interval=0)
+        self.addCleanup(self.queue.close, 0)
+
+    def test_rows_are_batched_per_table(self):
+        for i in range(3):
+            self.queue.enqueue("conversations", {"id": f"c{i}"})
+        self.queue.enqueue("analytics", {"id": "a0"})
+        self.queue.close()
+        self.assertEqual(self.queue.stats()["written"], 4)
+        self.assertEqual(self.sink.batches, [("conversations", ["c0", "c1"]), ("conversations", ["c2"]),
+                                             ("analytics", ["a0"])])
+        self.assertEqual(self.queue.stats()["queued"], 0)
+
+    def test_outage_spills_to_journal_and_replays_on_recovery(self):
+        self.sink.down = True
+        self.queue.enqueue("documents", {"id": "d0"})
+        self.queue.enqueue("conversations", {"id": "c0"})
+        self.assertEqual(self.queue.flush(), 0)
+        self.assertEqual(self.queue.stats()["journal_rows"], 2)
+        self.assertEqual(self.sink.batches, [])
+
+        # otro proceso (misma carpeta) también reenvía el journal al recuperarse
+        self.sink.down = False
+        other = WriteBehindQueue(self.sink, self.tmp.name, max_batch=2, flush_interval=60, retry_interval=0)
+        self.assertEqual(other.flush(), 2)
+        self.assertEqual(sorted(self.sink.batches), [("conversations", ["c0"]), ("documents", ["d0"])])
+        self.assertEqual(other.stats()["journal_rows"], 0)
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+    def test_unconfigured_sink_drops_rows(self):
+        queue = WriteBehindQueue(lambda table, rows: False, self.tmp.name, max_batch=10, flush_interval=60)
+        queue.enqueue("analytics", {"id": "a0"})
+        self.assertEqual(queue.flush(), 0)
+        self.assertEqual(queue.stats()["dropped"], 1)
+        queue.close(0)
+
+
+if __name__ == '__main__':
+    unittest.main()